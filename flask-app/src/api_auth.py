@@ -0,0 +1,56 @@
+"""
+API Authentication Module
+Checks X-API-KEY / X-API-SECRET credentials for the API decorators
+Remembers recent successful checks so PBKDF2 runs once per key, not once per request
+"""
+
+import os
+import hmac
+import hashlib
+from .models import User
+from .ttl_cache import TTLCache
+
+API_AUTH_CACHE_TTL = float(os.getenv("API_AUTH_CACHE_TTL", "300"))        # seconds
+API_AUTH_CACHE_SIZE = int(os.getenv("API_AUTH_CACHE_SIZE", "10000"))      # api keys per worker
+
+# api_key -> (api_secret_hash it was verified against, keyed digest of the secret)
+_verified_credentials = TTLCache(API_AUTH_CACHE_SIZE, API_AUTH_CACHE_TTL)
+# Per-process key: the cache never holds anything that can be checked offline
+_digest_key = os.urandom(32)
+
+
+def _secret_digest(api_key, api_secret):
+    return hmac.new(_digest_key, f"{api_key}:{api_secret}".encode("utf-8"), hashlib.sha256).digest()
+
+
+def authenticate_api_credentials(api_key, api_secret):
+    """
+    Look up the user owning `api_key` and check `api_secret`.
+
+    A success is cached for API_AUTH_CACHE_TTL seconds together with the
+    user's api_secret_hash, so a rotated secret invalidates the entry in
+    every worker on its next lookup. Failures are never cached.
+
+    Args:
+        api_key: X-API-KEY header value
+        api_secret: X-API-SECRET header value
+
+    Returns:
+        User object, or None if the credentials are invalid
+    """
+    user = User.query.filter_by(api_key=api_key).first()
+    if not user:
+        return None
+
+    digest = _secret_digest(api_key, api_secret)
+    cached = _verified_credentials.get(api_key)
+    if cached is not None:
+        secret_hash, cached_digest = cached
+        if secret_hash == user.api_secret_hash and hmac.compare_digest(cached_digest, digest):
+            return user
+
+    if not user.check_api_secret(api_secret):
+        return None
+    _verified_credentials.set(api_key, (user.api_secret_hash, digest))
+    return user
+
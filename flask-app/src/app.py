@@ -20,7 +20,7 @@ def create_app():
     
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", "dev-secret-key-change-in-production")
+    app.config['SECRET_KEY'] = os.getenv("SECRET_KEY", os.getenv("FLASK_SECRET_KEY", "dev-secret-key-change-in-production"))
 
     db.init_app(app)
 
@@ -0,0 +1,215 @@
+"""
+Balance Module
+Every balance change is a row in the append-only balance_ledger
+users.*_balance_eur are its materialized projection, kept current by atomic UPDATEs or compaction
+"""
+
+from .models import db
+from .ipfs_access_control import invalidate_user_access, balance_crossed_zero
+
+# Account name -> users column
+BALANCE_COLUMNS = {
+    "credit": "credit_balance_eur",     # Bandwidth, backups, cluster billing, access validation
+    "kubo": "kubo_balance_eur",         # Prepaid IPFS Kubo pins
+    "cluster": "cluster_balance_eur",   # Prepaid IPFS Cluster backups
+}
+ENTRY_TYPES = {"payment", "pin_charge", "bandwidth", "cluster_billing", "backup_billing", "refund"}
+
+
+def _column(account):
+    try:
+        return BALANCE_COLUMNS[account]
+    except KeyError:
+        raise ValueError(f"Unknown balance account: {account}") from None
+
+
+def _check_entry_type(entry_type):
+    if entry_type not in ENTRY_TYPES:
+        raise ValueError(f"Unknown ledger entry type: {entry_type}")
+
+
+def _after_change(account, ipfs_access_hash, old_balance, new_balance):
+    # Only the credit balance gates downloads (see validate_ipfs_access)
+    if account == "credit" and balance_crossed_zero(old_balance, new_balance):
+        invalidate_user_access(ipfs_access_hash)
+
+
+def debit_balance(user_id, account, amount, entry_type, reference=None, allow_overdraft=False):
+    """
+    Take `amount` from a user's balance in one statement.
+
+    A plain conditional UPDATE checks and writes the balance, so concurrent
+    charges queue on the row for microseconds instead of losing updates, and
+    the outcome comes back in the same round trip. The ledger row is written
+    by the same statement. A refused charge writes and locks nothing; a
+    successful one holds the row lock until the caller commits, so keep slow
+    work out of that transaction.
+
+    Args:
+        user_id: User ID
+        account: "credit", "kubo" or "cluster"
+        amount: Decimal to deduct
+        entry_type: Ledger entry type (see ENTRY_TYPES)
+        reference: What the charge is for (CID, billing period, ...)
+        allow_overdraft: Charge even if the balance goes negative (usage billed after the fact)
+
+    Returns:
+        dict: {"success": True, "old_balance": Decimal, "new_balance": Decimal}
+              or {"success": False, "error": str, "current_balance": Decimal (if the user exists)}
+    """
+    column = _column(account)
+    _check_entry_type(entry_type)
+    row = db.session.execute(db.text(f"""
+        WITH debited AS (
+            UPDATE users
+               SET {column} = {column} - :amount
+             WHERE id = :user_id AND (:allow_overdraft OR {column} >= :amount)
+            RETURNING id, ipfs_access_hash, {column} + :amount AS old_balance, {column} AS balance
+        ), logged AS (
+            INSERT INTO balance_ledger (user_id, account, amount_eur, entry_type, reference, applied, created_at)
+            SELECT debited.id, :account, -CAST(:amount AS numeric), :entry_type, :reference, true, now() AT TIME ZONE 'utc'
+              FROM debited
+        )
+        SELECT old_balance, balance, ipfs_access_hash FROM debited
+    """), {"user_id": user_id, "amount": amount, "allow_overdraft": allow_overdraft,
+           "account": account, "entry_type": entry_type, "reference": reference}).first()
+
+    if row is None:
+        # Nothing was written or locked: read the balance only to explain the refusal
+        current_balance = db.session.execute(
+            db.text(f"SELECT {column} FROM users WHERE id = :user_id"), {"user_id": user_id}
+        ).scalar()
+        if current_balance is None:
+            return {"success": False, "error": "User not found"}
+        return {"success": False, "error": "Insufficient funds", "current_balance": current_balance}
+    old_balance, new_balance, ipfs_access_hash = row
+
+    _after_change(account, ipfs_access_hash, old_balance, new_balance)
+    return {"success": True, "old_balance": old_balance, "new_balance": new_balance}
+
+
+def credit_balance(user_id, account, amount, entry_type, reference=None):
+    """
+    Add `amount` to a user's balance in one statement (payments, refunds).
+    Applied to the users row immediately, so new funds are usable right away.
+
+    Returns:
+        dict: {"success": True, "old_balance": Decimal, "new_balance": Decimal}
+              or {"success": False, "error": "User not found"}
+    """
+    column = _column(account)
+    _check_entry_type(entry_type)
+    row = db.session.execute(db.text(f"""
+        WITH credited AS (
+            UPDATE users
+               SET {column} = {column} + :amount
+             WHERE id = :user_id
+            RETURNING id, ipfs_access_hash, {column} - :amount AS old_balance, {column} AS balance
+        ), logged AS (
+            INSERT INTO balance_ledger (user_id, account, amount_eur, entry_type, reference, applied, created_at)
+            SELECT credited.id, :account, :amount, :entry_type, :reference, true, now() AT TIME ZONE 'utc'
+              FROM credited
+        )
+        SELECT ipfs_access_hash, old_balance, balance FROM credited
+    """), {"user_id": user_id, "amount": amount, "account": account,
+           "entry_type": entry_type, "reference": reference}).first()
+
+    if row is None:
+        return {"success": False, "error": "User not found"}
+    ipfs_access_hash, old_balance, new_balance = row
+    _after_change(account, ipfs_access_hash, old_balance, new_balance)
+    return {"success": True, "old_balance": old_balance, "new_balance": new_balance}
+
+
+def post_ledger_entry(user_id, account, amount, entry_type, reference=None):
+    """
+    Record a balance change without touching the users row.
+
+    For bulk billing: the insert never waits on a user row lock, so billing
+    runs do not contend with uploads or payments. The change reaches the
+    users row on the next compact_ledger(); get_balance() already sees it.
+
+    Args:
+        amount: Signed Decimal (negative for a debit)
+    """
+    _column(account)
+    _check_entry_type(entry_type)
+    db.session.execute(db.text("""
+        INSERT INTO balance_ledger (user_id, account, amount_eur, entry_type, reference, applied, created_at)
+        VALUES (:user_id, :account, :amount, :entry_type, :reference, false, now() AT TIME ZONE 'utc')
+    """), {"user_id": user_id, "account": account, "amount": amount,
+           "entry_type": entry_type, "reference": reference})
+
+
+def compact_ledger():
+    """
+    Fold all unapplied ledger rows into the users balance columns, in one statement.
+
+    Rows are claimed by flipping `applied`, so rows committed while this runs
+    are left for the next compaction and concurrent compactions never apply
+    a row twice.
+
+    Returns:
+        int: Users whose balances changed
+    """
+    rows = db.session.execute(db.text("""
+        WITH claimed AS (
+            UPDATE balance_ledger SET applied = true
+             WHERE NOT applied
+            RETURNING user_id, account, amount_eur
+        ), pending AS (
+            SELECT user_id,
+                   COALESCE(SUM(amount_eur) FILTER (WHERE account = 'credit'), 0) AS credit,
+                   COALESCE(SUM(amount_eur) FILTER (WHERE account = 'kubo'), 0) AS kubo,
+                   COALESCE(SUM(amount_eur) FILTER (WHERE account = 'cluster'), 0) AS cluster
+              FROM claimed
+             GROUP BY user_id
+        )
+        UPDATE users
+           SET credit_balance_eur = credit_balance_eur + pending.credit,
+               kubo_balance_eur = kubo_balance_eur + pending.kubo,
+               cluster_balance_eur = cluster_balance_eur + pending.cluster
+          FROM pending
+         WHERE users.id = pending.user_id
+        RETURNING users.ipfs_access_hash, users.credit_balance_eur - pending.credit, users.credit_balance_eur
+    """)).fetchall()
+
+    for ipfs_access_hash, old_balance, new_balance in rows:
+        _after_change("credit", ipfs_access_hash, old_balance, new_balance)
+    db.session.commit()
+    print(f"Compacted balance ledger into {len(rows)} users.")
+    return len(rows)
+
+
+def get_balance(user_id, account):
+    """
+    Current balance: the users column plus ledger rows not yet compacted.
+    O(1) in practice - the pending partial index only covers rows since the last compaction.
+
+    Returns:
+        Decimal, or None if the user does not exist
+    """
+    column = _column(account)
+    return db.session.execute(db.text(f"""
+        SELECT users.{column} + COALESCE((
+                   SELECT SUM(amount_eur) FROM balance_ledger
+                    WHERE user_id = users.id AND account = :account AND NOT applied
+               ), 0)
+          FROM users
+         WHERE users.id = :user_id
+    """), {"user_id": user_id, "account": account}).scalar()
+
+
+def ledger_entries(user_id, since, until):
+    """
+    A user's ledger rows in [since, until), oldest first (month-end statements, audits).
+
+    Returns:
+        list: (id, account, amount_eur, entry_type, reference, created_at) rows
+    """
+    return db.session.execute(db.text("""
+        SELECT id, account, amount_eur, entry_type, reference, created_at
+          FROM balance_ledger
+         WHERE user_id = :user_id AND created_at >= :since AND created_at < :until
+         ORDER BY created_at, id
+    """), {"user_id": user_id, "since": since, "until": until}).fetchall()
@@ -3,15 +3,28 @@ Bandwidth tracking and charging module for IPFS Kubo
 Tracks bandwidth usage and charges based on private/public network
 """
 
-from decimal import Decimal
+import os
+import threading
+from decimal import Decimal, ROUND_HALF_UP
 from .models import db, User
+from .money import BYTES_PER_GB, to_nanos, to_eur, gb_cost, bytes_to_gb
+from .ipfs_access_control import invalidate_user_access, balance_crossed_zero
 from datetime import datetime
 
 # Pricing constants (should match routes.py)
 PRICE_PER_GB_BANDWIDTH_PRIVATE = Decimal("0.02")  # €0.02/GB
 PRICE_PER_GB_BANDWIDTH_PUBLIC = Decimal("0.10")   # €0.10/GB
 FREE_BANDWIDTH_GB_PER_MONTH = Decimal("1.00")     # 1 GB free
-BYTES_PER_GB = 1024 * 1024 * 1024
+
+# Metering works in integer bytes and nano-euros (see money.py)
+PRICE_NANOS_PER_GB_PRIVATE = to_nanos(PRICE_PER_GB_BANDWIDTH_PRIVATE)
+PRICE_NANOS_PER_GB_PUBLIC = to_nanos(PRICE_PER_GB_BANDWIDTH_PUBLIC)
+FREE_BANDWIDTH_BYTES_PER_MONTH = int(FREE_BANDWIDTH_GB_PER_MONTH * BYTES_PER_GB)
+CHARGE_PLACES = 8   # credit_balance_eur / balance_ledger precision
+
+# Write-behind metering (BandwidthAccumulator)
+BANDWIDTH_FLUSH_SECONDS = float(os.getenv("BANDWIDTH_FLUSH_SECONDS", "10"))
+BANDWIDTH_FLUSH_BATCH = 500   # users per UPDATE ... FROM (VALUES ...) statement
 
 
 def track_bandwidth_usage(user_id, bytes_transferred, is_private):
@@ -32,49 +45,22 @@ def track_bandwidth_usage(user_id, bytes_transferred, is_private):
             "new_balance": Decimal
         }
     """
-    user = User.query.get(user_id)
-    if not user:
+    # One conditional UPDATE: free-tier split, charge and usage counters are
+    # computed against the locked row, so concurrent transfers cannot lose updates
+    rows = _meter_runs([(user_id, (bool(is_private), bytes_transferred))])
+    if not rows:
         return {"success": False, "error": "User not found"}
-    
-    gb_transferred = Decimal(bytes_transferred) / Decimal(BYTES_PER_GB)
-    
-    # Calculate total bandwidth used this cycle
-    total_used = user.bandwidth_used_private_gb + user.bandwidth_used_public_gb
-    
-    # Calculate free bandwidth remaining
-    free_remaining = max(Decimal("0"), FREE_BANDWIDTH_GB_PER_MONTH - total_used)
-    
-    # Apply free bandwidth first
-    free_used = min(gb_transferred, free_remaining)
-    paid_used = gb_transferred - free_used
-    
-    # Calculate charge
-    if paid_used > 0:
-        if is_private:
-            charge = paid_used * PRICE_PER_GB_BANDWIDTH_PRIVATE
-        else:
-            charge = paid_used * PRICE_PER_GB_BANDWIDTH_PUBLIC
-        
-        # Deduct from balance
-        user.credit_balance_eur -= charge
-    else:
-        charge = Decimal("0")
-    
-    # Update usage tracking
-    if is_private:
-        user.bandwidth_used_private_gb += gb_transferred
-    else:
-        user.bandwidth_used_public_gb += gb_transferred
-    
     db.session.commit()
     
+    _, _, _, new_balance, charge, free_bytes, used_bytes = rows[0]
+    
     return {
         "success": True,
         "charged_amount": charge,
-        "free_bandwidth_used": free_used,
-        "paid_bandwidth_used": paid_used,
-        "new_balance": user.credit_balance_eur,
-        "total_bandwidth_used": total_used + gb_transferred
+        "free_bandwidth_used": bytes_to_gb(free_bytes),
+        "paid_bandwidth_used": bytes_to_gb(bytes_transferred - free_bytes),
+        "new_balance": new_balance,
+        "total_bandwidth_used": bytes_to_gb(used_bytes + bytes_transferred)
     }
 
 
@@ -114,14 +100,12 @@ def check_bandwidth_allowance(user_id, bytes_needed):
     if not user:
         return {"allowed": False, "reason": "User not found"}
     
-    gb_needed = Decimal(bytes_needed) / Decimal(BYTES_PER_GB)
-    
     # Calculate free bandwidth remaining
-    total_used = user.bandwidth_used_private_gb + user.bandwidth_used_public_gb
-    free_remaining = max(Decimal("0"), FREE_BANDWIDTH_GB_PER_MONTH - total_used)
+    used_bytes = int(((user.bandwidth_used_private_gb + user.bandwidth_used_public_gb) * BYTES_PER_GB).to_integral_value(ROUND_HALF_UP))
+    free_remaining = max(0, FREE_BANDWIDTH_BYTES_PER_MONTH - used_bytes)
     
     # If within free allowance, always allow
-    if gb_needed <= free_remaining:
+    if bytes_needed <= free_remaining:
         return {
             "allowed": True,
             "estimated_cost": Decimal("0"),
@@ -129,8 +113,7 @@ def check_bandwidth_allowance(user_id, bytes_needed):
         }
     
     # Calculate cost for paid bandwidth (assume worst case - public pricing)
-    paid_needed = gb_needed - free_remaining
-    estimated_cost = paid_needed * PRICE_PER_GB_BANDWIDTH_PUBLIC
+    estimated_cost = to_eur(gb_cost(bytes_needed - free_remaining, PRICE_NANOS_PER_GB_PUBLIC), places=CHARGE_PLACES)
     
     # Check if user has enough balance
     if user.credit_balance_eur < estimated_cost:
@@ -147,3 +130,151 @@ def check_bandwidth_allowance(user_id, bytes_needed):
         "estimated_cost": estimated_cost,
         "using_free_bandwidth": False
     }
+
+
+# One row per (user, run): free bandwidth is used first, the rest is charged
+# at the private or public rate, all against the row as it is before the update.
+# Sizes are integer bytes; the charge is paid bytes × nano-euros per GB, rounded to
+# whole nano-euros and then to CHARGE_PLACES, exactly like money.gb_cost + to_eur.
+# The *_gb usage counters stay in GB.
+# Charges are recorded in balance_ledger by the same statement.
+_METER_SQL = """
+    WITH runs(user_id, bytes, is_private) AS (VALUES {values}),
+    usage AS (
+        SELECT u.id AS user_id, runs.bytes, runs.is_private,
+               CAST(round((u.bandwidth_used_private_gb + u.bandwidth_used_public_gb) * :bytes_per_gb) AS bigint) AS used_bytes
+          FROM users u
+          JOIN runs ON runs.user_id = u.id
+         ORDER BY u.id               -- Same lock order in every worker: no deadlocks between flushes
+           FOR UPDATE OF u
+    ),
+    free AS (
+        SELECT usage.*, LEAST(bytes, GREATEST(0, :free_bytes - used_bytes)) AS free_bytes FROM usage
+    ),
+    charges AS (
+        SELECT free.*,
+               round(div(CAST(bytes - free_bytes AS numeric) * CASE WHEN is_private THEN :price_private ELSE :price_public END
+                         + :bytes_per_gb / 2, :bytes_per_gb) * 0.000000001, :places) AS charge
+          FROM free
+    ),
+    metered AS (
+        UPDATE users u
+           SET credit_balance_eur = u.credit_balance_eur - charges.charge,
+               bandwidth_used_private_gb = u.bandwidth_used_private_gb + CASE WHEN charges.is_private THEN CAST(charges.bytes AS numeric) / :bytes_per_gb ELSE 0 END,
+               bandwidth_used_public_gb = u.bandwidth_used_public_gb + CASE WHEN charges.is_private THEN 0 ELSE CAST(charges.bytes AS numeric) / :bytes_per_gb END
+          FROM charges
+         WHERE u.id = charges.user_id
+        RETURNING u.id, u.ipfs_access_hash, u.credit_balance_eur + charges.charge AS old_balance, u.credit_balance_eur AS new_balance,
+                  charges.charge, charges.free_bytes, charges.used_bytes, charges.is_private
+    ),
+    logged AS (
+        INSERT INTO balance_ledger (user_id, account, amount_eur, entry_type, reference, applied, created_at)
+        SELECT id, 'credit', -charge, 'bandwidth', CASE WHEN is_private THEN 'private' ELSE 'public' END, true, now() AT TIME ZONE 'utc'
+          FROM metered
+         WHERE charge <> 0
+    )
+    SELECT id, ipfs_access_hash, old_balance, new_balance, charge, free_bytes, used_bytes FROM metered
+"""
+
+
+def _meter_runs(batch):
+    """
+    Meter one run per user in a single statement.
+
+    Args:
+        batch: [(user_id, (is_private, bytes_transferred)), ...] with distinct user ids
+
+    Returns:
+        list: (user_id, ipfs_access_hash, old_balance, new_balance, charge, free_bytes_used, bytes_used_before)
+    """
+    values = []
+    params = {
+        "bytes_per_gb": BYTES_PER_GB,
+        "free_bytes": FREE_BANDWIDTH_BYTES_PER_MONTH,
+        "price_private": PRICE_NANOS_PER_GB_PRIVATE,
+        "price_public": PRICE_NANOS_PER_GB_PUBLIC,
+        "places": CHARGE_PLACES,
+    }
+    for i, (user_id, (is_private, bytes_transferred)) in enumerate(batch):
+        values.append(f"(CAST(:u{i} AS integer), CAST(:b{i} AS bigint), CAST(:p{i} AS boolean))")
+        params[f"u{i}"] = user_id
+        params[f"b{i}"] = bytes_transferred
+        params[f"p{i}"] = is_private
+
+    rows = db.session.execute(db.text(_METER_SQL.format(values=", ".join(values))), params).fetchall()
+    for _, ipfs_access_hash, old_balance, new_balance, *_ in rows:
+        if balance_crossed_zero(old_balance, new_balance):
+            invalidate_user_access(ipfs_access_hash)
+    return rows
+
+
+class BandwidthAccumulator:
+    """
+    Buffers transfers in memory and meters them in batched UPDATEs.
+
+    Per user, consecutive transfers of the same kind (private/public) are
+    merged into one run. Within a run the free allowance is used up first
+    exactly as track_bandwidth_usage would do it transfer by transfer, so
+    only a change of kind needs a new run. A flush sends run N of every
+    user in one statement, so write load follows active users, not requests.
+    """
+
+    def __init__(self):
+        self._runs = {}  # user_id -> [[is_private, bytes], ...] in arrival order
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(self, user_id, bytes_transferred, is_private):
+        """Queue one transfer for the next flush."""
+        if bytes_transferred <= 0:
+            return
+        is_private = bool(is_private)
+        with self._lock:
+            runs = self._runs.setdefault(user_id, [])
+            if runs and runs[-1][0] == is_private:
+                runs[-1][1] += bytes_transferred
+            else:
+                runs.append([is_private, bytes_transferred])
+
+    def pending_users(self):
+        return len(self._runs)
+
+    def _requeue(self, pending):
+        # Put unflushed runs back in front of anything recorded since
+        with self._lock:
+            for user_id, runs in pending.items():
+                newer = self._runs.get(user_id, [])
+                if newer and runs and newer[0][0] == runs[-1][0]:
+                    runs[-1][1] += newer.pop(0)[1]
+                self._runs[user_id] = runs + newer
+
+    def flush(self, commit=True):
+        """
+        Meter everything buffered so far.
+
+        Args:
+            commit: Commit the session (False lets the caller commit the
+                    metering together with its own writes)
+
+        Returns:
+            int: Users metered
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._runs = self._runs, {}
+            if not pending:
+                return 0
+
+            try:
+                depth = max(len(runs) for runs in pending.values())
+                for index in range(depth):
+                    batch = [(user_id, runs[index]) for user_id, runs in sorted(pending.items()) if len(runs) > index]
+                    for start in range(0, len(batch), BANDWIDTH_FLUSH_BATCH):
+                        _meter_runs(batch[start:start + BANDWIDTH_FLUSH_BATCH])
+                if commit:
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self._requeue(pending)
+                raise
+            return len(pending)
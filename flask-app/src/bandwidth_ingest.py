@@ -0,0 +1,242 @@
+"""
+Bandwidth Ingestion Module
+Tails the private gateway access log (nginx `ipfs_gateway` format) and meters downloads
+Rolls traffic up into bandwidth_usage and bills it through BandwidthAccumulator
+"""
+
+import os
+import json
+import time
+from datetime import datetime, timezone
+from sqlalchemy.dialects.postgresql import insert
+from .models import db, BandwidthUsage, LogIngestCheckpoint
+from .bandwidth import BandwidthAccumulator, BANDWIDTH_FLUSH_SECONDS
+
+BANDWIDTH_LOG_PATH = os.getenv("BANDWIDTH_LOG_PATH", "/var/log/nginx/ipfs_gateway.log")
+BANDWIDTH_WINDOW_SECONDS = int(os.getenv("BANDWIDTH_WINDOW_SECONDS", "300"))   # bandwidth_usage rollup granularity
+BANDWIDTH_INGEST_POLL_SECONDS = 1
+BANDWIDTH_INGEST_BATCH_LINES = 10000
+ROLLUP_INSERT_BATCH = 1000       # bandwidth_usage rows per INSERT ... ON CONFLICT
+LOG_ROTATION_GRACE_SECONDS = 5   # Keep reading a renamed log this long, until nginx reopens its logs
+METERED_STATUSES = {200, 206}
+
+
+class LogFollower:
+    """
+    Reads complete lines from a log file from a saved (inode, offset).
+
+    Follows rename-style rotation (logrotate + nginx USR1) and truncation
+    in place. A partially written last line is left for the next read, so
+    `offset` always sits on a line boundary.
+    """
+
+    def __init__(self, path, inode=None, offset=0):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+        self._file = None
+        self._idle_since = None
+        self._open(inode, offset)
+
+    def _open(self, inode, offset):
+        # The checkpointed file may have been rotated while we were stopped
+        for candidate in (self.path, f"{self.path}.1"):
+            try:
+                stat = os.stat(candidate)
+            except FileNotFoundError:
+                continue
+            if inode is not None and stat.st_ino != inode:
+                continue
+            if stat.st_size < offset:
+                print(f"{candidate} is shorter than the checkpoint, it was truncated: reading from the start")
+                offset = 0
+            self._file = open(candidate, "rb")
+            self._file.seek(offset)
+            self.inode, self.offset = stat.st_ino, offset
+            return
+
+        if inode is not None:
+            print(f"Checkpointed log (inode {inode}) is gone, continuing with the current {self.path}")
+            self._open(None, 0)
+
+    def _rotated(self):
+        """True once the path points at a new file and the old one has gone quiet."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if stat.st_ino == self.inode:
+            if stat.st_size < self.offset:
+                print(f"{self.path} was truncated, reading from the start")
+                self._file.seek(0)
+                self.offset = 0
+            return False
+
+        now = time.monotonic()
+        if self._idle_since is None:
+            self._idle_since = now
+        return now - self._idle_since >= LOG_ROTATION_GRACE_SECONDS
+
+    def read_lines(self, limit=BANDWIDTH_INGEST_BATCH_LINES):
+        """Return up to `limit` complete lines, advancing `offset` past them."""
+        lines = []
+        while len(lines) < limit:
+            if self._file is None:
+                self._open(None, 0)
+                if self._file is None:
+                    break
+
+            line = self._file.readline()
+            if line.endswith(b"\n"):
+                self.offset += len(line)
+                self._idle_since = None
+                lines.append(line)
+                continue
+
+            # End of the written data: rewind any partial line, then look for a rotation
+            self._file.seek(self.offset)
+            if not self._rotated():
+                break
+            print(f"{self.path} was rotated, switching to the new file")
+            self._file.close()
+            self._file = None
+            self._idle_since = None
+            self._open(None, 0)
+        return lines
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def parse_gateway_line(line):
+    """
+    Parse one `ipfs_gateway` log line.
+
+    Returns:
+        tuple: (window_start, user_id, cid, is_private, bytes_sent), or None
+        for lines that are not billable (denied, failed, empty or unknown user)
+    """
+    try:
+        entry = json.loads(line)
+        if entry.get("status") not in METERED_STATUSES:
+            return None
+        bytes_sent = int(entry.get("bytes_sent") or 0)
+        # user_id / is_private were resolved by the auth_request gate from access hash + CID
+        user_id = int(entry["user_id"]) if entry.get("user_id") else None
+        cid = entry.get("cid")
+        if bytes_sent <= 0 or user_id is None or not cid:
+            return None
+        logged_at = datetime.fromisoformat(entry["time"]).astimezone(timezone.utc)
+    except (ValueError, KeyError, TypeError):
+        print(f"Skipping unparseable gateway log line: {line[:200]!r}")
+        return None
+
+    epoch = int(logged_at.timestamp())
+    window_start = datetime.utcfromtimestamp(epoch - epoch % BANDWIDTH_WINDOW_SECONDS)
+    return window_start, user_id, cid, entry.get("is_private") == "true", bytes_sent
+
+
+class BandwidthIngestor:
+    """
+    One ingestion pass over a log file, resumable from its checkpoint.
+
+    Rollups, balance charges and the new checkpoint are committed in one
+    transaction, so a crash or restart never double counts or skips a line:
+    uncommitted work is simply re-read from the last checkpoint.
+    """
+
+    def __init__(self, path=BANDWIDTH_LOG_PATH):
+        self.path = path
+        checkpoint = LogIngestCheckpoint.query.get(path)
+        self._committed = (checkpoint.inode, checkpoint.byte_offset) if checkpoint else (None, 0)
+        self.follower = LogFollower(path, *self._committed)
+        self.accumulator = BandwidthAccumulator()
+        self.rollups = {}  # (user_id, window_start, cid, is_private) -> [requests, bytes]
+        self._last_commit = time.monotonic()
+
+    def poll(self):
+        """Read and aggregate what is new in the log, committing every BANDWIDTH_FLUSH_SECONDS."""
+        lines = self.follower.read_lines()
+        for line in lines:
+            parsed = parse_gateway_line(line)
+            if parsed is None:
+                continue
+            window_start, user_id, cid, is_private, bytes_sent = parsed
+            rollup = self.rollups.setdefault((user_id, window_start, cid, is_private), [0, 0])
+            rollup[0] += 1
+            rollup[1] += bytes_sent
+            self.accumulator.record(user_id, bytes_sent, is_private)
+
+        if time.monotonic() - self._last_commit >= BANDWIDTH_FLUSH_SECONDS:
+            self.commit()
+        return len(lines)
+
+    def commit(self):
+        """Write rollups, charges and the checkpoint atomically."""
+        position = (self.follower.inode, self.follower.offset)
+        self._last_commit = time.monotonic()
+        if position == self._committed:
+            return
+
+        # Serializes ingestors of the same file; a moved checkpoint means another one got there first
+        db.session.execute(
+            insert(LogIngestCheckpoint).values(source=self.path, inode=None, byte_offset=0)
+            .on_conflict_do_nothing(index_elements=['source'])
+        )
+        checkpoint = LogIngestCheckpoint.query.filter_by(source=self.path).with_for_update().populate_existing().one()
+        if (checkpoint.inode, checkpoint.byte_offset) != self._committed:
+            raise RuntimeError(f"Checkpoint for {self.path} moved underneath us, restarting from it")
+
+        rows = [
+            {"user_id": user_id, "window_start": window_start, "cid": cid, "is_private": is_private,
+             "requests": requests, "bytes_transferred": bytes_transferred}
+            for (user_id, window_start, cid, is_private), (requests, bytes_transferred) in self.rollups.items()
+        ]
+        for start in range(0, len(rows), ROLLUP_INSERT_BATCH):
+            statement = insert(BandwidthUsage).values(rows[start:start + ROLLUP_INSERT_BATCH])
+            db.session.execute(statement.on_conflict_do_update(
+                constraint='uq_bandwidth_usage_window',
+                set_={
+                    "requests": BandwidthUsage.requests + statement.excluded.requests,
+                    "bytes_transferred": BandwidthUsage.bytes_transferred + statement.excluded.bytes_transferred,
+                }
+            ))
+        users = self.accumulator.flush(commit=False)
+
+        checkpoint.inode, checkpoint.byte_offset = position
+        checkpoint.updated_at = datetime.utcnow()
+        db.session.commit()
+
+        print(f"Ingested {self.path} up to offset {position[1]}: "
+              f"{len(self.rollups)} rollups, {users} users charged")
+        self._committed = position
+        self.rollups = {}
+
+
+def run_bandwidth_ingest(path=BANDWIDTH_LOG_PATH):
+    """Main loop: follow the log forever, restarting from the checkpoint after any error."""
+    from .app import create_app
+
+    app = create_app()
+    with app.app_context():
+        print(f"Bandwidth ingestion started for {path}")
+        ingestor = None
+        while True:
+            try:
+                if ingestor is None:
+                    ingestor = BandwidthIngestor(path)
+                if ingestor.poll() == 0:
+                    time.sleep(BANDWIDTH_INGEST_POLL_SECONDS)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Bandwidth ingestion error, resuming from the last checkpoint: {e}")
+                if ingestor is not None:
+                    ingestor.follower.close()
+                ingestor = None
+                time.sleep(BANDWIDTH_INGEST_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    run_bandwidth_ingest()
@@ -0,0 +1,230 @@
+"""
+Capability Token Module
+Short-lived HMAC-signed tokens granting download access to one CID
+Lets the gateway gate authorize requests without a Postgres round trip
+"""
+
+import os
+import json
+import time
+import hmac
+import base64
+import hashlib
+import logging
+import threading
+import psycopg2
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from .models import db, TokenRevocation
+
+# Dedicated signing secret (not SECRET_KEY, which falls back to a public default). Tokens are
+# neither minted nor accepted until a real one is configured
+CAPABILITY_TOKEN_SECRET = os.getenv("CAPABILITY_TOKEN_SECRET", "")
+CAPABILITY_TOKEN_MIN_SECRET_LENGTH = 32
+CAPABILITY_TOKEN_TTL = int(os.getenv("IPFS_TOKEN_TTL", "300"))                # seconds, default lifetime
+CAPABILITY_TOKEN_MAX_TTL = int(os.getenv("IPFS_TOKEN_MAX_TTL", "3600"))       # seconds, longest a caller may ask for
+REVOCATION_REFRESH_SECONDS = float(os.getenv("IPFS_TOKEN_REVOCATION_REFRESH", "5"))
+REVOCATION_MAX_STALENESS = REVOCATION_REFRESH_SECONDS * 6  # Older denylist -> tokens are refused
+
+# (access hash fingerprint, cid or None for user-wide) -> epoch seconds of the latest revocation
+_revoked = {}
+_revoked_lock = threading.Lock()
+_last_refresh = None
+_first_refresh = threading.Event()
+_refresher_lock = threading.Lock()
+_refresher_pid = None
+
+
+class CapabilityTokensDisabled(Exception):
+    """CAPABILITY_TOKEN_SECRET is missing or too short to sign with."""
+
+
+def access_hash_fingerprint(ipfs_access_hash):
+    """Stable, non-reversible id for an access hash (tokens are readable by whoever holds them)."""
+    return hashlib.sha256(ipfs_access_hash.encode("utf-8")).hexdigest()[:32]
+
+
+def capability_tokens_enabled():
+    return len(CAPABILITY_TOKEN_SECRET) >= CAPABILITY_TOKEN_MIN_SECRET_LENGTH
+
+
+def _signing_key():
+    if not capability_tokens_enabled():
+        raise CapabilityTokensDisabled(
+            f"Set CAPABILITY_TOKEN_SECRET (at least {CAPABILITY_TOKEN_MIN_SECRET_LENGTH} characters) to use capability tokens"
+        )
+    return hashlib.sha256(b"ipfs-capability-token:" + CAPABILITY_TOKEN_SECRET.encode("utf-8")).digest()
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def mint_capability_token(ipfs_access_hash, cid, validation, ttl=None):
+    """
+    Sign a token granting access to `cid` until it expires.
+
+    Args:
+        ipfs_access_hash: Access hash the grant was validated for
+        cid: Content identifier
+        validation: Valid verdict from validate_ipfs_access for (ipfs_access_hash, cid)
+        ttl: Lifetime in seconds (CAPABILITY_TOKEN_TTL if None, capped at CAPABILITY_TOKEN_MAX_TTL)
+
+    Returns:
+        tuple: (token, expires_at as epoch seconds)
+
+    Raises:
+        CapabilityTokensDisabled: No signing secret is configured
+    """
+    ttl = min(ttl or CAPABILITY_TOKEN_TTL, CAPABILITY_TOKEN_MAX_TTL)
+    now = time.time()
+    expires_at = int(now) + ttl
+    claims = {
+        "h": access_hash_fingerprint(ipfs_access_hash),
+        "c": cid,
+        "u": validation["user_id"],
+        "p": bool(validation["is_private"]),
+        "s": validation["file_size_bytes"],
+        "i": int(now * 1000),   # issued at, ms: revocations apply to tokens issued before them
+        "e": expires_at,
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    signature = _b64encode(hmac.new(_signing_key(), payload.encode("ascii"), hashlib.sha256).digest())
+    return f"{payload}.{signature}", expires_at
+
+
+def _decode(token):
+    """Claims of a correctly signed token, or None."""
+    if not isinstance(token, str):
+        return None
+    payload, _, signature = token.partition(".")
+    if not payload or not signature:
+        return None
+    expected = hmac.new(_signing_key(), payload.encode("ascii", "replace"), hashlib.sha256).digest()
+    try:
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            return None
+        return json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+
+
+def verify_capability_token(token, cid):
+    """
+    Check a capability token for `cid` using only the signature, the expiry
+    and the in-memory revocation denylist. No database access.
+
+    Args:
+        token: Token from mint_capability_token
+        cid: Content identifier being requested
+
+    Returns:
+        dict: Same shape as validate_ipfs_access, plus "expires_at" when valid
+    """
+    if not capability_tokens_enabled():
+        return {"valid": False, "reason": "Capability tokens are not enabled, use the access hash"}
+    if not isinstance(cid, str):
+        return {"valid": False, "reason": "Token does not grant access to this CID"}
+    _ensure_revocation_refresher()
+
+    claims = _decode(token)
+    if claims is None:
+        return {"valid": False, "reason": "Invalid capability token"}
+    if claims.get("c") != cid:
+        return {"valid": False, "reason": "Token does not grant access to this CID"}
+    if claims["e"] <= time.time():
+        return {"valid": False, "reason": "Capability token expired"}
+    # Fail closed: a stale denylist could be missing a revocation
+    if _last_refresh is None:
+        _first_refresh.wait(REVOCATION_REFRESH_SECONDS)
+    if _last_refresh is None or time.monotonic() - _last_refresh > REVOCATION_MAX_STALENESS:
+        return {"valid": False, "reason": "Token revocation list unavailable, use the access hash"}
+    if _is_revoked(claims):
+        return {"valid": False, "reason": "Capability token revoked"}
+
+    return {
+        "valid": True,
+        "user_id": claims["u"],
+        "is_private": claims["p"],
+        "file_size_bytes": claims["s"],
+        "expires_at": claims["e"]
+    }
+
+
+def _is_revoked(claims):
+    issued_at = claims["i"] / 1000
+    for key in ((claims["h"], None), (claims["h"], claims["c"])):
+        revoked_at = _revoked.get(key)
+        if revoked_at is not None and revoked_at >= issued_at:
+            return True
+    return False
+
+
+def revoke_capability_tokens(ipfs_access_hash, cid=None):
+    """
+    Revoke every token issued so far for one pin (or, without `cid`, for the user).
+    The row is added to the caller's session and reaches other workers on the next refresh.
+    """
+    now = datetime.utcnow()
+    fingerprint = access_hash_fingerprint(ipfs_access_hash)
+    db.session.add(TokenRevocation(access_hash_fingerprint=fingerprint, cid=cid, revoked_at=now))
+    with _revoked_lock:
+        _revoked[(fingerprint, cid)] = now.replace(tzinfo=timezone.utc).timestamp()
+
+
+def prune_token_revocations():
+    """Delete revocations older than any token still alive."""
+    cutoff = datetime.utcnow() - timedelta(seconds=CAPABILITY_TOKEN_MAX_TTL)
+    deleted = TokenRevocation.query.filter(TokenRevocation.revoked_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Pruned {deleted} expired token revocations.")
+    return deleted
+
+
+def _refresh_revocations(dsn):
+    """Background thread: reload the denylist every REVOCATION_REFRESH_SECONDS."""
+    global _revoked, _last_refresh
+    conn = None
+    while True:
+        try:
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT access_hash_fingerprint, cid, extract(epoch FROM max(revoked_at))
+                      FROM token_revocations
+                     WHERE revoked_at > (now() AT TIME ZONE 'utc') - make_interval(secs => %s)
+                     GROUP BY access_hash_fingerprint, cid
+                """, (CAPABILITY_TOKEN_MAX_TTL,))
+                revoked = {(fingerprint, cid): float(revoked_at) for fingerprint, cid, revoked_at in cursor}
+            with _revoked_lock:
+                _revoked = revoked
+            _last_refresh = time.monotonic()
+            _first_refresh.set()
+        except Exception as e:
+            logging.error(f"Capability token revocation refresh failed: {e}")
+            if conn is not None:
+                conn.close()
+            conn = None
+        time.sleep(REVOCATION_REFRESH_SECONDS)
+
+
+def _ensure_revocation_refresher():
+    # One refresher per process; a forked child must not trust its parent's denylist
+    global _refresher_pid, _last_refresh
+    if _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _last_refresh = None
+        _first_refresh.clear()
+        dsn = current_app.config['SQLALCHEMY_DATABASE_URI']
+        threading.Thread(target=_refresh_revocations, args=(dsn,), daemon=True,
+                         name="capability-token-revocations").start()
+        _refresher_pid = os.getpid()
@@ -1,28 +1,96 @@
+import os
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from .app import create_app
-from .models import db, User, Pin, ClusterBackup
+from .models import db, User, Pin, ClusterBackup, ReplicaHistory, ClusterPinOutcome
+from .ipfs_client import get_cluster_client, IPFSClientError
+from .ipfs_access_control import invalidate_pin_access, invalidate_user_access
+from .balances import post_ledger_entry
 from datetime import datetime, timedelta
-import subprocess
+
+CLEANUP_CHUNK_SIZE = int(os.getenv("CLEANUP_CHUNK_SIZE", "500"))              # Rows locked and committed together
+CLEANUP_CLUSTER_THREADS = int(os.getenv("CLEANUP_CLUSTER_THREADS", "16"))     # Concurrent cluster pin/unpin calls
+CLUSTER_PIN_OUTCOME_RETENTION = timedelta(days=30)
 
 def unpin_cid(cid):
-    """Executes the ipfs-cluster-ctl pin rm command."""
+    """Unpins a CID from the cluster through the REST API."""
     try:
-        subprocess.run(["ipfs-cluster-ctl", "pin", "rm", cid], check=True, capture_output=True, text=True)
+        get_cluster_client().pin_rm(cid)
         print(f"Successfully unpinned CID: {cid}")
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        print(f"Error unpinning CID {cid}: {e.stderr if hasattr(e, 'stderr') else e}")
+    except IPFSClientError as e:
+        print(f"Error unpinning CID {cid}: {e}")
         return False
 
 def repin_cid(cid):
-    """Executes the ipfs-cluster-ctl pin add command."""
+    """Re-pins a CID in the cluster through the REST API."""
     try:
-        subprocess.run(["ipfs-cluster-ctl", "pin", "add", cid], check=True, capture_output=True, text=True)
+        get_cluster_client().pin_add(cid)
         print(f"Successfully re-pinned CID: {cid}")
         return True
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        print(f"Error re-pinning CID {cid}: {e.stderr if hasattr(e, 'stderr') else e}")
+    except IPFSClientError as e:
+        print(f"Error re-pinning CID {cid}: {e}")
         return False
 
+def _cluster_call(action, row):
+    """
+    Run one cluster call for a row: a client method name ("pin_rm", "pin_add")
+    called with the row's CID, or a function of (client, row).
+    Returns None, or the error message.
+    """
+    try:
+        client = get_cluster_client()
+        if callable(action):
+            action(client, row)
+        else:
+            getattr(client, action)(row.cid)
+        return None
+    except IPFSClientError as e:
+        return str(e)
+
+def _locked_chunks(query, model):
+    """
+    Yield the rows of `query` CLEANUP_CHUNK_SIZE at a time, in id order.
+
+    Each chunk is row-locked (SKIP LOCKED, so a concurrent run takes other rows)
+    until the caller commits it. Rows the caller leaves matching the query are
+    not revisited in this run.
+    """
+    last_id = 0
+    while True:
+        chunk = query.filter(model.id > last_id).order_by(model.id) \
+            .limit(CLEANUP_CHUNK_SIZE).with_for_update(skip_locked=True, of=model).all()
+        if not chunk:
+            return
+        last_id = chunk[-1].id  # Read now: the rows may be deleted before we resume
+        yield chunk
+
+def cluster_fan_out(executor, job, action, rows):
+    """
+    Run `action` (see _cluster_call) for every row on the pool and record
+    each outcome (added to the session, committed with the chunk).
+
+    Returns:
+        list: The rows whose call succeeded
+    """
+    errors = list(executor.map(partial(_cluster_call, action), rows))
+    db.session.bulk_insert_mappings(ClusterPinOutcome, [
+        {"job": job, "cid": row.cid, "user_id": row.user_id, "succeeded": error is None, "error": error}
+        for row, error in zip(rows, errors)
+    ])
+    for row, error in zip(rows, errors):
+        if error is not None:
+            print(f"{job}: {getattr(action, '__name__', action)} {row.cid} failed: {error}")
+    return [row for row, error in zip(rows, errors) if error is None]
+
+def prune_cluster_pin_outcomes():
+    """Delete cleanup outcomes older than CLUSTER_PIN_OUTCOME_RETENTION."""
+    cutoff = datetime.utcnow() - CLUSTER_PIN_OUTCOME_RETENTION
+    deleted = ClusterPinOutcome.query.filter(ClusterPinOutcome.created_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    print(f"Pruned {deleted} cluster pin outcomes.")
+    return deleted
+
 def manage_pin_expiration():
     """
     Manages automatic unpinning of pins that reached their retention period (expire_at).
@@ -31,21 +99,155 @@ def manage_pin_expiration():
     """
     print("Starting pin expiration management...")
     
-    # Find all pins where expire_at has passed
+    # Find all pins where expire_at has passed, and unpin them chunk by chunk
     now = datetime.utcnow()
-    expired_pins = Pin.query.filter(Pin.status == 'pinned', Pin.expire_at <= now).all()
-    
-    for pin in expired_pins:
-        print(f"Pin {pin.cid} retention period expired (expire_at: {pin.expire_at}). Unpinning and deleting.")
-        if unpin_cid(pin.cid):
-            db.session.delete(pin)
-        else:
-            print(f"Failed to unpin {pin.cid}, but will delete record anyway.")
-            db.session.delete(pin)
-    
-    db.session.commit()
+    expired = Pin.query.filter(Pin.status == 'pinned', Pin.expire_at <= now)
+    deleted = failed = 0
+
+    with ThreadPoolExecutor(max_workers=CLEANUP_CLUSTER_THREADS) as executor:
+        for chunk in _locked_chunks(expired, Pin):
+            for pin in chunk:
+                invalidate_pin_access(pin.ipfs_access_hash, pin.cid)
+            unpinned = cluster_fan_out(executor, "pin_expiration", "pin_rm", chunk)
+            # Records are deleted even if the unpin failed; the failure stays in cluster_pin_outcomes
+            Pin.query.filter(Pin.id.in_([pin.id for pin in chunk])).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(chunk)
+            failed += len(chunk) - len(unpinned)
+            print(f"Expired {len(chunk)} pins ({len(chunk) - len(unpinned)} unpins failed).")
+
+    print(f"Deleted {deleted} expired pins, {failed} could not be unpinned.")
     print("Pin expiration management finished.")
+    return deleted
+
+
+def _chunks(items):
+    """Split a list into CLEANUP_CHUNK_SIZE slices."""
+    for start in range(0, len(items), CLEANUP_CHUNK_SIZE):
+        yield items[start:start + CLEANUP_CHUNK_SIZE]
+
+def _invalidate_users(rows):
+    # One cache drop and token revocation per user, not one per pin
+    for ipfs_access_hash in {row.ipfs_access_hash for row in rows}:
+        invalidate_user_access(ipfs_access_hash)
+
+def start_pin_grace_periods(executor):
+    """
+    Move every pinned pin of a user with no credit to 'grace_period' in one
+    statement, then unpin the returned CIDs chunk by chunk. A pin whose unpin
+    fails goes back to 'pinned' and is retried on the next run.
+
+    Returns:
+        int: Pins now in their grace period
+    """
+    moved = db.session.execute(db.text("""
+        UPDATE pins
+           SET status = 'grace_period', grace_period_started_at = now() AT TIME ZONE 'utc'
+          FROM users
+         WHERE pins.user_id = users.id AND users.credit_balance_eur <= 0 AND pins.status = 'pinned'
+        RETURNING pins.id, pins.cid, pins.user_id, pins.ipfs_access_hash
+    """)).fetchall()
+    _invalidate_users(moved)
+    db.session.commit()  # Access is cut now, whatever the cluster says
 
+    failed = 0
+    for chunk in _chunks(moved):
+        unpinned = {row.id for row in cluster_fan_out(executor, "grace_unpin", "pin_rm", chunk)}
+        retry = [row.id for row in chunk if row.id not in unpinned]
+        if retry:
+            db.session.execute(db.text("""
+                UPDATE pins SET status = 'pinned', grace_period_started_at = NULL
+                 WHERE id = ANY(:ids) AND status = 'grace_period'
+            """), {"ids": retry})
+            _invalidate_users([row for row in chunk if row.id not in unpinned])
+        db.session.commit()
+        failed += len(retry)
+    print(f"Moved {len(moved) - failed} pins of users without credit to their grace period ({failed} unpins failed).")
+    return len(moved) - failed
+
+def end_pin_grace_periods(executor):
+    """
+    Re-pin (for free, already paid) the grace-period pins of users who have
+    added credit, found with one join on the balance. Each chunk of
+    successful re-pins is marked 'pinned' in one statement.
+
+    Returns:
+        int: Pins re-pinned
+    """
+    recovered = db.session.execute(db.text("""
+        SELECT pins.id, pins.cid, pins.user_id, pins.ipfs_access_hash
+          FROM pins JOIN users ON users.id = pins.user_id
+         WHERE pins.status = 'grace_period' AND users.credit_balance_eur > 0
+    """)).fetchall()
+    db.session.commit()
+
+    repinned = 0
+    for chunk in _chunks(recovered):
+        done = cluster_fan_out(executor, "grace_repin", "pin_add", chunk)
+        # NOTE: already_charged remains True, no additional charge for re-pinning
+        db.session.execute(db.text("""
+            UPDATE pins SET status = 'pinned', grace_period_started_at = NULL
+             WHERE id = ANY(:ids) AND status = 'grace_period'
+        """), {"ids": [row.id for row in done]})
+        _invalidate_users(done)
+        db.session.commit()
+        repinned += len(done)
+    print(f"Re-pinned {repinned} of {len(recovered)} grace-period pins of users who added credit (FREE).")
+    return repinned
+
+def delete_expired_grace_users(executor, grace_period=timedelta(days=7)):
+    """
+    Delete users still without credit whose pins have been in their grace
+    period longer than `grace_period`, with all their data, CLEANUP_CHUNK_SIZE
+    users per transaction. Every pin and backup of the user is unpinned first,
+    grace-period pins included: their status is committed before the grace
+    unpin runs, so a crash in between leaves them pinned in the cluster
+    (unpinning an unpinned CID is harmless). Payments are kept, detached from
+    the user, for the accounts.
+
+    Returns:
+        int: Users deleted
+    """
+    limit = datetime.utcnow() - grace_period
+    deleted = last_id = 0
+    while True:
+        users = db.session.execute(db.text("""
+            SELECT id, ipfs_access_hash FROM users
+             WHERE id > :last_id AND credit_balance_eur <= 0
+               AND EXISTS (SELECT 1 FROM pins
+                            WHERE pins.user_id = users.id AND pins.status = 'grace_period'
+                              AND pins.grace_period_started_at <= :limit)
+             ORDER BY id
+             LIMIT :chunk
+               FOR UPDATE SKIP LOCKED
+        """), {"last_id": last_id, "limit": limit, "chunk": CLEANUP_CHUNK_SIZE}).fetchall()
+        if not users:
+            return deleted
+        last_id = users[-1].id
+        ids = [user.id for user in users]
+
+        still_pinned = db.session.execute(db.text("""
+            SELECT cid, user_id FROM pins WHERE user_id = ANY(:ids)
+            UNION ALL
+            SELECT cid, user_id FROM cluster_backups WHERE user_id = ANY(:ids)
+        """), {"ids": ids}).fetchall()
+        for chunk in _chunks(still_pinned):
+            cluster_fan_out(executor, "account_deletion", "pin_rm", chunk)
+
+        _invalidate_users(users)
+        for statement in (
+            "DELETE FROM replica_history WHERE backup_id IN (SELECT id FROM cluster_backups WHERE user_id = ANY(:ids))",
+            "DELETE FROM cluster_backups WHERE user_id = ANY(:ids)",
+            "DELETE FROM pins WHERE user_id = ANY(:ids)",                # pin_jobs cascade
+            "DELETE FROM invoices WHERE user_id = ANY(:ids)",
+            "DELETE FROM payment_addresses WHERE user_id = ANY(:ids)",
+            "UPDATE payments SET user_id = NULL WHERE user_id = ANY(:ids)",
+            "DELETE FROM users WHERE id = ANY(:ids)",
+        ):
+            db.session.execute(db.text(statement), {"ids": ids})
+        db.session.commit()
+        deleted += len(ids)
+        print(f"Deleted {len(ids)} users and all their data (7 days grace period expired): {ids}")
 
 def manage_pin_grace_periods():
     """
@@ -53,58 +255,15 @@ def manage_pin_grace_periods():
     - Initiates grace period if user balance is <= 0.
     - Re-pins content if user adds credit during grace period (FREE).
     - Deletes user + all data after 7 days grace period.
+    Each step is set-based SQL; cluster calls are driven from the returned CIDs.
     """
     print("Starting pin grace period management...")
-    
-    # 1. Handle users with depleted credit
-    users_with_no_credit = User.query.filter(User.credit_balance_eur <= 0).all()
-    for user in users_with_no_credit:
-        active_pins = Pin.query.filter_by(user_id=user.id, status='pinned').all()
-        for pin in active_pins:
-            print(f"User {user.id} has no credit. Moving pin {pin.cid} to grace period.")
-            if unpin_cid(pin.cid):
-                pin.status = 'grace_period'
-                pin.grace_period_started_at = datetime.utcnow()
-                db.session.add(pin)
-
-    # 2. Handle users in grace period who have re-added credit (FREE re-pinning)
-    pins_in_grace_period = Pin.query.filter_by(status='grace_period').all()
-    for pin in pins_in_grace_period:
-        if pin.user.credit_balance_eur > 0:
-            print(f"User {pin.user.id} has added credit. Re-pinning {pin.cid} (FREE - already paid).")
-            if repin_cid(pin.cid):
-                pin.status = 'pinned'
-                pin.grace_period_started_at = None # Clear the grace period start time
-                # NOTE: already_charged remains True, no additional charge for re-pinning
-                db.session.add(pin)
-
-    # 3. Handle expired grace periods (7 days) - DELETE USER + ALL DATA
-    grace_period_limit = datetime.utcnow() - timedelta(days=7)
-    expired_pins = Pin.query.filter(Pin.status == 'grace_period', Pin.grace_period_started_at <= grace_period_limit).all()
-    
-    # Track users to delete (users with expired grace periods)
-    users_to_delete = set()
-    for pin in expired_pins:
-        print(f"Grace period for pin {pin.cid} has expired. Will delete user {pin.user_id} and all data.")
-        users_to_delete.add(pin.user_id)
-        # The content is already unpinned, so we just delete the database record.
-        db.session.delete(pin)
-    
-    # Delete entire user accounts after 7 days grace period
-    for user_id in users_to_delete:
-        user = User.query.get(user_id)
-        if user:
-            print(f"Deleting user {user_id} and all associated data (7 days grace period expired).")
-            # Delete all user's pins (cascade should handle this, but explicit is safer)
-            Pin.query.filter_by(user_id=user_id).delete()
-            # Delete user invoices
-            from .models import Invoice
-            Invoice.query.filter_by(user_id=user_id).delete()
-            # Delete user account
-            db.session.delete(user)
-        
-    db.session.commit()
+    with ThreadPoolExecutor(max_workers=CLEANUP_CLUSTER_THREADS) as executor:
+        changed = start_pin_grace_periods(executor)
+        changed += end_pin_grace_periods(executor)
+        changed += delete_expired_grace_users(executor)
     print("Pin grace period management finished.")
+    return changed
 
 # NOTE: charge_monthly_pin_storage() REMOVED
 # IPFS Kubo uses PREPAID model - charges upfront when file is pinned
@@ -143,7 +302,7 @@ def charge_monthly_backup_storage():
         
         print(f"Billing User {user.id} for {total_size_gb:.4f} GB of backup storage. Cost: €{monthly_cost:.4f}")
         
-        user.credit_balance_eur -= monthly_cost
+        post_ledger_entry(user.id, "credit", -monthly_cost, "backup_billing", reference=f"{datetime.utcnow():%Y-%m-%d}")
         user.last_backup_billing_date = datetime.utcnow()
         db.session.add(user)
 
@@ -176,6 +335,7 @@ def reset_monthly_bandwidth():
     
     db.session.commit()
     print(f"Monthly bandwidth reset finished. Reset {len(users_to_reset)} users.")
+    return len(users_to_reset)
 
 
 def manage_cluster_backup_expiration():
@@ -184,40 +344,43 @@ def manage_cluster_backup_expiration():
     PREPAID model - no billing, just delete expired backups.
     """
     print("Starting cluster backup expiration management...")
-    from .models import ClusterBackup
-    
-    # Find all backups where expire_at has passed
+    # Find all backups where expire_at has passed, and unpin them chunk by chunk
     now = datetime.utcnow()
-    expired_backups = ClusterBackup.query.filter(
+    expired = ClusterBackup.query.filter(
         ClusterBackup.status == 'active',
         ClusterBackup.expire_at <= now
-    ).all()
-    
-    for backup in expired_backups:
-        print(f"Cluster backup {backup.id} ({backup.file_name}) retention period expired. Deleting.")
-        try:
-            # Unpin from IPFS cluster
-            ipfs_unpin_cmd = ["ipfs-cluster-ctl", "pin", "rm", backup.cid]
-            subprocess.run(ipfs_unpin_cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to unpin {backup.cid}, but will delete record anyway: {e}")
-        
-        # Delete from database
-        db.session.delete(backup)
-    
-    db.session.commit()
-    print(f"Cluster backup expiration management finished. Deleted {len(expired_backups)} backups.")
+    )
+    deleted = failed = 0
+
+    with ThreadPoolExecutor(max_workers=CLEANUP_CLUSTER_THREADS) as executor:
+        for chunk in _locked_chunks(expired, ClusterBackup):
+            unpinned = cluster_fan_out(executor, "backup_expiration", "pin_rm", chunk)
+            # Records are deleted even if the unpin failed; the failure stays in cluster_pin_outcomes
+            ids = [backup.id for backup in chunk]
+            ReplicaHistory.query.filter(ReplicaHistory.backup_id.in_(ids)).delete(synchronize_session=False)
+            ClusterBackup.query.filter(ClusterBackup.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(chunk)
+            failed += len(chunk) - len(unpinned)
+            print(f"Expired {len(chunk)} cluster backups ({len(chunk) - len(unpinned)} unpins failed).")
+
+    print(f"Cluster backup expiration management finished. Deleted {deleted} backups, {failed} could not be unpinned.")
+    return deleted
 
 
 def run_cleanup():
-    """Main function to run all cleanup tasks."""
+    """
+    Main function to run all cleanup tasks once (cron).
+    Each task takes its scheduler lock, so a task already running on another
+    host is skipped instead of run twice. Prefer the scheduler daemon
+    (python -m src.scheduler), which runs them on their own intervals.
+    """
+    from .scheduler import CLEANUP_TASKS, run_task
+
     app = create_app()
     with app.app_context():
-        manage_pin_expiration()              # Unpin IPFS Kubo files after retention period
-        manage_cluster_backup_expiration()   # Delete IPFS Cluster backups after retention period (PREPAID)
-        manage_pin_grace_periods()           # Handle grace period when balance=0 (7 days, then delete user)
-        reset_monthly_bandwidth()            # Reset bandwidth counters monthly (1 GB free per month)
-        charge_monthly_backup_storage()      # Monthly billing for backup service (legacy)
+        for name in CLEANUP_TASKS:
+            run_task(name, force=True)
         # Note: NO monthly billing for IPFS Kubo or IPFS Cluster - both are PREPAID
 
 if __name__ == "__main__":
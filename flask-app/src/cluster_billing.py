@@ -4,141 +4,331 @@ Daily cost calculation with replica tracking
 NO managed fee - only storage × replicas × days
 """
 
+import os
+import time
+import multiprocessing
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
 from datetime import datetime, timedelta
-from .models import db, User, ClusterBackup, ReplicaHistory
+from flask import current_app
+from .models import db, ClusterBackup, ReplicaHistory, BillingRun, BillingRunShard
+from .balances import post_ledger_entry, compact_ledger
+from .money import to_nanos, to_eur, micros, storage_cost, bytes_to_gb
 
 # Pricing constants
 DAILY_RATE_PER_GB = Decimal("0.0005125")  # €0.0005125/GB/day
 AVERAGE_DAYS_PER_MONTH = Decimal("30.4375")  # Average days in a month
+DAILY_RATE_NANOS_PER_GB = to_nanos(DAILY_RATE_PER_GB)
 
+# Billing run
+BILLING_WORKERS = int(os.getenv("BILLING_WORKERS", "4"))            # Processes billing shards in parallel
+BILLING_SHARD_USERS = int(os.getenv("BILLING_SHARD_USERS", "1000"))  # User ids per shard
 
-def calculate_backup_cost(backup, from_date, to_date):
+
+def billing_period_start(backup):
+    """A backup is billed from its last billing run, or from creation if never billed."""
+    return backup.last_billed_at or backup.created_at
+
+
+def load_replica_history(backup_ids, until):
     """
-    Calculate cost for a backup between two dates, accounting for replica changes.
+    Load the replica changes of many backups in one ordered query.
     
     Args:
-        backup: ClusterBackup object
+        backup_ids: ClusterBackup IDs
+        until: Latest change time of interest
+    
+    Returns:
+        dict: backup_id -> [(changed_at, replica_count), ...] oldest first
+    """
+    history = {backup_id: [] for backup_id in backup_ids}
+    if not history:
+        return history
+    
+    rows = db.session.query(
+        ReplicaHistory.backup_id, ReplicaHistory.changed_at, ReplicaHistory.replica_count
+    ).filter(
+        ReplicaHistory.backup_id.in_(list(history)),
+        ReplicaHistory.changed_at <= until
+    ).order_by(
+        ReplicaHistory.backup_id, ReplicaHistory.changed_at, ReplicaHistory.id
+    ).all()
+    
+    for backup_id, changed_at, replica_count in rows:
+        history[backup_id].append((changed_at, replica_count))
+    return history
+
+
+def piecewise_backup_cost(size_bytes, replica_count, history, from_date, to_date):
+    """
+    Cost of one backup between two dates from its preloaded replica history.
+    
+    Storage is charged piecewise: size × replicas × time for each stretch
+    between replica changes. The stretches are summed exactly in integer
+    replica-microseconds and the total is rounded once.
+    
+    Args:
+        size_bytes: Backup size
+        replica_count: Current replica count
+        history: [(changed_at, replica_count), ...] oldest first (see load_replica_history)
         from_date: Start date for billing period
         to_date: End date for billing period
     
     Returns:
-        Decimal: Total cost for the period
+        int: Total cost for the period in nano-euros
     """
-    total_cost = Decimal("0")
-    size_gb = Decimal(backup.size_bytes) / Decimal(1024 * 1024 * 1024)
-    
-    # Get all replica changes in this period
-    replica_changes = ReplicaHistory.query.filter(
-        ReplicaHistory.backup_id == backup.id,
-        ReplicaHistory.changed_at >= from_date,
-        ReplicaHistory.changed_at <= to_date
-    ).order_by(ReplicaHistory.changed_at).all()
+    # Replica changes in this period
+    change_times = [changed_at for changed_at, _ in history]
+    first = bisect_left(change_times, from_date)
+    replica_changes = history[first:bisect_right(change_times, to_date)]
     
     # If no replica changes, use current replica count for entire period
     if not replica_changes:
-        days = (to_date - from_date).total_seconds() / 86400
-        total_cost = size_gb * Decimal(backup.replica_count) * DAILY_RATE_PER_GB * Decimal(days)
-        return total_cost
+        return storage_cost(size_bytes * replica_count * micros(to_date - from_date), DAILY_RATE_NANOS_PER_GB)
     
-    # Calculate cost for each period between replica changes
+    # Replica-microseconds for each period between replica changes
+    replica_micros = 0
     current_date = from_date
-    current_replicas = backup.replica_count
+    current_replicas = replica_count
     
     # Start with the replica count before any changes
-    first_change = replica_changes[0]
-    if first_change.changed_at > from_date:
-        # Find what the replica count was before first change
-        prev_history = ReplicaHistory.query.filter(
-            ReplicaHistory.backup_id == backup.id,
-            ReplicaHistory.changed_at < from_date
-        ).order_by(ReplicaHistory.changed_at.desc()).first()
-        
-        if prev_history:
-            current_replicas = prev_history.replica_count
+    if replica_changes[0][0] > from_date:
+        if first > 0:
+            current_replicas = history[first - 1][1]  # Last change before the period
         else:
             current_replicas = 1  # Default starting replica count
     
-    for change in replica_changes:
-        # Calculate cost from current_date to change date
-        days = (change.changed_at - current_date).total_seconds() / 86400
-        period_cost = size_gb * Decimal(current_replicas) * DAILY_RATE_PER_GB * Decimal(days)
-        total_cost += period_cost
+    for changed_at, new_replica_count in replica_changes:
+        # Stretch from current_date to change date
+        replica_micros += current_replicas * micros(changed_at - current_date)
         
         # Update for next period
-        current_date = change.changed_at
-        current_replicas = change.replica_count
+        current_date = changed_at
+        current_replicas = new_replica_count
     
-    # Calculate cost from last change to end date
-    days = (to_date - current_date).total_seconds() / 86400
-    period_cost = size_gb * Decimal(current_replicas) * DAILY_RATE_PER_GB * Decimal(days)
-    total_cost += period_cost
+    # Stretch from last change to end date
+    replica_micros += current_replicas * micros(to_date - current_date)
     
-    return total_cost
+    return storage_cost(size_bytes * replica_micros, DAILY_RATE_NANOS_PER_GB)
 
 
-def charge_monthly_cluster_backups():
+def calculate_backup_costs(backups, to_date):
     """
-    Monthly billing for IPFS Cluster backups.
-    Charges based on daily usage with replica tracking.
-    NO managed fee - only storage costs.
+    Billing engine: cost of every backup from its billing period start to `to_date`.
+    One history query for the whole batch, whatever its size.
+    
+    Args:
+        backups: ClusterBackup objects
+        to_date: End date for billing period
+    
+    Returns:
+        dict: backup_id -> cost in nano-euros
     """
-    print("Starting monthly IPFS Cluster backup billing...")
+    history = load_replica_history([backup.id for backup in backups], to_date)
+    return {
+        backup.id: piecewise_backup_cost(
+            backup.size_bytes, backup.replica_count, history[backup.id], billing_period_start(backup), to_date
+        )
+        for backup in backups
+    }
+
+
+def calculate_backup_cost(backup, from_date, to_date):
+    """
+    Calculate cost for a backup between two dates, accounting for replica changes.
     
-    now = datetime.utcnow()
-    thirty_days_ago = now - timedelta(days=30)
+    Args:
+        backup: ClusterBackup object
+        from_date: Start date for billing period
+        to_date: End date for billing period
     
-    # Find all active backups that haven't been billed in last 30 days
-    backups_to_bill = ClusterBackup.query.filter(
+    Returns:
+        Decimal: Total cost for the period
+    """
+    history = load_replica_history([backup.id], to_date)[backup.id]
+    return to_eur(piecewise_backup_cost(backup.size_bytes, backup.replica_count, history, from_date, to_date))
+
+
+def _due_backups_filter(billed_until):
+    # Active backups not billed in the 30 days before the run
+    return db.and_(
         ClusterBackup.status == 'active',
         db.or_(
             ClusterBackup.last_billed_at == None,
-            ClusterBackup.last_billed_at <= thirty_days_ago
+            ClusterBackup.last_billed_at <= billed_until - timedelta(days=30)
         )
-    ).all()
+    )
+
+
+def plan_billing_run(shard_users=BILLING_SHARD_USERS):
+    """
+    Resume the unfinished billing run, or start a new one split into user id ranges.
     
-    if not backups_to_bill:
-        print("No backups to bill this month.")
-        return
+    Args:
+        shard_users: User ids per shard (bounds the memory and transaction size of one shard)
+    
+    Returns:
+        BillingRun
+    """
+    run = BillingRun.query.filter_by(status='running').order_by(BillingRun.id).first()
+    if run:
+        pending = run.shards.filter_by(status='pending').count()
+        print(f"Resuming billing run {run.id} (billing until {run.billed_until}): {pending} shards left")
+        return run
+    
+    run = BillingRun(billed_until=datetime.utcnow(), status='running')
+    db.session.add(run)
+    db.session.flush()
+    
+    low, high = db.session.query(
+        db.func.min(ClusterBackup.user_id), db.func.max(ClusterBackup.user_id)
+    ).filter(_due_backups_filter(run.billed_until)).one()
+    if low is not None:
+        db.session.add_all([
+            BillingRunShard(run_id=run.id, user_id_from=start, user_id_to=start + shard_users)
+            for start in range(low, high + 1, shard_users)
+        ])
+    db.session.commit()
+    print(f"Started billing run {run.id} (billing until {run.billed_until}): {run.shards.count()} shards")
+    return run
+
+
+def _claim_shard(run_id, skip_ids):
+    # Row lock held until the shard commits: a crashed worker's shard goes back to pending
+    return BillingRunShard.query.filter(
+        BillingRunShard.run_id == run_id,
+        BillingRunShard.status == 'pending',
+        BillingRunShard.id.notin_(skip_ids)
+    ).order_by(BillingRunShard.id).with_for_update(skip_locked=True).first()
+
+
+def bill_shard(shard, billed_until):
+    """
+    Charge every due backup of the shard's users and mark the shard done, in one commit.
+    
+    Args:
+        shard: Locked BillingRunShard
+        billed_until: End of the billing period (the run's billed_until)
+    """
+    backups = ClusterBackup.query.filter(
+        _due_backups_filter(billed_until),
+        ClusterBackup.user_id >= shard.user_id_from,
+        ClusterBackup.user_id < shard.user_id_to
+    ).all()
+    costs = calculate_backup_costs(backups, billed_until)
     
     # Group by user
     user_costs = {}
-    for backup in backups_to_bill:
-        # Determine billing period
-        if backup.last_billed_at:
-            from_date = backup.last_billed_at
-        else:
-            from_date = backup.created_at
-        
-        to_date = now
-        
-        # Calculate cost for this backup
-        cost = calculate_backup_cost(backup, from_date, to_date)
-        
-        if backup.user_id not in user_costs:
-            user_costs[backup.user_id] = Decimal("0")
-        user_costs[backup.user_id] += cost
-        
-        # Update last_billed_at
-        backup.last_billed_at = now
-        db.session.add(backup)
-        
-        print(f"  Backup {backup.id}: {backup.file_name}")
-        print(f"    Size: {backup.size_bytes / (1024**3):.2f} GB")
-        print(f"    Replicas: {backup.replica_count}")
-        print(f"    Period: {from_date} to {to_date}")
-        print(f"    Cost: €{cost:.2f}")
-    
-    # Charge each user
-    for user_id, total_cost in user_costs.items():
-        user = User.query.get(user_id)
-        if user:
-            print(f"\nCharging User {user_id}: €{total_cost:.2f}")
-            user.credit_balance_eur -= total_cost
-            db.session.add(user)
+    for backup in backups:
+        user_costs[backup.user_id] = user_costs.get(backup.user_id, 0) + costs[backup.id]
+        backup.last_billed_at = billed_until
+    
+    total = 0
+    for user_id, cost in user_costs.items():
+        amount = to_eur(cost, places=8)  # credit_balance_eur / balance_ledger precision
+        total += cost
+        # Usage is billed after the fact, so the balance may go negative (grace period).
+        # Ledger-only insert: the run never waits on user rows held by uploads or payments
+        post_ledger_entry(user_id, "credit", -amount, "cluster_billing", reference=f"{billed_until:%Y-%m-%d}")
     
+    shard.status = 'done'
+    shard.users_billed = len(user_costs)
+    shard.backups_billed = len(backups)
+    shard.amount_eur = to_eur(total, places=8)
+    shard.finished_at = datetime.utcnow()
     db.session.commit()
-    print(f"\nMonthly IPFS Cluster backup billing finished. Billed {len(user_costs)} users.")
+    print(f"  Shard {shard.id} (users {shard.user_id_from}-{shard.user_id_to - 1}): "
+          f"{shard.backups_billed} backups, {shard.users_billed} users, €{shard.amount_eur:.2f}")
+
+
+def drain_billing_shards(run_id):
+    """
+    Bill pending shards of a run until none are left. Safe to run in many processes at once.
+    A failed shard is rolled back and left pending for the next run.
+    
+    Returns:
+        int: Shards billed
+    """
+    billed_until = BillingRun.query.get(run_id).billed_until
+    billed = 0
+    failed = []
+    while True:
+        shard = _claim_shard(run_id, failed)
+        if shard is None:
+            db.session.rollback()
+            return billed
+        shard_id = shard.id
+        try:
+            bill_shard(shard, billed_until)
+            billed += 1
+        except Exception as e:
+            db.session.rollback()
+            failed.append(shard_id)
+            print(f"  Shard {shard_id} failed, left for the next run: {e}")
+
+
+_worker_app = None
+
+
+def _init_billing_worker(app):
+    global _worker_app
+    _worker_app = app
+    with app.app_context():
+        db.engine.dispose(close=False)  # Pooled connections belong to the parent process
+
+
+def _billing_worker(run_id):
+    with _worker_app.app_context():
+        return drain_billing_shards(run_id)
+
+
+def charge_monthly_cluster_backups(workers=BILLING_WORKERS, shard_users=BILLING_SHARD_USERS):
+    """
+    Monthly billing for IPFS Cluster backups.
+    Charges based on daily usage with replica tracking.
+    NO managed fee - only storage costs.
+    
+    Users are billed in id-range shards by a pool of `workers` processes.
+    Each shard commits its charges and its 'done' mark together, so a
+    crashed run resumes with the shards it had not finished and never
+    charges a backup twice.
+    
+    Returns:
+        dict: {"run_id", "shards", "users", "backups", "seconds"} for shards billed by this call
+    """
+    print("Starting monthly IPFS Cluster backup billing...")
+    started = time.monotonic()
+    run = plan_billing_run(shard_users)
+    run_id = run.id
+    done_before = {shard.id for shard in run.shards.filter_by(status='done')}
+    
+    if workers <= 1:
+        drain_billing_shards(run_id)
+    else:
+        db.session.remove()
+        db.engine.dispose()  # Forked workers must not share the parent's connections
+        app = current_app._get_current_object()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_billing_worker, initargs=(app,)) as executor:
+            list(executor.map(_billing_worker, [run_id] * workers))
+    
+    run = BillingRun.query.get(run_id)
+    billed = [shard for shard in run.shards.filter_by(status='done') if shard.id not in done_before]
+    if run.shards.filter_by(status='pending').count() == 0:
+        run.status = 'done'
+        run.finished_at = datetime.utcnow()
+        db.session.commit()
+        compact_ledger()  # One set-based UPDATE applies the whole run to the balances
+    else:
+        print(f"Billing run {run_id} is incomplete, the next run resumes it.")
+    
+    elapsed = time.monotonic() - started
+    users = sum(shard.users_billed for shard in billed)
+    backups = sum(shard.backups_billed for shard in billed)
+    print(f"\nMonthly IPFS Cluster backup billing finished: {users} users, {backups} backups "
+          f"in {elapsed:.1f}s ({users / elapsed:.1f} users/s, {backups / elapsed:.1f} backups/s).")
+    return {"run_id": run_id, "shards": len(billed), "users": users, "backups": backups, "seconds": elapsed}
 
 
 def get_estimated_monthly_cost(user_id):
@@ -172,32 +362,27 @@ def get_estimated_monthly_cost(user_id):
         }
     
     now = datetime.utcnow()
-    total_cost = Decimal("0")
+    total_cost = 0
     backup_details = []
+    costs = calculate_backup_costs(backups, now)  # Constant query count, however many backups
     
     for backup in backups:
         # Calculate from last billing or creation
-        if backup.last_billed_at:
-            from_date = backup.last_billed_at
-        else:
-            from_date = backup.created_at
-        
-        cost = calculate_backup_cost(backup, from_date, now)
+        from_date = billing_period_start(backup)
+        cost = costs[backup.id]
         total_cost += cost
         
-        size_gb = Decimal(backup.size_bytes) / Decimal(1024 * 1024 * 1024)
-        
         backup_details.append({
             "id": backup.id,
             "file_name": backup.file_name,
-            "size_gb": float(size_gb),
+            "size_gb": float(bytes_to_gb(backup.size_bytes)),
             "replica_count": backup.replica_count,
-            "estimated_cost": float(cost),
+            "estimated_cost": float(to_eur(cost)),
             "days_since_last_bill": (now - from_date).days
         })
     
     return {
-        "total_estimated_cost": float(total_cost),
+        "total_estimated_cost": float(to_eur(total_cost)),
         "backups": backup_details
     }
 
@@ -234,3 +419,16 @@ def update_replica_count(backup_id, new_replica_count):
     
     db.session.commit()
     return True
+
+
+def run_cluster_billing():
+    """Entry point for the monthly cron job."""
+    from .app import create_app
+
+    app = create_app()
+    with app.app_context():
+        charge_monthly_cluster_backups()
+
+
+if __name__ == "__main__":
+    run_cluster_billing()
@@ -3,20 +3,49 @@ Customer Dashboard Routes
 """
 from flask import Blueprint, render_template, request, jsonify
 from src.models import db, User, Pin, Payment, ClusterBackup
-from decimal import Decimal
+from src.money import DAYS_PER_MONTH, div_round, to_nanos, to_eur, gb_cost
+from src.payment_addresses import get_payment_address, payment_details, SATSALE_INVOICE_EUR
+from src.bandwidth import PRICE_PER_GB_BANDWIDTH_PRIVATE, PRICE_PER_GB_BANDWIDTH_PUBLIC
+from src.pin_listing import pin_page_from_args
 from datetime import datetime
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+# Projections are computed in integer nano-euros and converted once for display
+PINNING_PRICE_NANOS_PER_GB_MONTH = to_nanos("0.07")
+BACKUP_PRICE_NANOS_PER_GB_MONTH = to_nanos("0.0156")
+
+
+def _pin_totals(user_id):
+    """File counts and bytes of a user's pins, by visibility, in one aggregate query."""
+    return db.session.query(
+        db.func.count(Pin.id).label('files'),
+        db.func.count(Pin.id).filter(Pin.is_private).label('private_files'),
+        db.func.count(Pin.id).filter(db.not_(Pin.is_private)).label('public_files'),
+        db.func.coalesce(db.func.sum(Pin.size_bytes), 0).label('total_bytes'),
+        db.func.coalesce(db.func.sum(Pin.size_bytes).filter(Pin.is_private), 0).label('private_bytes'),
+        db.func.coalesce(db.func.sum(Pin.size_bytes).filter(db.not_(Pin.is_private)), 0).label('public_bytes'),
+    ).filter(Pin.user_id == user_id).one()
+
+
+def _cluster_totals(user_id):
+    """Bytes of all a user's cluster backups, and count and size × replicas of the billed ones, in one aggregate query."""
+    billed = ClusterBackup.status.in_(['active', 'grace_period'])
+    return db.session.query(
+        db.func.coalesce(db.func.sum(ClusterBackup.size_bytes), 0).label('total_bytes'),
+        db.func.count(ClusterBackup.id).filter(billed).label('billed_backups'),
+        db.func.coalesce(
+            db.func.sum(ClusterBackup.size_bytes * ClusterBackup.replica_count).filter(billed), 0
+        ).label('billed_replica_bytes'),
+    ).filter(ClusterBackup.user_id == user_id).one()
+
+
 @dashboard_bp.route('/dashboard', methods=['GET'])
 def customer_dashboard():
     """
     Customer billing dashboard
     Access via: https://datahosting.company/dashboard?token=DASHBOARD_TOKEN
     """
-    import requests
-    import logging
-    
     # Get dashboard token from query string
     token = request.args.get('token')
     
@@ -32,63 +61,60 @@ def customer_dashboard():
     if not user:
         return jsonify({"error": "Invalid dashboard token"}), 401
     
-    # Get user's pins (IPFS Kubo)
-    pins = Pin.query.filter_by(user_id=user.id).order_by(Pin.created_at.desc()).all()
-    
-    # Get user's cluster backups
-    cluster_backups = ClusterBackup.query.filter_by(user_id=user.id).order_by(ClusterBackup.created_at.desc()).all()
+    # Totals come from one grouped aggregate per table; only the rows shown are loaded
+    pin_totals = _pin_totals(user.id)
+    cluster_totals = _cluster_totals(user.id)
     
     # Calculate total storage (Kubo pins)
-    total_storage_bytes = sum(pin.size_bytes for pin in pins)
-    total_storage_gb = float(total_storage_bytes) / (1024 ** 3)
+    total_storage_gb = float(pin_totals.total_bytes) / (1024 ** 3)
     
     # Calculate total cluster backup storage
-    total_cluster_bytes = sum(backup.size_bytes for backup in cluster_backups)
-    total_cluster_gb = float(total_cluster_bytes) / (1024 ** 3)
+    total_cluster_gb = float(cluster_totals.total_bytes) / (1024 ** 3)
     
-    # Calculate daily and monthly cluster costs
-    daily_cluster_cost = Decimal("0")
-    monthly_cluster_cost = Decimal("0")
+    # Calculate daily and monthly cluster costs (active and grace period backups)
+    monthly_cluster_cost = gb_cost(cluster_totals.billed_replica_bytes, BACKUP_PRICE_NANOS_PER_GB_MONTH)
+    daily_cluster_cost = div_round(monthly_cluster_cost, DAYS_PER_MONTH)
     cluster_backups_with_info = []
     grace_period_backups = []
     
-    for backup in cluster_backups:
-        size_gb = Decimal(backup.size_bytes) / Decimal(1024 ** 3)
-        monthly_cost = size_gb * backup.replica_count * Decimal("0.0156")
-        daily_cost = monthly_cost / 30
+    recent_cluster_backups = ClusterBackup.query.filter(
+        ClusterBackup.user_id == user.id,
+        ClusterBackup.status.in_(['active', 'grace_period'])
+    ).order_by(ClusterBackup.created_at.desc()).limit(10).all()
+    
+    for backup in recent_cluster_backups:
+        monthly_cost = gb_cost(backup.size_bytes * backup.replica_count, BACKUP_PRICE_NANOS_PER_GB_MONTH)
+        daily_cost = div_round(monthly_cost, DAYS_PER_MONTH)
+        
+        # Calculate days remaining until expiration
+        if backup.expire_at:
+            days_remaining = (backup.expire_at - datetime.utcnow()).days
+            if days_remaining < 0:
+                days_remaining = 0
+        else:
+            days_remaining = None
+        
+        backup_info = {
+            'backup': backup,
+            'daily_cost': to_eur(daily_cost),
+            'monthly_cost': to_eur(monthly_cost),
+            'days_remaining': days_remaining
+        }
         
-        if backup.status in ['active', 'grace_period']:
-            daily_cluster_cost += daily_cost
-            monthly_cluster_cost += monthly_cost
-            
-            # Calculate days remaining until expiration
-            if backup.expire_at:
-                days_remaining = (backup.expire_at - datetime.utcnow()).days
-                if days_remaining < 0:
-                    days_remaining = 0
-            else:
-                days_remaining = None
-            
-            backup_info = {
-                'backup': backup,
-                'daily_cost': float(daily_cost),
-                'monthly_cost': float(monthly_cost),
-                'days_remaining': days_remaining
-            }
-            
-            if backup.status == 'grace_period':
-                # Calculate grace period days left
-                grace_days_elapsed = (datetime.utcnow() - backup.updated_at).days
-                grace_days_left = max(0, 7 - grace_days_elapsed)
-                backup_info['grace_days_left'] = grace_days_left
-                grace_period_backups.append(backup_info)
-            else:
-                cluster_backups_with_info.append(backup_info)
+        if backup.status == 'grace_period':
+            # Calculate grace period days left
+            grace_days_elapsed = (datetime.utcnow() - (backup.grace_period_started_at or datetime.utcnow())).days
+            grace_days_left = max(0, 7 - grace_days_elapsed)
+            backup_info['grace_days_left'] = grace_days_left
+            grace_period_backups.append(backup_info)
+        else:
+            cluster_backups_with_info.append(backup_info)
     
     # Calculate how many days current balance can sustain all backups
+    balance = to_nanos(user.credit_balance_eur)
     if daily_cluster_cost > 0:
-        days_balance_lasts = int(user.credit_balance_eur / daily_cluster_cost)
-        months_balance_lasts = float(user.credit_balance_eur / monthly_cluster_cost)
+        days_balance_lasts = int(balance / daily_cluster_cost)
+        months_balance_lasts = balance / monthly_cluster_cost
     else:
         days_balance_lasts = 999999  # Infinite (no active backups)
         months_balance_lasts = 999
@@ -98,75 +124,39 @@ def customer_dashboard():
     now = datetime.utcnow()
     days_in_month = monthrange(now.year, now.month)[1]
     days_until_month_end = days_in_month - now.day
-    cost_until_month_end = float(daily_cluster_cost * days_until_month_end)
+    cost_until_month_end = daily_cluster_cost * days_until_month_end
     
     # Calculate how much to add to reach end of month
-    if cost_until_month_end > float(user.credit_balance_eur):
-        amount_to_add_for_month = cost_until_month_end - float(user.credit_balance_eur)
-    else:
-        amount_to_add_for_month = 0
+    amount_to_add_for_month = max(0, cost_until_month_end - balance)
     
     # Get recent pins (last 10)
-    recent_pins = pins[:10]
-    
-    # Get recent cluster backups (last 10)
-    recent_cluster_backups = cluster_backups[:10]
+    recent_pins = Pin.query.filter_by(user_id=user.id).order_by(Pin.created_at.desc()).limit(10).all()
     
     # Get payment history
     recent_payments = Payment.query.filter_by(user_id=user.id).order_by(Payment.created_at.desc()).limit(10).all()
     
-    # Generate Bitcoin payment address via SatSale
-    btc_address = None
-    btc_qr_url = None
-    payment_amount = 10  # Default suggested amount in EUR
-    
-    try:
-        # Create a payment request with SatSale
-        webhook_url = f"http://localhost:5003/webhook/satsale?user_id={user.id}"
-        satsale_url = f"http://localhost:5004/api/createpayment?amount={payment_amount}&currency=EUR&method=onchain&w_url={webhook_url}"
-        
-        response = requests.get(satsale_url, timeout=5)
-        
-        if response.status_code == 200:
-            invoice_data = response.json()
-            if 'invoice' in invoice_data:
-                invoice = invoice_data['invoice']
-                btc_address = invoice.get('address')
-                btc_amount = invoice.get('btc_value')
-                invoice_uuid = invoice.get('uuid')
-                
-                # Generate QR code URL
-                if btc_address:
-                    btc_qr_url = f"http://localhost:5004/static/qr_codes/{invoice_uuid}.png"
-                    logging.info(f"Generated Bitcoin address {btc_address} for user {user.id}")
-            else:
-                logging.warning(f"No invoice in SatSale response: {invoice_data}")
-        else:
-            logging.error(f"SatSale returned status {response.status_code}: {response.text}")
-            
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to connect to SatSale: {e}")
-        btc_address = "Service temporarily unavailable. Please try refreshing the page."
-    except Exception as e:
-        logging.error(f"Error generating Bitcoin address: {e}")
-        btc_address = "Error generating payment address"
+    # Bitcoin payment address from the pre-created invoice pool: never waits on SatSale
+    payment_address = get_payment_address(user.id)
+    btc_address = payment_address.address if payment_address else None
+    btc_qr_url = payment_details(payment_address)["qr_code_url"]
+    payment_amount = payment_address.amount_eur.normalize() if payment_address else SATSALE_INVOICE_EUR
     
     # Render dashboard template
     return render_template('dashboard.html',
         user=user,
         total_storage_gb=total_storage_gb,
-        total_files=len(pins),
+        total_files=pin_totals.files,
         recent_pins=recent_pins,
         total_cluster_gb=total_cluster_gb,
-        total_cluster_backups=len([b for b in cluster_backups if b.status in ['active', 'grace_period']]),
+        total_cluster_backups=cluster_totals.billed_backups,
         cluster_backups_with_info=cluster_backups_with_info,
         grace_period_backups=grace_period_backups,
-        daily_cluster_cost=float(daily_cluster_cost),
-        monthly_cluster_cost=float(monthly_cluster_cost),
+        daily_cluster_cost=to_eur(daily_cluster_cost),
+        monthly_cluster_cost=to_eur(monthly_cluster_cost),
         days_balance_lasts=days_balance_lasts,
         months_balance_lasts=months_balance_lasts,
-        cost_until_month_end=cost_until_month_end,
-        amount_to_add_for_month=amount_to_add_for_month,
+        cost_until_month_end=to_eur(cost_until_month_end),
+        amount_to_add_for_month=to_eur(amount_to_add_for_month),
         days_until_month_end=days_until_month_end,
         recent_payments=recent_payments,
         btc_address=btc_address,
@@ -191,31 +181,24 @@ def dashboard_stats():
     if not user:
         return jsonify({"error": "Invalid dashboard token"}), 401
     
-    # Get user's pins
-    pins = Pin.query.filter_by(user_id=user.id).all()
-    
-    # Calculate statistics
-    total_storage_bytes = sum(pin.size_bytes for pin in pins)
-    total_storage_gb = float(total_storage_bytes) / (1024 ** 3)
-    
-    # Count file types
-    public_files = sum(1 for pin in pins if not pin.is_private)
-    private_files = sum(1 for pin in pins if pin.is_private)
+    # Calculate statistics (one aggregate query)
+    pin_totals = _pin_totals(user.id)
+    total_storage_gb = float(pin_totals.total_bytes) / (1024 ** 3)
     
     # Storage by type
-    public_storage = sum(pin.size_bytes for pin in pins if not pin.is_private) / (1024 ** 3)
-    private_storage = sum(pin.size_bytes for pin in pins if pin.is_private) / (1024 ** 3)
+    public_storage = float(pin_totals.public_bytes) / (1024 ** 3)
+    private_storage = float(pin_totals.private_bytes) / (1024 ** 3)
     
     # Calculate estimated monthly cost
-    storage_cost = Decimal(total_storage_gb) * Decimal("0.07")
+    storage_cost = gb_cost(pin_totals.total_bytes, PINNING_PRICE_NANOS_PER_GB_MONTH)
     
     # Estimate bandwidth cost (using average)
     avg_bandwidth_cost = (
-        (user.bandwidth_used_private_gb * Decimal("0.02")) +
-        (user.bandwidth_used_public_gb * Decimal("0.10"))
+        to_nanos(user.bandwidth_used_private_gb * PRICE_PER_GB_BANDWIDTH_PRIVATE) +
+        to_nanos(user.bandwidth_used_public_gb * PRICE_PER_GB_BANDWIDTH_PUBLIC)
     )
     
-    estimated_monthly_cost = float(storage_cost + avg_bandwidth_cost)
+    estimated_monthly_cost = float(to_eur(storage_cost + avg_bandwidth_cost))
     
     return jsonify({
         "balance": {
@@ -226,9 +209,9 @@ def dashboard_stats():
             "total_gb": round(total_storage_gb, 2),
             "public_gb": round(public_storage, 2),
             "private_gb": round(private_storage, 2),
-            "total_files": len(pins),
-            "public_files": public_files,
-            "private_files": private_files
+            "total_files": pin_totals.files,
+            "public_files": pin_totals.public_files,
+            "private_files": pin_totals.private_files
         },
         "bandwidth": {
             "private_used_gb": float(user.bandwidth_used_private_gb),
@@ -237,8 +220,8 @@ def dashboard_stats():
             "cycle_start": user.bandwidth_cycle_start.isoformat() if user.bandwidth_cycle_start else None
         },
         "costs": {
-            "storage_monthly_eur": float(storage_cost),
-            "bandwidth_current_eur": float(avg_bandwidth_cost),
+            "storage_monthly_eur": float(to_eur(storage_cost)),
+            "bandwidth_current_eur": float(to_eur(avg_bandwidth_cost)),
             "estimated_monthly_total_eur": estimated_monthly_cost
         },
         "account": {
@@ -263,40 +246,11 @@ def dashboard_files():
     if not user:
         return jsonify({"error": "Invalid dashboard token"}), 401
     
-    # Get pagination parameters
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 50, type=int)
-    
-    # Get user's pins with pagination
-    pagination = Pin.query.filter_by(user_id=user.id).order_by(Pin.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    
-    files = []
-    for pin in pagination.items:
-        files.append({
-            "cid": pin.cid,
-            "file_name": pin.file_name,
-            "size_bytes": pin.size_bytes,
-            "size_mb": round(pin.size_bytes / (1024 ** 2), 2),
-            "is_private": pin.is_private,
-            "status": pin.status,
-            "created_at": pin.created_at.isoformat() if pin.created_at else None,
-            "expire_at": pin.expire_at.isoformat() if pin.expire_at else None,
-            "url": f"https://ipfs.datahosting.company/ipfs/{pin.cid}" if not pin.is_private else f"https://private.datahosting.company/ipfs/{pin.cid}"
-        })
-    
-    return jsonify({
-        "files": files,
-        "pagination": {
-            "page": page,
-            "per_page": per_page,
-            "total": pagination.total,
-            "pages": pagination.pages,
-            "has_next": pagination.has_next,
-            "has_prev": pagination.has_prev
-        }
-    })
+    # Cursor pagination: ?cursor= from the previous page's next_cursor, ?total=approx for an estimated count
+    try:
+        return jsonify(pin_page_from_args(user.id, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
 
 @dashboard_bp.route('/dashboard/payments', methods=['GET'])
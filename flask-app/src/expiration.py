@@ -0,0 +1,183 @@
+"""
+Expiration Module
+Releases expired pins and cluster backups at their deadline instead of on a periodic full scan
+A timing wheel holds the deadlines of the next EXPIRATION_HORIZON_SECONDS, loaded from partial indexes on expire_at
+New deadlines inside the horizon are announced with NOTIFY, so Postgres is idle between deadlines
+"""
+
+import os
+import time
+import select
+import psycopg2
+from datetime import datetime, timezone
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from flask import current_app
+from .models import db
+
+EXPIRATION_HORIZON_SECONDS = int(os.getenv("EXPIRATION_HORIZON_SECONDS", "3600"))   # Deadlines held in memory
+EXPIRATION_TICK_SECONDS = 1             # Wheel slot width: content is released at most this late
+EXPIRATION_RETRY_SECONDS = 1            # Another node holds the task lock: look again this much later
+DEADLINE_CHANNEL = "expiration_deadlines"
+
+# Deadline kind -> (scheduler task that releases it, SQL for the next deadlines, one per second)
+DEADLINE_KINDS = {
+    "pin": ("pin_expiration", """
+        SELECT max(expire_at) FROM pins
+         WHERE status = 'pinned' AND expire_at < :until
+         GROUP BY date_trunc('second', expire_at)
+    """),
+    "backup": ("cluster_backup_expiration", """
+        SELECT max(expire_at) FROM cluster_backups
+         WHERE status = 'active' AND expire_at < :until
+         GROUP BY date_trunc('second', expire_at)
+    """),
+}
+
+
+def _epoch(moment):
+    # expire_at columns hold naive UTC
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel: one slot per tick over a fixed horizon.
+
+    add() is O(1). Each slot keeps, per kind, the latest deadline that fell
+    in it, so one wake-up releases everything due in that tick. Deadlines
+    past the horizon are refused; the caller loads them later.
+    """
+
+    def __init__(self, slots, tick=EXPIRATION_TICK_SECONDS, now=None):
+        self.tick = tick
+        self.slots = slots
+        self._buckets = [{} for _ in range(slots)]
+        self._next_tick = int((time.time() if now is None else now) // tick)
+
+    def add(self, kind, deadline):
+        """Schedule `kind` at `deadline` (epoch seconds). Returns False if past the horizon."""
+        tick = max(int(deadline // self.tick), self._next_tick)  # Overdue: due on the next pop
+        if tick >= self._next_tick + self.slots:
+            return False
+        bucket = self._buckets[tick % self.slots]
+        bucket[kind] = max(deadline, bucket.get(kind, deadline))
+        return True
+
+    def pop_due(self, now):
+        """Remove and return the kinds with a deadline at or before `now`."""
+        due = set()
+        now_tick = int(now // self.tick)
+        for _ in range(self.slots):
+            if self._next_tick > now_tick:
+                break
+            bucket = self._buckets[self._next_tick % self.slots]
+            for kind, deadline in list(bucket.items()):
+                if deadline <= now:
+                    due.add(kind)
+                    del bucket[kind]
+            if bucket:
+                break  # The rest of this tick is still ahead of us
+            self._next_tick += 1
+        else:
+            self._next_tick = max(self._next_tick, now_tick)  # Slept past the whole wheel
+        return due
+
+    def next_deadline(self):
+        """Epoch seconds of the earliest scheduled deadline, or None if the wheel is empty."""
+        for offset in range(self.slots):
+            bucket = self._buckets[(self._next_tick + offset) % self.slots]
+            if bucket:
+                return min(bucket.values())
+        return None
+
+
+def register_deadline(kind, expire_at):
+    """
+    Tell running expiration daemons about a new or moved deadline (new pin,
+    retention change). Delivered when the caller's transaction commits;
+    deadlines past the horizon are picked up by the daemons' next load.
+
+    Args:
+        kind: "pin" or "backup" (see DEADLINE_KINDS)
+        expire_at: Naive UTC datetime, or None for content that never expires
+    """
+    if expire_at is None or (expire_at - datetime.utcnow()).total_seconds() >= EXPIRATION_HORIZON_SECONDS:
+        return
+    db.session.execute(
+        db.text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": DEADLINE_CHANNEL, "payload": f"{kind} {_epoch(expire_at)}"}
+    )
+
+
+def load_deadlines(wheel, until):
+    """Add every deadline before `until` (and any overdue one) to the wheel. Returns deadlines loaded."""
+    loaded = 0
+    for kind, (_, sql) in DEADLINE_KINDS.items():
+        for (expire_at,) in db.session.execute(db.text(sql), {"until": until}):
+            loaded += wheel.add(kind, _epoch(expire_at))
+    db.session.commit()
+    return loaded
+
+
+def _apply_notifications(wheel, conn):
+    conn.poll()
+    while conn.notifies:
+        payload = conn.notifies.pop(0).payload
+        try:
+            kind, deadline = payload.split()
+            if kind in DEADLINE_KINDS:
+                wheel.add(kind, float(deadline))
+        except ValueError:
+            print(f"Ignoring malformed deadline notification: {payload!r}")
+
+
+def run_expiration_daemon():
+    """
+    Main loop: sleep until the next deadline (or a notification), then run
+    that kind's cleanup task through the scheduler, under its advisory lock.
+    """
+    from .app import create_app
+    from .scheduler import run_task
+
+    app = create_app()
+    with app.app_context():
+        dsn = current_app.config['SQLALCHEMY_DATABASE_URI']
+        print(f"Expiration daemon started (horizon {EXPIRATION_HORIZON_SECONDS}s)")
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {DEADLINE_CHANNEL}")
+
+                # Subscribed first, then loaded: no deadline falls in between
+                wheel = TimingWheel(EXPIRATION_HORIZON_SECONDS // EXPIRATION_TICK_SECONDS)
+                next_load = 0
+                while True:
+                    now = time.time()
+                    if now >= next_load:
+                        # Reload at half the horizon, so the wheel always covers what is coming
+                        until = datetime.utcfromtimestamp(now + EXPIRATION_HORIZON_SECONDS - EXPIRATION_TICK_SECONDS)
+                        print(f"Loaded {load_deadlines(wheel, until)} expiration deadlines until {until}")
+                        next_load = now + EXPIRATION_HORIZON_SECONDS / 2
+
+                    for kind in sorted(wheel.pop_due(now)):
+                        if not run_task(DEADLINE_KINDS[kind][0], force=True):
+                            wheel.add(kind, now + EXPIRATION_RETRY_SECONDS)
+                        db.session.remove()
+
+                    wake_at = min(filter(None, (wheel.next_deadline(), next_load)))
+                    if select.select([conn], [], [], max(0, wake_at - time.time())) != ([], [], []):
+                        _apply_notifications(wheel, conn)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Expiration daemon error, restarting: {e}")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+if __name__ == "__main__":
+    run_expiration_daemon()
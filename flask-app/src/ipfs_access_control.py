@@ -4,65 +4,279 @@ Validates user's ipfs_access_hash before allowing IPFS cluster operations
 Prevents billing evasion by ensuring all IPFS access goes through billing system
 """
 
+import os
+import time
+import select
+import logging
+import threading
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from .models import db, User, Pin
-from flask import jsonify
+from .ttl_cache import TTLCache
+from .capability_tokens import revoke_capability_tokens
+from flask import jsonify, current_app
 
+# Verdict cache for the gateway hot path, keyed on (ipfs_access_hash, cid)
+VALIDATION_CACHE_TTL = float(os.getenv("IPFS_VALIDATE_CACHE_TTL", "30"))       # seconds
+VALIDATION_CACHE_SIZE = int(os.getenv("IPFS_VALIDATE_CACHE_SIZE", "100000"))   # entries per worker
+INVALIDATION_CHANNEL = "ipfs_access_invalidate"
+UNKNOWN_HASH_REASON = "Invalid IPFS access hash"
 
-def validate_ipfs_access(ipfs_access_hash, cid):
-    """
-    Validate if a user has permission to access a specific CID.
-    
-    Args:
-        ipfs_access_hash: User's unique IPFS access hash
-        cid: Content identifier to access
-    
-    Returns:
-        dict: {
-            "valid": bool,
-            "user_id": int (if valid),
-            "is_private": bool (if valid),
-            "reason": str (if invalid)
-        }
-    """
-    # Check if hash exists
-    user = User.query.filter_by(ipfs_access_hash=ipfs_access_hash).first()
-    if not user:
+_validation_cache = TTLCache(VALIDATION_CACHE_SIZE, VALIDATION_CACHE_TTL)
+# ipfs_access_hash -> monotonic time of the last user-wide invalidation
+_user_invalidated_at = TTLCache(VALIDATION_CACHE_SIZE, VALIDATION_CACHE_TTL)
+# (ipfs_access_hash, cid) -> monotonic time of the last invalidation of that pin
+_pin_invalidated_at = TTLCache(VALIDATION_CACHE_SIZE, VALIDATION_CACHE_TTL)
+_listener_ready = threading.Event()
+_listener_lock = threading.Lock()
+_listener_pid = None
+
+
+def _verdict(user_id, credit_balance, pin_id, pin_status, is_private, size_bytes):
+    """Build the validate_ipfs_access result from one (user, pin) row."""
+    if user_id is None:
         return {
             "valid": False,
-            "reason": "Invalid IPFS access hash"
+            "reason": UNKNOWN_HASH_REASON
         }
     
     # Check if user has positive balance
-    if user.credit_balance_eur <= 0:
+    if credit_balance <= 0:
         return {
             "valid": False,
             "reason": "Insufficient credits. Please add funds to your account."
         }
     
     # Check if pin exists and belongs to this user
-    pin = Pin.query.filter_by(cid=cid, ipfs_access_hash=ipfs_access_hash).first()
-    if not pin:
+    if pin_id is None:
         return {
             "valid": False,
             "reason": "CID not found or access denied"
         }
     
     # Check if pin is active (not in grace period or expired)
-    if pin.status != 'pinned':
+    if pin_status != 'pinned':
         return {
             "valid": False,
-            "reason": f"Pin is not active (status: {pin.status})"
+            "reason": f"Pin is not active (status: {pin_status})"
         }
     
     return {
         "valid": True,
-        "user_id": user.id,
-        "is_private": pin.is_private,
-        "pin_id": pin.id,
-        "file_size_bytes": pin.size_bytes
+        "user_id": user_id,
+        "is_private": is_private,
+        "pin_id": pin_id,
+        "file_size_bytes": size_bytes
     }
 
 
+def _lookup_verdict(ipfs_access_hash, cid):
+    """Single-query fallback: the user row LEFT JOINed to the matching pin."""
+    row = db.session.query(
+        User.id, User.credit_balance_eur, Pin.id, Pin.status, Pin.is_private, Pin.size_bytes
+    ).outerjoin(
+        Pin, db.and_(Pin.ipfs_access_hash == User.ipfs_access_hash, Pin.cid == cid)
+    ).filter(
+        User.ipfs_access_hash == ipfs_access_hash
+    ).order_by(
+        (Pin.status == 'pinned').desc()  # An active copy wins over stale duplicates
+    ).first()
+
+    if row is None:
+        return _verdict(None, None, None, None, None, None)
+    return _verdict(*row)
+
+
+def _invalidated_at(ipfs_access_hash, cid, user_invalidated_at):
+    # Cached verdicts read at or before this moment are stale
+    return max(filter(None, (user_invalidated_at, _pin_invalidated_at.get((ipfs_access_hash, cid)))), default=None)
+
+
+def _cache_verdict(key, verdict, looked_up_at):
+    # Stamped with the time the lookup started: an invalidation that lands while
+    # it runs is newer than the entry. Unknown hashes are not cached, so junk
+    # hashes cannot evict real verdicts.
+    if verdict["valid"] or verdict["reason"] != UNKNOWN_HASH_REASON:
+        _validation_cache.set(key, verdict, stored_at=looked_up_at)
+
+
+def validate_ipfs_access(ipfs_access_hash, cid):
+    """
+    Validate if a user has permission to access a specific CID.
+    
+    Verdicts are cached per worker for VALIDATION_CACHE_TTL seconds and
+    dropped early via invalidate_pin_access / invalidate_user_access.
+    
+    Args:
+        ipfs_access_hash: User's unique IPFS access hash
+        cid: Content identifier to access
+    
+    Returns:
+        dict: {
+            "valid": bool,
+            "user_id": int (if valid),
+            "is_private": bool (if valid),
+            "reason": str (if invalid)
+        }
+    """
+    _ensure_invalidation_listener()
+    key = (ipfs_access_hash, cid)
+
+    # The cache is only trusted while we are subscribed to invalidations
+    if _listener_ready.is_set():
+        verdict = _validation_cache.get(
+            key, newer_than=_invalidated_at(ipfs_access_hash, cid, _user_invalidated_at.get(ipfs_access_hash))
+        )
+        if verdict is not None:
+            return dict(verdict)
+
+    looked_up_at = time.monotonic()
+    verdict = _lookup_verdict(ipfs_access_hash, cid)
+    if _listener_ready.is_set():
+        _cache_verdict(key, verdict, looked_up_at)
+    return dict(verdict)
+
+
+def validate_ipfs_access_batch(ipfs_access_hash, cids):
+    """
+    Validate many CIDs for one user at once.
+    
+    Cache hits are answered locally; all misses are resolved together with
+    a single users LEFT JOIN pins ... cid IN (...) query.
+    
+    Args:
+        ipfs_access_hash: User's unique IPFS access hash
+        cids: Iterable of content identifiers (duplicates are collapsed)
+    
+    Returns:
+        dict: cid -> verdict, each identical to validate_ipfs_access(ipfs_access_hash, cid)
+    """
+    _ensure_invalidation_listener()
+    use_cache = _listener_ready.is_set()
+    user_invalidated_at = _user_invalidated_at.get(ipfs_access_hash) if use_cache else None
+
+    verdicts = {}
+    misses = []
+    for cid in dict.fromkeys(cids):
+        verdict = _validation_cache.get(
+            (ipfs_access_hash, cid), newer_than=_invalidated_at(ipfs_access_hash, cid, user_invalidated_at)
+        ) if use_cache else None
+        if verdict is not None:
+            verdicts[cid] = dict(verdict)
+        else:
+            misses.append(cid)
+
+    if not misses:
+        return verdicts
+
+    looked_up_at = time.monotonic()
+    rows = db.session.query(
+        User.id, User.credit_balance_eur, Pin.cid, Pin.id, Pin.status, Pin.is_private, Pin.size_bytes
+    ).outerjoin(
+        Pin, db.and_(Pin.ipfs_access_hash == User.ipfs_access_hash, Pin.cid.in_(misses))
+    ).filter(
+        User.ipfs_access_hash == ipfs_access_hash
+    ).order_by(
+        (Pin.status == 'pinned').desc()  # Same tie-break as the single lookup
+    ).all()
+
+    user_id, credit_balance = (rows[0][0], rows[0][1]) if rows else (None, None)
+    pins = {}
+    for _, _, cid, pin_id, status, is_private, size_bytes in rows:
+        if cid is not None and cid not in pins:
+            pins[cid] = (pin_id, status, is_private, size_bytes)
+
+    for cid in misses:
+        verdict = _verdict(user_id, credit_balance, *pins.get(cid, (None, None, None, None)))
+        if use_cache:
+            _cache_verdict((ipfs_access_hash, cid), verdict, looked_up_at)
+        verdicts[cid] = dict(verdict)
+    return verdicts
+
+
+def _notify_invalidation(payload):
+    # Delivered to every worker's listener when the caller's transaction commits
+    db.session.execute(
+        db.text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": INVALIDATION_CHANNEL, "payload": payload}
+    )
+
+
+def _apply_invalidation(payload):
+    ipfs_access_hash, _, cid = payload.partition(" ")
+    if cid:
+        _pin_invalidated_at.set((ipfs_access_hash, cid), time.monotonic())
+        _validation_cache.pop((ipfs_access_hash, cid))
+    else:
+        _user_invalidated_at.set(ipfs_access_hash, time.monotonic())
+
+
+def invalidate_pin_access(ipfs_access_hash, cid):
+    """
+    Drop cached verdicts and revoke capability tokens for one pin, in every worker.
+    Call whenever a pin changes status or is deleted, before committing.
+    """
+    _apply_invalidation(f"{ipfs_access_hash} {cid}")
+    _notify_invalidation(f"{ipfs_access_hash} {cid}")
+    revoke_capability_tokens(ipfs_access_hash, cid)
+
+
+def invalidate_user_access(ipfs_access_hash):
+    """
+    Drop all cached verdicts and revoke all capability tokens for a user, in every worker.
+    Call when the user's balance crosses zero or the account is deleted, before committing.
+    """
+    _apply_invalidation(ipfs_access_hash)
+    _notify_invalidation(ipfs_access_hash)
+    revoke_capability_tokens(ipfs_access_hash)
+
+
+def balance_crossed_zero(old_balance, new_balance):
+    """True if a balance change flips the positive-balance check in validate_ipfs_access."""
+    return (old_balance > 0) != (new_balance > 0)
+
+
+def _listen_for_invalidations(dsn):
+    """Background thread: apply invalidations published by any process."""
+    while True:
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+            # Anything may have changed while we were not subscribed
+            _validation_cache.clear()
+            _listener_ready.set()
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    _apply_invalidation(conn.notifies.pop(0).payload)
+        except Exception as e:
+            _listener_ready.clear()
+            _validation_cache.clear()
+            logging.error(f"IPFS access invalidation listener failed, retrying: {e}")
+            time.sleep(5)
+
+
+def _ensure_invalidation_listener():
+    # One listener per process; a forked child must not trust its parent's cache
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_ready.clear()
+        _validation_cache.clear()
+        dsn = current_app.config['SQLALCHEMY_DATABASE_URI']
+        threading.Thread(target=_listen_for_invalidations, args=(dsn,), daemon=True,
+                         name="ipfs-access-invalidation").start()
+        _listener_pid = os.getpid()
+
+
 def get_user_by_ipfs_hash(ipfs_access_hash):
     """
     Get user by IPFS access hash.
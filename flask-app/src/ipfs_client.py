@@ -0,0 +1,221 @@
+"""
+IPFS Client Module
+Pooled HTTP clients for the Kubo RPC API and the IPFS Cluster REST API
+Replaces per-call `ipfs` / `ipfs-cluster-ctl` subprocesses with keep-alive connections
+"""
+
+import os
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Endpoints (the nodes the `ipfs` and `ipfs-cluster-ctl` CLIs used to talk to)
+IPFS_API_URL = os.getenv("IPFS_API_URL", os.getenv("IPFS_PUBLIC_API", "http://127.0.0.1:5001"))
+IPFS_CLUSTER_API = os.getenv("IPFS_CLUSTER_API", "http://127.0.0.1:9094")
+IPFS_CLUSTER_BASIC_AUTH = os.getenv("IPFS_CLUSTER_BASIC_AUTH")  # "user:password", optional
+
+# Timeouts in seconds and connections kept alive per endpoint
+IPFS_CONNECT_TIMEOUT = float(os.getenv("IPFS_CONNECT_TIMEOUT", "5"))
+IPFS_READ_TIMEOUT = float(os.getenv("IPFS_READ_TIMEOUT", "60"))
+IPFS_ADD_TIMEOUT = float(os.getenv("IPFS_ADD_TIMEOUT", "300"))  # matches nginx proxy timeouts
+IPFS_POOL_SIZE = int(os.getenv("IPFS_POOL_SIZE", "16"))
+
+
+class IPFSClientError(Exception):
+    """A Kubo or Cluster call failed (unreachable, timed out or returned an error)."""
+
+
+class _PooledClient:
+    """Base client holding one keep-alive requests.Session per endpoint."""
+
+    def __init__(self, base_url, pool_size=IPFS_POOL_SIZE,
+                 connect_timeout=IPFS_CONNECT_TIMEOUT, read_timeout=IPFS_READ_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # No transparent retries: pin/unpin callers decide what a failure means
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, path, read_timeout=None, missing_ok=False, **kwargs):
+        timeout = (self.timeout[0], read_timeout) if read_timeout else self.timeout
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise IPFSClientError(f"{method} {path} failed: {e}") from e
+
+        if missing_ok and response.status_code == 404:
+            return None
+        if response.status_code >= 400:
+            raise IPFSClientError(f"{method} {path} returned {response.status_code}: {response.text.strip()}")
+        return response
+
+    @staticmethod
+    def _ndjson(response):
+        """Parse a body that may be a JSON array, a single object or newline-delimited objects."""
+        text = response.text.strip()
+        if not text:
+            return []
+        try:
+            data = json.loads(text)
+            return data if isinstance(data, list) else [data]
+        except ValueError:
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class KuboClient(_PooledClient):
+    """Kubo RPC API (/api/v0). Every RPC call is a POST."""
+
+    def add(self, chunks, filename="file", pin=True, read_timeout=IPFS_ADD_TIMEOUT):
+        """
+        Stream content into /api/v0/add with chunked transfer encoding.
+
+        Args:
+            chunks: Iterable of bytes
+            filename: Name sent in the multipart header
+            pin: Pin on this node, so GC cannot reclaim it before the cluster has a copy
+            read_timeout: Seconds to wait for Kubo's answer
+
+        Returns:
+            str: Root CID
+        """
+        boundary = os.urandom(16).hex()
+        filename = filename.replace('"', "")
+
+        def body():
+            yield (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n"
+            ).encode("utf-8")
+            yield from chunks
+            yield f"\r\n--{boundary}--\r\n".encode("ascii")
+
+        response = self._request(
+            "POST", "/api/v0/add",
+            read_timeout=read_timeout,
+            params={"quieter": "true", "pin": str(pin).lower(), "progress": "false"},
+            data=body(),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+
+        # Kubo answers with one JSON object per added entry; the root is last
+        entries = self._ndjson(response)
+        if not entries or "Hash" not in entries[-1]:
+            raise IPFSClientError(f"Unexpected add response from Kubo: {response.text.strip()}")
+        return entries[-1]["Hash"]
+
+    def pin_rm(self, cid):
+        """Remove this node's recursive pin on a CID (`ipfs pin rm`)."""
+        return self._request("POST", "/api/v0/pin/rm", params={"arg": cid}).json()
+
+    def id(self, read_timeout=None):
+        """Node identity (`ipfs id`)."""
+        return self._request("POST", "/api/v0/id", read_timeout=read_timeout).json()
+
+    def swarm_peers(self, read_timeout=None):
+        """Connected swarm peers (`ipfs swarm peers`)."""
+        return self._request("POST", "/api/v0/swarm/peers", read_timeout=read_timeout).json().get("Peers") or []
+
+
+class ClusterClient(_PooledClient):
+    """IPFS Cluster REST API."""
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(base_url, **kwargs)
+        if IPFS_CLUSTER_BASIC_AUTH:
+            self.session.auth = tuple(IPFS_CLUSTER_BASIC_AUTH.split(":", 1))
+
+    def pin_add(self, cid, replication_min=None, replication_max=None):
+        """
+        Pin a CID across the cluster (`ipfs-cluster-ctl pin add`).
+
+        Args:
+            cid: Content identifier
+            replication_min: Minimum replica count (cluster default if None)
+            replication_max: Maximum replica count (cluster default if None)
+
+        Returns:
+            dict: Pin object as returned by the cluster
+        """
+        params = {}
+        if replication_min is not None:
+            params["replication-min"] = replication_min
+        if replication_max is not None:
+            params["replication-max"] = replication_max
+        return self._request("POST", f"/pins/{cid}", params=params).json()
+
+    def pin_rm(self, cid):
+        """Unpin a CID from the cluster (`ipfs-cluster-ctl pin rm`)."""
+        return self._request("DELETE", f"/pins/{cid}").json()
+
+    def pin_status(self, cid):
+        """
+        Per-peer status of a CID (`ipfs-cluster-ctl status`).
+
+        Returns:
+            dict: peer_map of cluster peer ID -> {ipfs_peer_id, status, ...};
+            peers not allocated to the CID report "remote". None if the
+            cluster does not track the CID.
+        """
+        response = self._request("GET", f"/pins/{cid}", missing_ok=True)
+        return None if response is None else response.json().get("peer_map") or {}
+
+    def pin_ls(self, read_timeout=None):
+        """
+        Every pin in the cluster's shared state (`ipfs-cluster-ctl pin ls`), streamed.
+
+        Cluster >= 1.0 answers newline-delimited objects, read one line at a
+        time so memory stays flat; an older cluster's JSON array is parsed whole.
+
+        Yields:
+            dict: Pin object (cid, replication_factor_min/max, allocations, timestamp, ...)
+        """
+        response = self._request("GET", "/allocations", read_timeout=read_timeout,
+                                 params={"filter": "pin"}, stream=True)
+        try:
+            lines = response.iter_lines()
+            for line in lines:
+                if not line.strip():
+                    continue
+                if line.lstrip().startswith(b"["):
+                    yield from json.loads(line + b"".join(lines))
+                    return
+                yield json.loads(line)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise IPFSClientError(f"GET /allocations failed mid-stream: {e}") from e
+        finally:
+            response.close()
+
+    def peers(self, read_timeout=None):
+        """Cluster peers (`ipfs-cluster-ctl peers ls`)."""
+        return self._ndjson(self._request("GET", "/peers", read_timeout=read_timeout))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name, factory):
+    # Connection pools must not be shared across fork(), so clients are per process
+    key = (name, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
+
+
+def get_kubo_client():
+    """Shared KuboClient for this process."""
+    return _get_client("kubo", lambda: KuboClient(IPFS_API_URL))
+
+
+def get_cluster_client():
+    """Shared ClusterClient for this process."""
+    return _get_client("cluster", lambda: ClusterClient(IPFS_CLUSTER_API))
@@ -0,0 +1,308 @@
+"""
+Streaming Upload Module
+Forwards multipart uploads straight from the request body to Kubo /api/v0/add
+No temp files - size is counted in flight and the CID comes back from Kubo
+Uploads stay pinned on the receiving node until the cluster holds a copy elsewhere (upload_pins)
+"""
+
+from datetime import datetime, timedelta
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Preamble, Field, File, Data, Epilogue, NeedData
+from .models import db
+from .ipfs_client import get_kubo_client, get_cluster_client, IPFSClientError
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024      # 1 MiB read from the client per step
+MAX_FORM_FIELD_BYTES = 64 * 1024     # Plain form fields (retention_months, private, ...) are tiny
+UPLOAD_PIN_BATCH = 500               # Upload pins looked at per release_upload_pins() run
+UPLOAD_PIN_REJECTED_AFTER = timedelta(hours=1)  # Still wanted by no pin or backup: the upload was rejected
+UPLOAD_PIN_STUCK_AFTER = timedelta(days=1)      # Wanted, but still no other cluster copy: reported
+
+
+class UploadFormatError(Exception):
+    """The request body is not a usable multipart/form-data upload."""
+
+
+class StreamingUpload:
+    """
+    Walks a multipart/form-data request body one chunk at a time.
+
+    Plain form fields are collected into `fields`. The file part is exposed
+    through iter_file() so it can be forwarded without ever touching disk;
+    `size_bytes` counts the bytes as they pass. Memory use is bounded by
+    UPLOAD_CHUNK_SIZE regardless of the upload size.
+    """
+
+    def __init__(self, stream, content_type, chunk_size=UPLOAD_CHUNK_SIZE):
+        mimetype, options = parse_options_header(content_type or "")
+        boundary = options.get("boundary")
+        if mimetype != "multipart/form-data" or not boundary:
+            raise UploadFormatError("Expected a multipart/form-data upload")
+
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = MultipartDecoder(boundary.encode("latin-1"))
+        self._events = self._iter_events()
+        self._first_chunk = b""
+        self._file_done = False
+
+        self.fields = {}
+        self.filename = None
+        self.size_bytes = 0
+        self.cid = None
+
+    def _iter_events(self):
+        """Yield decoder events, reading from the client only when the decoder needs more data."""
+        while True:
+            event = self._decoder.next_event()
+            if isinstance(event, NeedData):
+                data = self._stream.read(self._chunk_size)
+                # An empty read means the body is complete (None tells the decoder so)
+                self._decoder.receive_data(data or None)
+                continue
+            if isinstance(event, Epilogue):
+                return
+            if not isinstance(event, Preamble):
+                yield event
+
+    def _next_event(self):
+        try:
+            return next(self._events, None)
+        except ValueError as e:
+            raise UploadFormatError(f"Malformed multipart body: {e}") from e
+
+    def _read_field(self, name):
+        """Collect the value of a plain form field."""
+        parts = []
+        size = 0
+        while True:
+            event = self._next_event()
+            if not isinstance(event, Data):
+                raise UploadFormatError(f"Truncated form field: {name}")
+            size += len(event.data)
+            if size > MAX_FORM_FIELD_BYTES:
+                raise UploadFormatError(f"Form field too large: {name}")
+            parts.append(event.data)
+            if not event.more_data:
+                break
+        self.fields[name] = b"".join(parts).decode("utf-8", "replace")
+
+    def _skip_part(self):
+        while True:
+            event = self._next_event()
+            if not isinstance(event, Data):
+                raise UploadFormatError("Truncated multipart part")
+            if not event.more_data:
+                return
+
+    def next_file(self, field_name="file"):
+        """
+        Advance to the file part named `field_name`, collecting form fields on the way.
+
+        The first chunk of file data is read ahead so empty files can be
+        rejected before anything is sent to Kubo.
+
+        Returns:
+            bool: True if the file part was found
+        """
+        while True:
+            event = self._next_event()
+            if event is None:
+                return False
+            if isinstance(event, Field):
+                self._read_field(event.name)
+            elif isinstance(event, File) and event.name == field_name:
+                self.filename = event.filename
+                break
+            else:
+                self._skip_part()
+
+        # Read ahead until the first non-empty chunk (or the end of the part)
+        while True:
+            event = self._next_event()
+            if not isinstance(event, Data):
+                raise UploadFormatError("Truncated file part")
+            if event.data or not event.more_data:
+                self._first_chunk = event.data
+                self._file_done = not event.more_data
+                return True
+
+    @property
+    def is_empty(self):
+        return self._file_done and not self._first_chunk
+
+    def iter_file(self):
+        """Yield the file contents chunk by chunk, counting bytes as they pass."""
+        if self._first_chunk:
+            self.size_bytes += len(self._first_chunk)
+            yield self._first_chunk
+            self._first_chunk = b""
+
+        while not self._file_done:
+            event = self._next_event()
+            if not isinstance(event, Data):
+                raise UploadFormatError("Truncated file part")
+            self._file_done = not event.more_data
+            if event.data:
+                self.size_bytes += len(event.data)
+                yield event.data
+
+    def finish(self):
+        """Consume the rest of the body so fields sent after the file are available."""
+        # Drain any part of the file the caller did not read
+        for _ in self.iter_file():
+            pass
+
+        while True:
+            event = self._next_event()
+            if event is None:
+                return self.fields
+            if isinstance(event, Field):
+                self._read_field(event.name)
+            else:
+                self._skip_part()
+
+
+def add_to_kubo(upload):
+    """
+    Stream the current file part of `upload` into Kubo's /api/v0/add.
+
+    Kubo starts hashing while the client is still uploading. Content is
+    pinned on this node (Kubo runs with --enable-gc and the cluster pin is
+    asynchronous) and recorded in upload_pins; release_upload_pins() drops
+    the local pin once the cluster has its own copy, or the upload was rejected.
+
+    Args:
+        upload: StreamingUpload positioned on a file part (see next_file)
+
+    Returns:
+        str: Root CID of the added file
+    """
+    cid = get_kubo_client().add(upload.iter_file(), filename=upload.filename or "file")
+    hold_upload_pin(cid)
+    return cid
+
+
+def hold_upload_pin(cid):
+    """Record the local pin of a fresh upload, in its own transaction so a rejected request cannot roll it back."""
+    with db.engine.begin() as connection:
+        connection.execute(db.text("""
+            INSERT INTO upload_pins (cid, added_at) VALUES (:cid, :now)
+            ON CONFLICT (cid) DO UPDATE SET added_at = EXCLUDED.added_at
+        """), {"cid": cid, "now": datetime.utcnow()})
+
+
+def stream_upload_to_kubo(req, field_name="file"):
+    """
+    Parse a multipart upload request and stream its file into Kubo in one pass.
+
+    Args:
+        req: Flask request (its form/files must not have been accessed)
+        field_name: Name of the file part
+
+    Returns:
+        StreamingUpload: with `filename`, `size_bytes`, `fields` and `cid` set.
+        `cid` is None when the file is empty (nothing is sent to Kubo).
+
+    Raises:
+        UploadFormatError: body is not a usable upload (missing part, malformed)
+        IPFSClientError: Kubo failed to add the content
+    """
+    upload = StreamingUpload(req.stream, req.content_type)
+    if not upload.next_file(field_name):
+        raise UploadFormatError("No file part in the request")
+    if not upload.filename:
+        raise UploadFormatError("No selected file")
+
+    if not upload.is_empty:
+        upload.cid = add_to_kubo(upload)
+    upload.finish()
+    return upload
+
+
+def _release_upload_pin(kubo, cluster, local_peer, row, rejected_before):
+    """
+    Returns:
+        bool: True if the local pin is gone (or was the cluster's) and the row can be deleted
+    """
+    peers = list((cluster.pin_status(row.cid) or {}).values())
+    local = [peer for peer in peers if peer.get("ipfs_peer_id") == local_peer]
+    if local and local[0].get("status") != "remote":
+        return True  # The cluster allocated this node: the pin we hold is the cluster's
+    if row.wanted and not any(peer.get("status") == "pinned" for peer in peers if peer not in local):
+        return False  # No other copy yet
+    if not row.wanted and row.added_at >= rejected_before:
+        return False  # The request may still be committing its pin or backup
+    try:
+        kubo.pin_rm(row.cid)
+    except IPFSClientError as e:
+        if "not pinned" not in str(e):
+            raise
+    return True
+
+
+def release_upload_pins(batch=UPLOAD_PIN_BATCH):
+    """
+    Drop the local pins of uploads the cluster no longer needs from this node.
+
+    A wanted upload (queued/pinning/pinned pin or active cluster backup) is
+    released once another cluster peer reports it pinned. An unwanted one is
+    released after UPLOAD_PIN_REJECTED_AFTER. Kubo pins are not reference
+    counted, so when the cluster allocated the CID to this very node the pin
+    is the cluster's and is left alone; only the bookkeeping row goes.
+
+    Every row is looked at on each run, `batch` at a time in (added_at, cid)
+    order, so rows that must wait never hold back the ones behind them. A
+    wanted upload with no other copy is never released (it may be the only
+    one); past UPLOAD_PIN_STUCK_AFTER it is reported, since it needs a
+    cluster re-pin (see reconcile) rather than more waiting.
+
+    Returns:
+        int: Upload pins released
+    """
+    kubo = cluster = local_peer = None
+    now = datetime.utcnow()
+    rejected_before = now - UPLOAD_PIN_REJECTED_AFTER
+    stuck_before = now - UPLOAD_PIN_STUCK_AFTER
+    seen = released = 0
+    stuck = []
+    last = None
+    while True:
+        rows = db.session.execute(db.text(f"""
+            SELECT u.cid, u.added_at,
+                   EXISTS (SELECT 1 FROM pins p WHERE p.cid = u.cid AND p.status IN ('queued', 'pinning', 'pinned'))
+                   OR EXISTS (SELECT 1 FROM cluster_backups b WHERE b.cid = u.cid AND b.status = 'active') AS wanted
+              FROM upload_pins u
+             {"WHERE (u.added_at, u.cid) > (:last_added_at, :last_cid)" if last else ""}
+             ORDER BY u.added_at, u.cid
+             LIMIT :batch
+        """), {"batch": batch, "last_added_at": last and last.added_at, "last_cid": last and last.cid}).fetchall()
+        db.session.commit()
+        if not rows:
+            break
+        last = rows[-1]
+        seen += len(rows)
+
+        if kubo is None:
+            kubo, cluster = get_kubo_client(), get_cluster_client()
+            local_peer = kubo.id()["ID"]
+        done = []
+        for row in rows:
+            try:
+                if _release_upload_pin(kubo, cluster, local_peer, row, rejected_before):
+                    done.append({"cid": row.cid, "added_at": row.added_at})
+                elif row.wanted and row.added_at < stuck_before:
+                    stuck.append(row.cid)
+            except IPFSClientError as e:
+                print(f"Could not release upload pin {row.cid}: {e}")
+
+        if done:
+            # A re-upload of the same CID meanwhile refreshed added_at: keep that row
+            db.session.execute(db.text("DELETE FROM upload_pins WHERE cid = :cid AND added_at = :added_at"), done)
+            db.session.commit()
+            released += len(done)
+
+    if stuck:
+        print(f"{len(stuck)} uploads wanted for over {UPLOAD_PIN_STUCK_AFTER} have no other cluster copy "
+              f"and stay pinned here, e.g. {stuck[:5]}")
+    print(f"Released {released} of {seen} upload pins.")
+    return released
@@ -44,6 +44,15 @@ class Pin(db.Model):
     grace_period_started_at = db.Column(db.DateTime, nullable=True)
     retention_months = db.Column(db.Integer, default=1, nullable=False)
 
+    __table_args__ = (
+        # Keyset pagination (pin_listing): each filter gets an index ending in the (created_at, id) sort key
+        db.Index('ix_pins_user_created_id', 'user_id', 'created_at', 'id'),  # Also dashboard totals and recent pins
+        db.Index('ix_pins_user_status_created_id', 'user_id', 'status', 'created_at', 'id'),
+        db.Index('ix_pins_user_private_created_id', 'user_id', 'is_private', 'created_at', 'id'),
+        db.Index('ix_pins_user_cid_prefix', 'user_id', 'cid', postgresql_ops={'cid': 'varchar_pattern_ops'}),
+        db.Index('ix_pins_expire_at_pinned', 'expire_at', postgresql_where=db.text("status = 'pinned'")),  # Expiration deadlines
+    )
+
 
 class ClusterBackup(db.Model):
     __tablename__ = 'cluster_backups'
@@ -59,6 +68,12 @@ class ClusterBackup(db.Model):
     expire_at = db.Column(db.DateTime, nullable=True)
     already_charged = db.Column(db.Boolean, default=False, nullable=False)
     grace_period_started_at = db.Column(db.DateTime, nullable=True)
+    last_billed_at = db.Column(db.DateTime, nullable=True)  # End of the last period charged by cluster_billing
+
+    __table_args__ = (
+        db.Index('ix_cluster_backups_user_created', 'user_id', 'created_at'),  # Dashboard totals and recent backups
+        db.Index('ix_cluster_backups_expire_at_active', 'expire_at', postgresql_where=db.text("status = 'active'")),  # Expiration deadlines
+    )
 
 
 class Payment(db.Model):
@@ -86,3 +101,185 @@ class ReplicaHistory(db.Model):
     backup_id = db.Column(db.Integer, db.ForeignKey('cluster_backups.id'), nullable=False)
     replica_count = db.Column(db.Integer, nullable=False)
     changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class PinJob(db.Model):
+    """Durable queue entry driving a Pin through queued -> pinning -> pinned/error."""
+    __tablename__ = 'pin_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    pin_id = db.Column(db.Integer, db.ForeignKey('pins.id', ondelete='CASCADE'), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    refund_eur = db.Column(db.Numeric(16, 8), nullable=False, default=0.00)  # Upfront charge returned if pinning fails for good
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    pin = db.relationship('Pin', backref=db.backref('job', uselist=False, passive_deletes=True))
+
+    __table_args__ = (
+        db.Index('ix_pin_jobs_ready', 'run_after', postgresql_where=db.text("status = 'queued'")),
+    )
+
+
+class UploadPin(db.Model):
+    """Upload pinned on the Kubo node that received it, until the cluster holds it elsewhere (see ipfs_upload)."""
+    __tablename__ = 'upload_pins'
+    cid = db.Column(db.String(255), primary_key=True)
+    added_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_upload_pins_added_cid', 'added_at', 'cid'),  # release_upload_pins keyset order
+    )
+
+
+class TokenRevocation(db.Model):
+    """Capability tokens for this access hash (and CID, if set) issued before revoked_at are void."""
+    __tablename__ = 'token_revocations'
+    id = db.Column(db.Integer, primary_key=True)
+    access_hash_fingerprint = db.Column(db.String(64), nullable=False)
+    cid = db.Column(db.String(255), nullable=True)  # NULL revokes every token of the user
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+class BandwidthUsage(db.Model):
+    """Gateway traffic rolled up per user, CID and time window (written by bandwidth_ingest)."""
+    __tablename__ = 'bandwidth_usage'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)  # No FK: usage history outlives deleted accounts
+    cid = db.Column(db.String(255), nullable=False)
+    is_private = db.Column(db.Boolean, nullable=False)
+    window_start = db.Column(db.DateTime, nullable=False)
+    requests = db.Column(db.Integer, nullable=False, default=0)
+    bytes_transferred = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'window_start', 'cid', 'is_private', name='uq_bandwidth_usage_window'),
+        db.Index('ix_bandwidth_usage_window_start', 'window_start'),  # Daily usage snapshots
+    )
+
+
+class LogIngestCheckpoint(db.Model):
+    """How far a log file has been ingested; advanced in the same transaction as the usage it produced."""
+    __tablename__ = 'log_ingest_checkpoints'
+    source = db.Column(db.String(255), primary_key=True)  # Log path
+    inode = db.Column(db.BigInteger, nullable=True)
+    byte_offset = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class BalanceLedger(db.Model):
+    """
+    Append-only record of every balance credit (+) and debit (-).
+    users.*_balance_eur are the materialized projection of these rows.
+    """
+    __tablename__ = 'balance_ledger'
+    id = db.Column(db.BigInteger, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)  # No FK: the audit trail outlives deleted accounts
+    account = db.Column(db.String(20), nullable=False)  # credit, kubo, cluster
+    amount_eur = db.Column(db.Numeric(16, 8), nullable=False)
+    entry_type = db.Column(db.String(30), nullable=False)  # payment, pin_charge, bandwidth, cluster_billing, backup_billing, refund
+    reference = db.Column(db.String(255), nullable=True)  # tx id, CID, billing period, ...
+    applied = db.Column(db.Boolean, nullable=False, default=False)  # Already reflected in the users row
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_balance_ledger_user_created', 'user_id', 'created_at'),
+        db.Index('ix_balance_ledger_created', 'created_at'),
+        db.Index('ix_balance_ledger_pending', 'user_id', postgresql_where=db.text('NOT applied')),
+    )
+
+
+class BillingRun(db.Model):
+    """One cluster billing run, split into user id-range shards that commit separately."""
+    __tablename__ = 'billing_runs'
+    id = db.Column(db.Integer, primary_key=True)
+    billed_until = db.Column(db.DateTime, nullable=False)  # End of every period the run charges, kept on resume
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, done
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    shards = db.relationship('BillingRunShard', backref='run', lazy='dynamic')
+
+
+class BillingRunShard(db.Model):
+    """Users [user_id_from, user_id_to) of a billing run. 'done' is committed with the shard's charges."""
+    __tablename__ = 'billing_run_shards'
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('billing_runs.id'), nullable=False, index=True)
+    user_id_from = db.Column(db.Integer, nullable=False)
+    user_id_to = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, done
+    users_billed = db.Column(db.Integer, nullable=False, default=0)
+    backups_billed = db.Column(db.Integer, nullable=False, default=0)
+    amount_eur = db.Column(db.Numeric(16, 8), nullable=False, default=0)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class UsageSnapshot(db.Model):
+    """One row per user per day (written by usage_snapshots): storage at the end of the day, traffic and charges during it."""
+    __tablename__ = 'usage_snapshots'
+    user_id = db.Column(db.Integer, primary_key=True)  # No FK: usage history outlives deleted accounts
+    day = db.Column(db.Date, primary_key=True)
+    pins = db.Column(db.Integer, nullable=False, default=0)
+    pinned_public_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    pinned_private_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    cluster_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    cluster_replica_bytes = db.Column(db.BigInteger, nullable=False, default=0)  # size × replicas, what is billed
+    bandwidth_public_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    bandwidth_private_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    charges_eur = db.Column(db.Numeric(16, 8), nullable=False, default=0)  # Ledger debits of the day
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class PaymentAddress(db.Model):
+    """
+    A SatSale invoice created ahead of time (payment_addresses).
+    Pooled while user_id is NULL, then handed to one user until it expires.
+    """
+    __tablename__ = 'payment_addresses'
+    id = db.Column(db.Integer, primary_key=True)
+    reference = db.Column(db.String(64), unique=True, nullable=False)  # In the invoice webhook URL, resolves the payer
+    satsale_uuid = db.Column(db.String(255), nullable=True)
+    address = db.Column(db.String(255), nullable=False)
+    payment_uri = db.Column(db.String(512), nullable=True)
+    amount_eur = db.Column(db.Numeric(16, 8), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    assigned_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    paid_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_payment_addresses_pool', 'expires_at', postgresql_where=db.text('user_id IS NULL')),
+        db.Index('ix_payment_addresses_user', 'user_id', 'expires_at'),
+    )
+
+
+class ClusterPinOutcome(db.Model):
+    """Result of one cluster unpin / re-pin made by a cleanup job, kept for retries and audits."""
+    __tablename__ = 'cluster_pin_outcomes'
+    id = db.Column(db.BigInteger, primary_key=True)
+    job = db.Column(db.String(50), nullable=False)  # pin_expiration, backup_expiration, grace_unpin, grace_repin, account_deletion, reconcile_*
+    cid = db.Column(db.String(255), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)  # No FK: outcomes outlive deleted users
+    succeeded = db.Column(db.Boolean, nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_cluster_pin_outcomes_failed', 'cid', postgresql_where=db.text('NOT succeeded')),
+    )
+
+
+class TaskRun(db.Model):
+    """Last run of each scheduled task (one row per task, written by the scheduler)."""
+    __tablename__ = 'task_runs'
+    name = db.Column(db.String(100), primary_key=True)
+    status = db.Column(db.String(20), nullable=False)  # running, ok, failed
+    host = db.Column(db.String(255), nullable=True)    # hostname:pid of the node that ran it
+    started_at = db.Column(db.DateTime, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration_seconds = db.Column(db.Float, nullable=True)
+    rows_touched = db.Column(db.BigInteger, nullable=True)
+    error = db.Column(db.Text, nullable=True)
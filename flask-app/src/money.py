@@ -0,0 +1,70 @@
+"""
+Money Module
+Integer fixed-point arithmetic for billing: amounts in nano-euros, sizes in bytes, time in microseconds
+Every amount is rounded once, where it is produced, to the nearest nano-euro (halves away from zero, like Postgres round())
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import timedelta
+
+NANOS_PER_EUR = 10 ** 9
+BYTES_PER_GB = 1024 * 1024 * 1024
+MICROS_PER_DAY = 86400 * 10 ** 6
+DAYS_PER_MONTH = 30  # Dashboard projections: a month of daily costs
+
+
+def div_round(numerator, denominator):
+    """Integer division rounded to nearest, halves away from zero."""
+    quotient, remainder = divmod(abs(numerator), denominator)
+    if 2 * remainder >= denominator:
+        quotient += 1
+    return quotient if numerator >= 0 else -quotient
+
+
+def to_nanos(eur):
+    """
+    Convert a euro amount (Decimal, str or int) to integer nano-euros.
+    Digits beyond the ninth decimal are rounded half away from zero.
+    """
+    return int((Decimal(eur) * NANOS_PER_EUR).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def to_eur(nanos, places=9):
+    """
+    Convert nano-euros to a Decimal euro amount with `places` decimals.
+
+    Pass the precision of the column the amount is written to (2 for the
+    kubo/cluster balances, 8 for the credit balance and the ledger), so the
+    rounding happens here, once, and not silently in the database.
+    """
+    step = 10 ** (9 - places)
+    return Decimal(div_round(nanos, step)).scaleb(-places)
+
+
+def micros(duration):
+    """Whole microseconds in a timedelta (exact, unlike total_seconds())."""
+    return duration // timedelta(microseconds=1)
+
+
+def storage_cost(byte_days_micros, rate_per_gb_day):
+    """
+    Cost of storage priced per GB per day.
+
+    Args:
+        byte_days_micros: Sum of size_bytes × replicas × microseconds stored
+        rate_per_gb_day: Price in nano-euros per GB per day
+
+    Returns:
+        int: nano-euros
+    """
+    return div_round(byte_days_micros * rate_per_gb_day, BYTES_PER_GB * MICROS_PER_DAY)
+
+
+def gb_cost(size_bytes, rate_per_gb):
+    """Cost of `size_bytes` priced per GB (transfer, or a month of storage), in nano-euros."""
+    return div_round(size_bytes * rate_per_gb, BYTES_PER_GB)
+
+
+def bytes_to_gb(size_bytes):
+    """Decimal GB, for display and the *_gb usage columns."""
+    return Decimal(size_bytes) / Decimal(BYTES_PER_GB)
@@ -0,0 +1,192 @@
+"""
+Payment Address Module
+Keeps a pool of SatSale invoices created ahead of time and hands one to each user
+Pages read invoices from Postgres only: SatSale is called by a background refiller, never inline
+"""
+
+import os
+import secrets
+import logging
+import threading
+import requests
+from datetime import datetime, timedelta
+from decimal import Decimal
+from flask import current_app
+from .models import db, PaymentAddress
+
+SATSALE_API_URL = os.getenv("SATSALE_API_URL", "http://localhost:8000")
+SATSALE_WEBHOOK_URL = os.getenv("SATSALE_WEBHOOK_URL", "http://localhost:5003/webhook/satsale")
+SATSALE_INVOICE_EUR = Decimal(os.getenv("SATSALE_INVOICE_EUR", "10"))           # Suggested top-up per invoice
+SATSALE_INVOICE_TTL = int(os.getenv("SATSALE_INVOICE_TTL", "3600"))             # seconds, SatSale payment timeout
+SATSALE_POOL_SIZE = int(os.getenv("SATSALE_POOL_SIZE", "20"))                   # Unassigned invoices kept ready
+SATSALE_REFILL_SECONDS = float(os.getenv("SATSALE_REFILL_SECONDS", "30"))
+SATSALE_TIMEOUT = 10
+INVOICE_MIN_REMAINING = timedelta(minutes=10)   # Never hand out an invoice about to expire
+INVOICE_RETENTION = timedelta(days=7)           # Expired invoices are kept this long for late webhooks
+_REFILL_LOCK = 0x5A75A1E                        # pg advisory lock key: one refiller at a time
+
+_refill_wanted = threading.Event()
+_refiller_lock = threading.Lock()
+_refiller_pid = None
+
+
+def get_payment_address(user_id):
+    """
+    The user's open invoice, or a fresh one from the pool. Database only.
+
+    Args:
+        user_id: User ID
+
+    Returns:
+        PaymentAddress, or None while the pool is empty (the refiller is woken up)
+    """
+    _ensure_invoice_refiller()
+    fresh = datetime.utcnow() + INVOICE_MIN_REMAINING
+
+    cached = PaymentAddress.query.filter(
+        PaymentAddress.user_id == user_id,
+        PaymentAddress.paid_at == None,
+        PaymentAddress.expires_at > fresh
+    ).order_by(PaymentAddress.expires_at.desc()).first()
+    if cached:
+        return cached
+
+    claimed = db.session.execute(db.text("""
+        UPDATE payment_addresses
+           SET user_id = :user_id, assigned_at = now() AT TIME ZONE 'utc'
+         WHERE id = (
+               SELECT id FROM payment_addresses
+                WHERE user_id IS NULL AND expires_at > :fresh
+                ORDER BY expires_at DESC
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED)
+        RETURNING id
+    """), {"user_id": user_id, "fresh": fresh}).scalar()
+    db.session.commit()
+    _refill_wanted.set()
+    if claimed is None:
+        logging.warning(f"Payment address pool is empty, no invoice for user {user_id} yet")
+        return None
+    return PaymentAddress.query.get(claimed)
+
+
+def payment_details(payment_address):
+    """bitcoin_address / payment_uri / qr_code_url for API responses (all None without an invoice)."""
+    if payment_address is None:
+        return {"bitcoin_address": None, "payment_uri": None, "qr_code_url": None}
+    return {
+        "bitcoin_address": payment_address.address,
+        "payment_uri": payment_address.payment_uri,
+        "qr_code_url": f"{SATSALE_API_URL}/api/qr/{payment_address.address}"
+    }
+
+
+def create_invoice():
+    """
+    Ask SatSale for one invoice. Its webhook URL carries our reference, so
+    the invoice can be handed to any user later.
+
+    Returns:
+        PaymentAddress (not yet added to the session)
+
+    Raises:
+        requests.RequestException, ValueError: SatSale failed or returned no address
+    """
+    reference = secrets.token_urlsafe(24)
+    response = requests.get(f"{SATSALE_API_URL}/api/createpayment", params={
+        "amount": str(SATSALE_INVOICE_EUR),
+        "currency": "EUR",
+        "method": "onchain",
+        "w_url": f"{SATSALE_WEBHOOK_URL}?invoice={reference}"
+    }, timeout=SATSALE_TIMEOUT)
+    response.raise_for_status()
+    payment_data = response.json()
+    # SatSale returns address nested in 'invoice' key
+    invoice = payment_data.get("invoice") or {}
+    if not invoice.get("address"):
+        raise ValueError(f"No invoice address in SatSale response: {payment_data}")
+    return PaymentAddress(
+        reference=reference,
+        satsale_uuid=invoice.get("uuid"),
+        address=invoice["address"],
+        payment_uri=payment_data.get("payment_uri"),
+        amount_eur=SATSALE_INVOICE_EUR,
+        expires_at=datetime.utcnow() + timedelta(seconds=SATSALE_INVOICE_TTL)
+    )
+
+
+def refill_invoice_pool(target=SATSALE_POOL_SIZE):
+    """
+    Top the pool up to `target` usable invoices, one SatSale call per
+    transaction, and drop invoices expired for longer than INVOICE_RETENTION.
+    Only one process refills at a time (advisory lock); the others return.
+
+    Returns:
+        int: Invoices created
+    """
+    created = 0
+    while True:
+        if not db.session.execute(db.text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": _REFILL_LOCK}).scalar():
+            db.session.rollback()
+            return created
+        if created == 0:
+            PaymentAddress.query.filter(
+                PaymentAddress.paid_at == None,
+                PaymentAddress.expires_at < datetime.utcnow() - INVOICE_RETENTION
+            ).delete(synchronize_session=False)
+        ready = PaymentAddress.query.filter(
+            PaymentAddress.user_id == None,
+            PaymentAddress.expires_at > datetime.utcnow() + INVOICE_MIN_REMAINING
+        ).count()
+        if ready >= target:
+            db.session.commit()
+            return created
+        db.session.add(create_invoice())
+        db.session.commit()
+        created += 1
+
+
+def _refill_loop(app):
+    """Background thread: refill every SATSALE_REFILL_SECONDS, or sooner when an invoice is handed out."""
+    while True:
+        with app.app_context():
+            try:
+                created = refill_invoice_pool()
+                if created:
+                    logging.info(f"Added {created} SatSale invoices to the payment address pool")
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Payment address pool refill failed: {e}")
+            finally:
+                db.session.remove()
+        _refill_wanted.wait(SATSALE_REFILL_SECONDS)
+        _refill_wanted.clear()
+
+
+def _ensure_invoice_refiller():
+    # One refiller thread per process (threads do not survive fork)
+    global _refiller_pid
+    if _refiller_pid == os.getpid():
+        return
+    with _refiller_lock:
+        if _refiller_pid == os.getpid():
+            return
+        threading.Thread(target=_refill_loop, args=(current_app._get_current_object(),), daemon=True,
+                         name="payment-address-refill").start()
+        _refiller_pid = os.getpid()
+
+
+def mark_invoice_paid(reference):
+    """
+    Resolve a webhook's invoice reference and mark the invoice paid.
+    Added to the caller's session.
+
+    Returns:
+        PaymentAddress, or None if the reference is unknown or was never handed out
+    """
+    payment_address = PaymentAddress.query.filter_by(reference=reference).first()
+    if payment_address is None or payment_address.user_id is None:
+        return None
+    if payment_address.paid_at is None:
+        payment_address.paid_at = datetime.utcnow()
+    return payment_address
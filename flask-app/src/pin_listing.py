@@ -0,0 +1,161 @@
+"""
+Pin Listing Module
+Keyset (cursor) pagination over a user's pins, newest first, ordered by (created_at, id)
+Every page is an index range scan: no OFFSET, no COUNT(*)
+"""
+
+import re
+import json
+import base64
+from datetime import datetime
+from sqlalchemy import tuple_
+from sqlalchemy.dialects import postgresql
+from .models import db, Pin
+
+PIN_PAGE_DEFAULT = 50
+PIN_PAGE_MAX = 500
+PIN_STATUSES = {'queued', 'pinning', 'pinned', 'error', 'grace_period'}
+_CID_PREFIX = re.compile(r'^[A-Za-z0-9]{1,100}$')  # base32 / base58 only, so it is LIKE-safe
+
+
+class CursorError(ValueError):
+    """A cursor that we did not issue (or that was tampered with)."""
+
+
+def encode_cursor(pin):
+    """Opaque cursor pointing just past `pin` in (created_at DESC, id DESC) order."""
+    raw = json.dumps([pin.created_at.isoformat(), pin.id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Returns:
+        tuple: (created_at, id)
+
+    Raises:
+        CursorError: The cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, pin_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(pin_id)
+    except (ValueError, TypeError) as e:
+        raise CursorError(f"Invalid cursor: {cursor}") from e
+
+
+def pin_filters(user_id, status=None, is_private=None, cid_prefix=None):
+    """
+    Filtered (but not yet paged) query over a user's pins.
+
+    Args:
+        user_id: User ID
+        status: Only pins in this status (see PIN_STATUSES)
+        is_private: True / False to keep only private / public pins, None for both
+        cid_prefix: Only CIDs starting with this (alphanumeric) string
+
+    Raises:
+        ValueError: Unknown status or a CID prefix with non-CID characters
+    """
+    query = Pin.query.filter(Pin.user_id == user_id)
+    if status is not None:
+        if status not in PIN_STATUSES:
+            raise ValueError(f"status must be one of {sorted(PIN_STATUSES)}")
+        query = query.filter(Pin.status == status)
+    if is_private is not None:
+        query = query.filter(Pin.is_private == is_private)
+    if cid_prefix:
+        if not _CID_PREFIX.match(cid_prefix):
+            raise ValueError("cid_prefix may only contain letters and digits")
+        query = query.filter(Pin.cid.like(f"{cid_prefix}%"))
+    return query
+
+
+def list_pins(query, limit=PIN_PAGE_DEFAULT, cursor=None):
+    """
+    One page of `query` (from pin_filters), newest first.
+
+    Fetches limit + 1 rows to learn whether another page exists, so no
+    separate count is needed.
+
+    Returns:
+        tuple: (pins, next_cursor) - next_cursor is None on the last page
+
+    Raises:
+        CursorError: The cursor is malformed
+    """
+    limit = max(1, min(limit, PIN_PAGE_MAX))
+    if cursor:
+        created_at, pin_id = decode_cursor(cursor)
+        # A row-value comparison is a single index condition: the scan starts right at the cursor
+        query = query.filter(tuple_(Pin.created_at, Pin.id) < (created_at, pin_id))
+    pins = query.order_by(Pin.created_at.desc(), Pin.id.desc()).limit(limit + 1).all()
+    if len(pins) <= limit:
+        return pins, None
+    pins = pins[:limit]
+    return pins, encode_cursor(pins[-1])
+
+
+def approximate_count(query):
+    """
+    The planner's row estimate for `query` (from pin_filters): free, but only
+    as fresh as the last ANALYZE. Good enough for "about 12,000 files".
+
+    Returns:
+        int
+    """
+    compiled = query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    plan = db.session.execute(db.text(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def pin_to_dict(pin):
+    """The JSON shape shared by the dashboard and the API listing."""
+    return {
+        "id": pin.id,
+        "cid": pin.cid,
+        "file_name": pin.file_name,
+        "size_bytes": pin.size_bytes,
+        "size_mb": round(pin.size_bytes / (1024 ** 2), 2),
+        "is_private": pin.is_private,
+        "status": pin.status,
+        "retention_months": pin.retention_months,
+        "created_at": pin.created_at.isoformat() if pin.created_at else None,
+        "expire_at": pin.expire_at.isoformat() if pin.expire_at else None,
+        "url": f"https://ipfs.datahosting.company/ipfs/{pin.cid}" if not pin.is_private else f"https://private.datahosting.company/ipfs/{pin.cid}"
+    }
+
+
+def pin_page_from_args(user_id, args):
+    """
+    Parse ?limit=&cursor=&status=&private=&cid_prefix=&total=approx and
+    return the page as a JSON-ready dict.
+
+    Raises:
+        ValueError: A bad filter, limit or cursor (CursorError is a ValueError)
+    """
+    private = args.get('private')
+    if private not in (None, 'true', 'false'):
+        raise ValueError("private must be true or false")
+    query = pin_filters(
+        user_id,
+        status=args.get('status'),
+        is_private=None if private is None else private == 'true',
+        cid_prefix=args.get('cid_prefix')
+    )
+    try:
+        limit = int(args.get('limit', args.get('per_page', PIN_PAGE_DEFAULT)))  # per_page: older dashboard clients
+    except ValueError:
+        raise ValueError("limit must be an integer") from None
+
+    pins, next_cursor = list_pins(query, limit=limit, cursor=args.get('cursor'))
+    page = {
+        "files": [pin_to_dict(pin) for pin in pins],
+        "next_cursor": next_cursor,
+        "has_next": next_cursor is not None
+    }
+    if args.get('total') == 'approx':
+        page["approximate_total"] = approximate_count(query)
+    return page
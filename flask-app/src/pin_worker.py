@@ -0,0 +1,156 @@
+"""
+Pin Worker Module
+Drains the pin_jobs queue in Postgres and pins CIDs to the IPFS Cluster
+Keeps slow cluster allocations out of the gunicorn request workers
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from .models import db, PinJob
+from .ipfs_client import get_cluster_client, IPFSClientError
+from .ipfs_access_control import invalidate_pin_access
+from .balances import credit_balance
+
+PIN_WORKER_THREADS = int(os.getenv("PIN_WORKER_THREADS", "8"))        # Concurrent cluster pin calls
+PIN_WORKER_BATCH = int(os.getenv("PIN_WORKER_BATCH", "32"))           # Jobs claimed per round trip
+PIN_WORKER_POLL_SECONDS = float(os.getenv("PIN_WORKER_POLL_SECONDS", "1"))
+PIN_JOB_MAX_ATTEMPTS = int(os.getenv("PIN_JOB_MAX_ATTEMPTS", "5"))
+PIN_JOB_RETRY_BASE_SECONDS = 30                                       # 30s, 60s, 120s, ...
+PIN_JOB_LEASE = timedelta(minutes=10)                                 # A running job older than this is requeued
+
+
+def enqueue_pin(pin, refund_eur):
+    """
+    Queue a pin for the worker pool. Added to the caller's session, so the
+    job commits atomically with the Pin row (and the upfront charge).
+
+    Args:
+        pin: Pin object with status 'queued'
+        refund_eur: Amount to give back if the pin ultimately fails
+    """
+    job = PinJob(pin=pin, status='queued', refund_eur=refund_eur)
+    db.session.add(job)
+    return job
+
+
+def claim_jobs(limit=PIN_WORKER_BATCH):
+    """
+    Claim ready jobs and move their pins to 'pinning' in one statement.
+    SKIP LOCKED lets any number of workers drain the queue without blocking each other.
+
+    Returns:
+        list: (job_id, pin_id, cid, attempts) tuples
+    """
+    rows = db.session.execute(db.text("""
+        WITH claimed AS (
+            UPDATE pin_jobs
+               SET status = 'running', locked_at = now() AT TIME ZONE 'utc', attempts = attempts + 1
+             WHERE id IN (
+                   SELECT id FROM pin_jobs
+                    WHERE status = 'queued' AND run_after <= now() AT TIME ZONE 'utc'
+                    ORDER BY run_after
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED)
+            RETURNING id, pin_id, attempts
+        )
+        UPDATE pins
+           SET status = 'pinning'
+          FROM claimed
+         WHERE pins.id = claimed.pin_id
+        RETURNING claimed.id, pins.id, pins.cid, claimed.attempts
+    """), {"limit": limit}).fetchall()
+    db.session.commit()
+    return [tuple(row) for row in rows]
+
+
+def requeue_stale_jobs():
+    """Put back jobs whose worker died mid-pin (cluster pin add is idempotent)."""
+    cutoff = datetime.utcnow() - PIN_JOB_LEASE
+    stale = PinJob.query.filter(PinJob.status == 'running', PinJob.locked_at < cutoff).all()
+    for job in stale:
+        print(f"Requeueing stale pin job {job.id} (locked at {job.locked_at})")
+        job.status = 'queued'
+        job.locked_at = None
+        job.pin.status = 'queued'
+    db.session.commit()
+    return len(stale)
+
+
+def _pin_to_cluster(cid):
+    try:
+        get_cluster_client().pin_add(cid)
+        return None
+    except IPFSClientError as e:
+        return str(e)
+
+
+def record_result(job_id, error):
+    """Advance a job (and its pin) after one pin attempt."""
+    job = PinJob.query.get(job_id)
+    if job is None:
+        return  # Pin was deleted while we were pinning
+    pin = job.pin
+    job.locked_at = None
+    invalidate_pin_access(pin.ipfs_access_hash, pin.cid)
+
+    if error is None:
+        job.status = 'done'
+        job.last_error = None
+        pin.status = 'pinned'
+        print(f"Pinned {pin.cid} (job {job.id}, attempt {job.attempts})")
+    elif job.attempts < PIN_JOB_MAX_ATTEMPTS:
+        delay = PIN_JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1)
+        job.status = 'queued'
+        job.last_error = error
+        job.run_after = datetime.utcnow() + timedelta(seconds=delay)
+        pin.status = 'queued'
+        print(f"Pinning {pin.cid} failed (attempt {job.attempts}), retrying in {delay}s: {error}")
+    else:
+        job.status = 'failed'
+        job.last_error = error
+        pin.status = 'error'
+        # Nothing was stored for the customer: give back the prepaid amount
+        if job.refund_eur:
+            credit_balance(pin.user_id, "kubo", job.refund_eur, "refund", reference=pin.cid)
+        print(f"Giving up on {pin.cid} after {job.attempts} attempts, refunded €{job.refund_eur}: {error}")
+
+
+def process_batch(executor):
+    """Claim one batch, pin it concurrently and record the outcomes. Returns jobs handled."""
+    claimed = claim_jobs()
+    if not claimed:
+        return 0
+
+    # Only the cluster calls run on the pool; DB writes stay on this thread's session
+    errors = executor.map(_pin_to_cluster, [cid for _, _, cid, _ in claimed])
+    for (job_id, _, _, _), error in zip(claimed, errors):
+        record_result(job_id, error)
+    db.session.commit()
+    return len(claimed)
+
+
+def run_pin_worker():
+    """Main loop: keep draining the queue, sleep briefly when it is empty."""
+    from .app import create_app
+
+    app = create_app()
+    with app.app_context(), ThreadPoolExecutor(max_workers=PIN_WORKER_THREADS) as executor:
+        print(f"Pin worker started ({PIN_WORKER_THREADS} threads, batch {PIN_WORKER_BATCH})")
+        last_stale_check = 0
+        while True:
+            try:
+                if time.monotonic() - last_stale_check > 60:
+                    requeue_stale_jobs()
+                    last_stale_check = time.monotonic()
+                if process_batch(executor) == 0:
+                    time.sleep(PIN_WORKER_POLL_SECONDS)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Pin worker error: {e}")
+                time.sleep(PIN_WORKER_POLL_SECONDS)
+
+
+if __name__ == "__main__":
+    run_pin_worker()
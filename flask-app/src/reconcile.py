@@ -0,0 +1,206 @@
+"""
+Cluster Reconciliation Module
+Diffs the IPFS Cluster pinset against pins and cluster_backups, and optionally repairs it
+The streamed `pin ls` is spooled into a temp table and diffed by Postgres, so Python never holds the CID set
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from .models import db
+from .ipfs_client import get_cluster_client
+from .cleanup import cluster_fan_out, CLEANUP_CLUSTER_THREADS
+
+RECONCILE_REPAIR = os.getenv("RECONCILE_REPAIR", "false").lower() == "true"   # Scheduled runs only report unless set
+RECONCILE_BATCH = int(os.getenv("RECONCILE_BATCH", "5000"))                    # CIDs per insert / repair chunk
+RECONCILE_MIN_AGE = timedelta(minutes=10)   # Younger pins may still be mid-upload or mid-pinning: never repaired
+RECONCILE_SAMPLES = 20                      # CIDs listed per category in the report
+
+# Content the database wants in the cluster (queued/pinning pins are on their way in)
+_WANTED = """
+    (EXISTS (SELECT 1 FROM pins p WHERE p.cid = c.cid AND p.status IN ('queued', 'pinning', 'pinned'))
+     OR EXISTS (SELECT 1 FROM cluster_backups b WHERE b.cid = c.cid AND b.status = 'active'))
+"""
+
+# The diff cursors are opened when the run starts: each chunk is re-checked right before it
+# is repaired, so content uploaded (or deleted) meanwhile is not unpinned (or re-pinned)
+STILL_ORPHANED_SQL = f"SELECT c.cid FROM unnest(CAST(:cids AS text[])) AS c(cid) WHERE NOT {_WANTED}"
+STILL_WANTED_SQL = f"SELECT c.cid FROM unnest(CAST(:cids AS text[])) AS c(cid) WHERE {_WANTED}"
+
+# Pinned in the cluster, wanted by nobody. pinned_at is NULL if the cluster does not report it
+ORPHANS_SQL = f"""
+    SELECT c.cid, NULL::integer AS user_id, c.pinned_at
+      FROM cluster_pin_ls c
+     WHERE NOT {_WANTED}
+"""
+
+# Paid for and marked pinned, but absent from the cluster. A CID held by several rows
+# is re-pinned once, with the highest replica count any backup asks for
+MISSING_SQL = """
+    SELECT DISTINCT ON (cid) cid, user_id, replica_count, created_at
+      FROM (SELECT cid, user_id, NULL::integer AS replica_count, created_at
+              FROM pins WHERE status = 'pinned'
+            UNION ALL
+            SELECT cid, user_id, replica_count, created_at
+              FROM cluster_backups WHERE status = 'active') wanted
+     WHERE NOT EXISTS (SELECT 1 FROM cluster_pin_ls c WHERE c.cid = wanted.cid)
+     ORDER BY cid, replica_count DESC NULLS LAST
+"""
+
+# Active backups pinned with another replication factor, or on fewer peers than paid for
+REPLICATION_SQL = """
+    SELECT DISTINCT ON (b.cid) b.cid, b.user_id, b.replica_count, b.created_at,
+           c.replication_min, c.replication_max, c.allocations
+      FROM cluster_backups b JOIN cluster_pin_ls c ON c.cid = b.cid
+     WHERE b.status = 'active'
+       AND (c.replication_min <> b.replica_count OR c.replication_max <> b.replica_count
+            OR c.allocations < b.replica_count)
+     ORDER BY b.cid, b.replica_count DESC
+"""
+
+
+def _naive_utc(timestamp):
+    # Cluster timestamps are RFC 3339; a zero or missing one means "unknown"
+    if not timestamp or timestamp.startswith("0001-"):
+        return None
+    try:
+        moment = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+
+def spool_cluster_pins(connection, client):
+    """
+    Stream `pin ls` into the temp table cluster_pin_ls, RECONCILE_BATCH rows per insert.
+
+    Returns:
+        int: Cluster pins spooled
+    """
+    connection.execute(db.text("""
+        CREATE TEMP TABLE cluster_pin_ls (
+            cid text PRIMARY KEY,
+            replication_min integer,
+            replication_max integer,
+            allocations integer,
+            pinned_at timestamp
+        ) ON COMMIT PRESERVE ROWS
+    """))
+    insert = db.text("""
+        INSERT INTO cluster_pin_ls (cid, replication_min, replication_max, allocations, pinned_at)
+        VALUES (:cid, :replication_min, :replication_max, :allocations, :pinned_at)
+        ON CONFLICT (cid) DO NOTHING
+    """)
+    spooled = 0
+    batch = []
+    for pin in client.pin_ls():
+        batch.append({
+            "cid": pin["cid"]["/"] if isinstance(pin["cid"], dict) else pin["cid"],
+            "replication_min": pin.get("replication_factor_min"),
+            "replication_max": pin.get("replication_factor_max"),
+            "allocations": len(pin.get("allocations") or []),
+            "pinned_at": _naive_utc(pin.get("timestamp")),
+        })
+        if len(batch) >= RECONCILE_BATCH:
+            connection.execute(insert, batch)
+            spooled += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert, batch)
+        spooled += len(batch)
+    connection.execute(db.text("ANALYZE cluster_pin_ls"))
+    connection.commit()
+    return spooled
+
+
+def _diff(connection, sql, executor, job, action, repairable, recheck_sql):
+    """
+    Stream one diff query RECONCILE_BATCH rows at a time, keeping a few samples
+    and, if `action` is set, repairing the rows that pass `repairable` and
+    that `recheck_sql` still returns.
+
+    Returns:
+        tuple: (rows found, rows repaired, sample CIDs)
+    """
+    found = repaired = 0
+    samples = []
+    result = connection.execute(db.text(sql).execution_options(stream_results=True))
+    for chunk in result.partitions(RECONCILE_BATCH):  # An explicit size: without one a Core result fetches everything
+        found += len(chunk)
+        samples.extend(row.cid for row in chunk[:RECONCILE_SAMPLES - len(samples)])
+        if action is None:
+            continue
+        todo = [row for row in chunk if repairable(row)]
+        if todo:
+            current = {cid for (cid,) in db.session.execute(db.text(recheck_sql), {"cids": [row.cid for row in todo]})}
+            db.session.commit()
+            todo = [row for row in todo if row.cid in current]
+        if todo:
+            repaired += len(cluster_fan_out(executor, job, action, todo))
+            db.session.commit()
+    result.close()
+    return found, repaired, samples
+
+
+def _repin(client, row):
+    # Plain pins take the cluster default replication; backups their paid replica count
+    client.pin_add(row.cid, replication_min=row.replica_count, replication_max=row.replica_count)
+
+
+def reconcile_cluster_pins(repair=RECONCILE_REPAIR):
+    """
+    Compare the cluster pinset with the database and report (or repair):
+    - orphans: pinned in the cluster, wanted by no pin or active backup (unpinned)
+    - missing: pinned pins / active backups absent from the cluster (re-pinned)
+    - replication mismatches: backups with the wrong replication factor or
+      too few allocations (re-pinned with their replica count)
+
+    Only content older than RECONCILE_MIN_AGE is repaired, so in-flight
+    uploads and pin jobs are left alone, and each chunk is checked against
+    the database again right before it is repaired. Each repair is recorded in
+    cluster_pin_outcomes (jobs reconcile_orphan / reconcile_missing /
+    reconcile_replication).
+
+    Returns:
+        dict: Counts and sample CIDs per category; "rows" is the total found
+    """
+    print(f"Starting cluster reconciliation ({'repair' if repair else 'report only'})...")
+    cutoff = datetime.utcnow() - RECONCILE_MIN_AGE
+
+    def old_enough(row):
+        created = row.pinned_at if hasattr(row, "pinned_at") else row.created_at
+        return created is not None and created < cutoff
+
+    with db.engine.connect() as connection, ThreadPoolExecutor(max_workers=CLEANUP_CLUSTER_THREADS) as executor:
+        report = {"cluster_pins": spool_cluster_pins(connection, get_cluster_client())}
+        for category, sql, job, action, recheck_sql in (
+            ("orphans", ORPHANS_SQL, "reconcile_orphan", "pin_rm", STILL_ORPHANED_SQL),
+            ("missing", MISSING_SQL, "reconcile_missing", _repin, STILL_WANTED_SQL),
+            ("replication_mismatches", REPLICATION_SQL, "reconcile_replication", _repin, STILL_WANTED_SQL),
+        ):
+            found, repaired, samples = _diff(connection, sql, executor, job, action if repair else None,
+                                             old_enough, recheck_sql)
+            report[category] = found
+            report[f"{category}_repaired"] = repaired
+            report[f"{category}_sample"] = samples
+            print(f"{category}: {found} found, {repaired} repaired. e.g. {samples[:5]}")
+        connection.execute(db.text("DROP TABLE cluster_pin_ls"))
+        connection.commit()
+
+    report["rows"] = report["orphans"] + report["missing"] + report["replication_mismatches"]
+    print(f"Cluster reconciliation finished: {report['cluster_pins']} cluster pins, {report['rows']} discrepancies.")
+    return report
+
+
+def run_reconcile():
+    """Entry point: python -m src.reconcile [--repair]"""
+    from .app import create_app
+
+    app = create_app()
+    with app.app_context():
+        reconcile_cluster_pins(repair=RECONCILE_REPAIR or "--repair" in sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run_reconcile()
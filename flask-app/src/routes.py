@@ -1,31 +1,24 @@
-from flask import Blueprint, jsonify, request, current_app, render_template
+from flask import Blueprint, jsonify, request, render_template, Response, stream_with_context
 from .models import db, User, Pin, ClusterBackup, Payment, Invoice, ReplicaHistory # Added Backup import
-from .ipfs_access_control import validate_ipfs_access, verify_pin_ownership
+from .ipfs_access_control import validate_ipfs_access, validate_ipfs_access_batch, verify_pin_ownership
+from .capability_tokens import mint_capability_token, verify_capability_token, CapabilityTokensDisabled
+from .api_auth import authenticate_api_credentials
+from .ipfs_upload import stream_upload_to_kubo, UploadFormatError
+from .ipfs_client import get_cluster_client, get_kubo_client, IPFSClientError
+from .pin_worker import enqueue_pin
+from .balances import debit_balance, credit_balance, ledger_entries
+from .money import to_nanos, to_eur, gb_cost, bytes_to_gb
+from .usage_snapshots import usage_history
+from .payment_addresses import get_payment_address, payment_details, mark_invoice_paid
+from .pin_listing import pin_page_from_args
+from .inventory_export import export_inventory, EXPORT_FORMATS
+from .expiration import register_deadline
 import secrets
-import subprocess
-import os
+import time
 from decimal import Decimal
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from functools import wraps
-
-# Authentication decorator
-def require_auth(f):
-    """Decorator to require API key and secret authentication"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('X-API-KEY')
-        api_secret = request.headers.get('X-API-SECRET')
-        
-        if not api_key or not api_secret:
-            return jsonify({"error": "Missing API credentials"}), 401
-        
-        user = User.query.filter_by(api_key=api_key).first()
-        if not user or not user.check_api_secret(api_secret):
-            return jsonify({"error": "Invalid API credentials"}), 401
-        
-        return f(user, *args, **kwargs)
-    return decorated_function
-
+from urllib.parse import parse_qs
 
 main = Blueprint('main', __name__)
 
@@ -49,6 +42,10 @@ KUBO_PRICING = {
 
 FREE_BANDWIDTH_GB_PER_MONTH = Decimal("5.00")     # 5 GB free bandwidth per customer per month
 ALLOWED_RETENTION_MONTHS = [1, 2, 6, 12]
+# Least a pin can cost per GB (any tier, any retention): checked against Content-Length before the upload
+CHEAPEST_KUBO_PRICE_PER_GB = min(
+    tier["price_per_gb_month"] * months for tiers in KUBO_PRICING.values() for months, tier in tiers.items()
+)
 
 # Legacy pricing for backward compatibility
 PRICE_PER_GB_MONTH_EUR_PINNING = Decimal("0.07")  # Old default
@@ -60,24 +57,33 @@ PRICE_PER_GB_MONTH_EUR_BACKUP = Decimal("0.0156") # For Backup Service (legacy)
 
 BYTES_PER_GB = 1024 * 1024 * 1024
 
-# --- Authentication Decorator ---
-def require_api_key(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('X-API-KEY')
-        api_secret = request.headers.get('X-API-SECRET')
-        if not api_key or not api_secret:
-            return jsonify({"error": "API key and secret are required"}), 401
-        
-        user = User.query.filter_by(api_key=api_key).first()
-        
-        # Use the updated check_api_secret method
-        if not user or not user.check_api_secret(api_secret):
-            return jsonify({"error": "Invalid API key or secret"}), 401
-        
-        request.user = user
-        return f(*args, **kwargs)
-    return decorated_function
+# --- Authentication Decorators ---
+def _api_credentials_required(pass_user):
+    """
+    Build an X-API-KEY / X-API-SECRET check. The user is stored on
+    request.user and, if `pass_user`, also passed as the first argument.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            api_key = request.headers.get('X-API-KEY')
+            api_secret = request.headers.get('X-API-SECRET')
+            if not api_key or not api_secret:
+                return jsonify({"error": "API key and secret are required"}), 401
+            
+            user = authenticate_api_credentials(api_key, api_secret)
+            if not user:
+                return jsonify({"error": "Invalid API key or secret"}), 401
+            
+            request.user = user
+            if pass_user:
+                return f(user, *args, **kwargs)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+require_api_key = _api_credentials_required(pass_user=False)  # Handler reads request.user
+require_auth = _api_credentials_required(pass_user=True)      # Handler receives user as first argument
 
 @main.route('/')
 def index():
@@ -118,32 +124,8 @@ def welcome_data():
     if not user:
         return jsonify({"error": "Invalid token"}), 404
     
-    # Generate payment address via SatSale
-    bitcoin_address = None
-    payment_uri = None
-    qr_code_url = None
-    
-    try:
-        import requests
-        satsale_response = requests.get(
-            "http://localhost:8000/api/createpayment",
-            params={
-                "amount": 10,
-                "currency": "EUR",
-                "method": "onchain",
-                "w_url": f"http://localhost:5003/webhook/satsale?user_id={user.api_key}"
-            },
-            timeout=10
-        )
-        if satsale_response.status_code == 200:
-            payment_data = satsale_response.json()
-            # SatSale returns address nested in 'invoice' key
-            invoice_data = payment_data.get("invoice", {})
-            bitcoin_address = invoice_data.get("address")
-            payment_uri = payment_data.get("payment_uri")
-            qr_code_url = f"http://localhost:8000/api/qr/{bitcoin_address}" if bitcoin_address else None
-    except Exception as e:
-        bitcoin_address = "Error generating address"
+    # Payment address from the pre-created invoice pool (no SatSale call here)
+    payment = payment_details(get_payment_address(user.id))
     
     return jsonify({
         "credentials": {
@@ -152,11 +134,7 @@ def welcome_data():
             "dashboard_token": user.dashboard_token,
             "ipfs_access_hash": user.ipfs_access_hash
         },
-        "payment": {
-            "bitcoin_address": bitcoin_address,
-            "payment_uri": payment_uri,
-            "qr_code_url": qr_code_url
-        },
+        "payment": payment,
         "balance": {
             "kubo_balance": str(user.kubo_balance_eur),
             "cluster_balance": str(user.cluster_balance_eur)
@@ -182,6 +160,83 @@ def check_balance():
         "cluster_balance": str(user.cluster_balance_eur)
     }), 200
 
+@main.route('/api/balance/ledger', methods=['GET'])
+def balance_ledger():
+    """
+    List balance ledger entries by dashboard token.
+    ?since= / ?until= are ISO dates (default: the current month so far)
+    """
+    token = request.args.get('token')
+    if not token:
+        return jsonify({"error": "Token required"}), 400
+    
+    user = User.query.filter_by(dashboard_token=token).first()
+    if not user:
+        return jsonify({"error": "Invalid token"}), 404
+    
+    now = datetime.utcnow()
+    try:
+        since = datetime.fromisoformat(request.args['since']) if 'since' in request.args else now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        until = datetime.fromisoformat(request.args['until']) if 'until' in request.args else now
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO dates"}), 400
+    if until - since > timedelta(days=366):
+        return jsonify({"error": "At most one year per request"}), 400
+    
+    entries = ledger_entries(user.id, since, until)
+    return jsonify({
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "entries": [{
+            "id": entry_id,
+            "account": account,
+            "amount_eur": str(amount),
+            "type": entry_type,
+            "reference": reference,
+            "created_at": created_at.isoformat()
+        } for entry_id, account, amount, entry_type, reference, created_at in entries]
+    }), 200
+
+@main.route('/api/usage/history', methods=['GET'])
+def usage_history_series():
+    """
+    Daily usage series by dashboard token (from the usage_snapshots rollup).
+    ?since= / ?until= are ISO days, both included (default: the last 30 days)
+    """
+    token = request.args.get('token')
+    if not token:
+        return jsonify({"error": "Token required"}), 400
+    
+    user = User.query.filter_by(dashboard_token=token).first()
+    if not user:
+        return jsonify({"error": "Invalid token"}), 404
+    
+    today = datetime.utcnow().date()
+    try:
+        since = date.fromisoformat(request.args['since']) if 'since' in request.args else today - timedelta(days=30)
+        until = date.fromisoformat(request.args['until']) if 'until' in request.args else today
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO dates"}), 400
+    if until - since > timedelta(days=366):
+        return jsonify({"error": "At most one year per request"}), 400
+    
+    snapshots = usage_history(user.id, since, until)
+    return jsonify({
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "days": [{
+            "day": snapshot.day.isoformat(),
+            "pins": snapshot.pins,
+            "pinned_public_bytes": snapshot.pinned_public_bytes,
+            "pinned_private_bytes": snapshot.pinned_private_bytes,
+            "cluster_bytes": snapshot.cluster_bytes,
+            "cluster_replica_bytes": snapshot.cluster_replica_bytes,
+            "bandwidth_public_bytes": snapshot.bandwidth_public_bytes,
+            "bandwidth_private_bytes": snapshot.bandwidth_private_bytes,
+            "charges_eur": str(snapshot.charges_eur)
+        } for snapshot in snapshots]
+    }), 200
+
 @main.route('/api/pricing', methods=['GET'])
 def get_pricing():
     """Get current pricing structure for IPFS Kubo pinning"""
@@ -287,35 +342,9 @@ def register():
         dashboard_url = f"https://datahosting.company/dashboard?token={new_user.dashboard_token}"
         welcome_url = f"https://datahosting.company/register?welcome={new_user.dashboard_token}"
         
-        # Generate Bitcoin payment address immediately via SatSale
-        bitcoin_address = None
-        payment_uri = None
-        qr_code_url = None
-        
-        try:
-            import requests
-            satsale_response = requests.get(
-                "http://localhost:8000/api/createpayment",
-                params={
-                    "amount": 10,
-                    "currency": "EUR",
-                    "method": "onchain",
-                    "w_url": f"http://localhost:5003/webhook/satsale?user_id={new_user.api_key}"
-                },
-                timeout=10
-            )
-            if satsale_response.status_code == 200:
-                payment_data = satsale_response.json()
-                # SatSale returns address nested in 'invoice' key
-                invoice_data = payment_data.get("invoice", {})
-                bitcoin_address = invoice_data.get("address")
-                payment_uri = payment_data.get("payment_uri")
-                qr_code_url = f"http://localhost:8000/api/qr/{bitcoin_address}" if bitcoin_address else None
-        except Exception as payment_error:
-            # Log error but don't fail registration
-            import logging
-            logging.error(f"Failed to generate payment address: {payment_error}")
-            bitcoin_address = "ERROR - Visit dashboard for payment address"
+        # Bitcoin payment address from the pre-created invoice pool (no SatSale call here)
+        payment = payment_details(get_payment_address(new_user.id))
+        bitcoin_address = payment["bitcoin_address"] or "PENDING - Visit dashboard for payment address"
         
         # Check if request wants HTML (from web form) or JSON (from API)
         accept_header = request.headers.get('Accept', '')
@@ -338,8 +367,8 @@ def register():
             },
             "payment": {
                 "bitcoin_address": bitcoin_address,
-                "payment_uri": payment_uri,
-                "qr_code_url": qr_code_url,
+                "payment_uri": payment["payment_uri"],
+                "qr_code_url": payment["qr_code_url"],
                 "recommended_amount": "€10 to start (any amount works)",
                 "note": "Send Bitcoin to this address to add credits"
             },
@@ -371,15 +400,26 @@ def create_pin():
     """Handles file pinning, billing, and database recording for the Pinning Service."""
     user = request.user
 
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part in the request"}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+    # Refuse before a byte reaches Kubo: uploads are pinned there until billed or released.
+    # Content-Length bounds the file size (the multipart framing adds a few hundred bytes)
+    minimum_cost = to_eur(gb_cost(request.content_length or 0, to_nanos(CHEAPEST_KUBO_PRICE_PER_GB)), places=2)
+    if user.kubo_balance_eur <= 0 or user.kubo_balance_eur < minimum_cost:
+        return jsonify({
+            "error": "Insufficient credits in Kubo balance",
+            "minimum_required_credits": str(minimum_cost),
+            "current_kubo_balance": str(user.kubo_balance_eur)
+        }), 402
+
+    # Stream the body straight into Kubo; form fields may arrive before or after the file
+    try:
+        upload = stream_upload_to_kubo(request)
+    except UploadFormatError as e:
+        return jsonify({"error": str(e)}), 400
+    except IPFSClientError as e:
+        return jsonify({"error": "Failed to add file to IPFS node", "details": str(e)}), 500
 
     try:
-        retention_months = int(request.form.get('retention_months', 1))
+        retention_months = int(upload.fields.get('retention_months', 1))
         if retention_months not in ALLOWED_RETENTION_MONTHS:
             return jsonify({
                 "error": f"retention_months must be one of {ALLOWED_RETENTION_MONTHS}",
@@ -388,19 +428,14 @@ def create_pin():
     except (ValueError, TypeError):
         return jsonify({"error": "Invalid retention_months format"}), 400
 
-    is_private = request.form.get('private', 'false').lower() == 'true'
+    is_private = upload.fields.get('private', 'false').lower() == 'true'
 
-    temp_dir = os.path.join(os.path.dirname(current_app.root_path), 'temp_uploads')
-    os.makedirs(temp_dir, exist_ok=True)
-    temp_path = os.path.join(temp_dir, file.filename)
-    file.save(temp_path)
-    
-    file_size_bytes = os.path.getsize(temp_path)
+    file_size_bytes = upload.size_bytes
     if file_size_bytes == 0:
-        os.remove(temp_path)
         return jsonify({"error": "Cannot pin an empty file"}), 400
 
-    file_size_gb = Decimal(file_size_bytes) / Decimal(BYTES_PER_GB)
+    cid = upload.cid
+    file_size_gb = bytes_to_gb(file_size_bytes)
     
     # NEW RETENTION-BASED PRICING: Get price based on retention and privacy
     access_type = "private" if is_private else "public"
@@ -408,15 +443,19 @@ def create_pin():
     price_per_gb_month = pricing["price_per_gb_month"]
     
     # PREPAID MODEL: Calculate upfront cost for entire retention period
-    upfront_cost = file_size_gb * price_per_gb_month * retention_months
+    # Integer nano-euros, rounded once to the cent precision of kubo_balance_eur
+    upfront_cost = to_eur(gb_cost(file_size_bytes, to_nanos(price_per_gb_month) * retention_months), places=2)
     
     # Use Kubo balance for IPFS Kubo pinning
-    if user.kubo_balance_eur < upfront_cost:
-        os.remove(temp_path)
+    # PREPAID MODEL: Charge upfront for entire retention period, checked and deducted in one statement
+    # (rejected content stays pinned on the upload node until release_upload_pins drops it)
+    charge = debit_balance(user.id, "kubo", upfront_cost, "pin_charge", reference=cid)
+    if not charge["success"]:
+        db.session.rollback()
         return jsonify({
             "error": "Insufficient credits in Kubo balance",
             "required_credits": str(upfront_cost),
-            "current_kubo_balance": str(user.kubo_balance_eur),
+            "current_kubo_balance": str(charge.get("current_balance")),
             "pricing_details": {
                 "file_size_gb": str(file_size_gb),
                 "price_per_gb_month": str(price_per_gb_month),
@@ -426,24 +465,12 @@ def create_pin():
         }), 402
 
     try:
-        ipfs_add_cmd = ["ipfs", "add", "-Q", temp_path]
-        result = subprocess.run(ipfs_add_cmd, capture_output=True, text=True, check=True)
-        cid = result.stdout.strip()
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        os.remove(temp_path)
-        return jsonify({"error": "Failed to add file to IPFS node", "details": str(e)}), 500
-    finally:
-        os.remove(temp_path)
-
-    try:
-        # PREPAID MODEL: Charge upfront for entire retention period from Kubo balance
-        user.kubo_balance_eur -= upfront_cost
         expire_at = datetime.utcnow() + timedelta(days=30 * retention_months)
 
         new_pin = Pin(
             user_id=user.id,
             cid=cid,
-            file_name=file.filename,
+            file_name=upload.filename,
             size_bytes=file_size_bytes,
             status='queued',
             is_private=is_private,
@@ -454,45 +481,108 @@ def create_pin():
         )
         db.session.add(new_pin)
 
-        ipfs_pin_cmd = ["ipfs-cluster-ctl", "pin", "add", cid]
-        subprocess.run(ipfs_pin_cmd, check=True)
-        
-        new_pin.status = 'pinned'
+        # ASYNC PINNING: the pin worker drives queued -> pinning -> pinned/error
+        enqueue_pin(new_pin, refund_eur=upfront_cost)
+        register_deadline("pin", expire_at)
         db.session.commit()
 
         return jsonify({
-            "message": "File pinned successfully!",
+            "message": "File uploaded and queued for pinning.",
             "cid": cid,
+            "status": new_pin.status,
+            "status_url": f"/api/pins/{cid}/status",
             "cost_charged": str(upfront_cost),
             "retention_months": retention_months,
             "pricing_tier": access_type,
             "price_per_gb_month": str(price_per_gb_month),
-            "new_kubo_balance_eur": str(user.kubo_balance_eur),
+            "new_kubo_balance_eur": str(charge["new_balance"]),
             "free_bandwidth_per_month": str(FREE_BANDWIDTH_GB_PER_MONTH)
-        }), 201
+        }), 202
 
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        db.session.rollback()
-        return jsonify({"error": "Failed to pin CID to cluster", "details": str(e)}), 500
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
 
+@main.route('/api/pins', methods=['GET'])
+@require_api_key
+def list_user_pins():
+    """
+    Lists the caller's pins, newest first, one cursor page at a time.
+    Filters: ?status=, ?private=true|false, ?cid_prefix=; ?limit= (max 500);
+    pass the returned next_cursor as ?cursor= for the next page.
+    """
+    try:
+        return jsonify(pin_page_from_args(request.user.id, request.args)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@main.route('/api/export', methods=['GET'])
+@require_api_key
+def export_user_inventory():
+    """
+    Streams every pin and cluster backup of the caller, for reconciliation.
+    ?format=ndjson (default) or csv
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {sorted(EXPORT_FORMATS)}"}), 400
+
+    # stream_with_context keeps the app context (and the DB cursor) alive while the body is sent
+    return Response(
+        stream_with_context(export_inventory(request.user.id, export_format)),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=inventory-{request.user.id}.{export_format}"}
+    )
+
+@main.route('/api/pins/<cid>/status', methods=['GET'])
+@require_api_key
+def get_pin_status(cid):
+    """Reports where an uploaded CID is in the pinning pipeline."""
+    user = request.user
+
+    pin = Pin.query.filter_by(user_id=user.id, cid=cid).order_by(Pin.created_at.desc()).first()
+    if not pin:
+        return jsonify({"error": "Pin not found"}), 404
+
+    status = {
+        "cid": pin.cid,
+        "file_name": pin.file_name,
+        "status": pin.status,
+        "created_at": pin.created_at.isoformat() if pin.created_at else None,
+        "expire_at": pin.expire_at.isoformat() if pin.expire_at else None
+    }
+
+    job = pin.job
+    if job:
+        status["attempts"] = job.attempts
+        status["last_error"] = job.last_error
+        if job.status == 'queued' and job.attempts > 0:
+            status["next_attempt_at"] = job.run_after.isoformat()
+
+    return jsonify(status), 200
+
 @main.route('/api/backups', methods=['POST'])
 @require_api_key
 def create_backup():
     """Handles file backups, billing, and database recording for the Backup Service."""
     user = request.user
 
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part in the request"}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+    # Checked again below; refuse before the upload reaches Kubo
+    if user.credit_balance_eur <= 0:
+        return jsonify({
+            "error": "Insufficient credits. Please add funds to your account to back up files.",
+            "current_balance": str(user.credit_balance_eur)
+        }), 402
 
     try:
-        retention_months = int(request.form.get('retention_months', 1))
+        upload = stream_upload_to_kubo(request)
+    except UploadFormatError as e:
+        return jsonify({"error": str(e)}), 400
+    except IPFSClientError as e:
+        return jsonify({"error": "Failed to add file to IPFS node for backup", "details": str(e)}), 500
+
+    try:
+        retention_months = int(upload.fields.get('retention_months', 1))
         if not (1 <= retention_months <= 12):
             return jsonify({"error": "retention_months must be between 1 and 12"}), 400
     except (ValueError, TypeError):
@@ -501,34 +591,18 @@ def create_backup():
     # Backups are always private by default as per requirements
     is_private = True
 
-    temp_dir = os.path.join(os.path.dirname(current_app.root_path), 'temp_uploads')
-    os.makedirs(temp_dir, exist_ok=True)
-    temp_path = os.path.join(temp_dir, file.filename)
-    file.save(temp_path)
-    
-    file_size_bytes = os.path.getsize(temp_path)
+    file_size_bytes = upload.size_bytes
     if file_size_bytes == 0:
-        os.remove(temp_path)
         return jsonify({"error": "Cannot backup an empty file"}), 400
 
     # PAY-AS-YOU-GO CHANGE: Check for any positive balance instead of upfront cost.
     if user.credit_balance_eur <= 0:
-        os.remove(temp_path)
         return jsonify({
             "error": "Insufficient credits. Please add funds to your account to back up files.",
             "current_balance": str(user.credit_balance_eur)
         }), 402
 
-    try:
-        # Add to IPFS to get CID
-        ipfs_add_cmd = ["ipfs", "add", "-Q", temp_path]
-        result = subprocess.run(ipfs_add_cmd, capture_output=True, text=True, check=True)
-        cid = result.stdout.strip()
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        os.remove(temp_path)
-        return jsonify({"error": "Failed to add file to IPFS node for backup", "details": str(e)}), 500
-    finally:
-        os.remove(temp_path) # Clean up temp file
+    cid = upload.cid
 
     try:
         # PAY-AS-YOU-GO CHANGE: Do not deduct cost upfront.
@@ -538,7 +612,7 @@ def create_backup():
         new_backup = Backup(
             user_id=user.id,
             cid=cid,
-            file_name=file.filename,
+            file_name=upload.filename,
             size_bytes=file_size_bytes,
             status='active',
             is_private=is_private,
@@ -547,8 +621,7 @@ def create_backup():
         db.session.add(new_backup)
 
         # Pin to cluster
-        ipfs_pin_cmd = ["ipfs-cluster-ctl", "pin", "add", cid]
-        subprocess.run(ipfs_pin_cmd, check=True)
+        get_cluster_client().pin_add(cid)
         
         db.session.commit()
 
@@ -558,7 +631,7 @@ def create_backup():
             "estimated_monthly_cost_eur": str((Decimal(file_size_bytes) / Decimal(BYTES_PER_GB)) * PRICE_PER_GB_MONTH_EUR_BACKUP)
         }), 201
 
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+    except IPFSClientError as e:
         db.session.rollback()
         return jsonify({"error": "Failed to pin CID to cluster for backup", "details": str(e)}), 500
     except Exception as e:
@@ -587,32 +660,157 @@ def validate_access():
     """
     Validate IPFS access hash and CID ownership.
     Used by IPFS cluster or gateway to verify user has paid for access.
+    A capability token may be sent instead of the access hash (no database lookup).
     """
     data = request.get_json()
     if not data:
         return jsonify({"error": "No JSON data provided"}), 400
     
     ipfs_access_hash = data.get('ipfs_access_hash')
+    token = data.get('token')
     cid = data.get('cid')
     
+    if not (ipfs_access_hash or token) or not cid:
+        return jsonify({"error": "ipfs_access_hash (or token) and cid are required"}), 400
+    if not all(isinstance(value, str) for value in (ipfs_access_hash or token, cid)):
+        return jsonify({"error": "ipfs_access_hash, token and cid must be strings"}), 400
+    
+    # Validate access
+    if token:
+        validation = verify_capability_token(token, cid)
+    else:
+        validation = validate_ipfs_access(ipfs_access_hash, cid)
+    
+    if validation["valid"]:
+        return jsonify(_validation_response(validation)), 200
+    else:
+        return jsonify(_validation_response(validation)), 403
+
+
+MAX_BATCH_VALIDATE_CIDS = 1000
+
+@main.route('/api/ipfs/validate/batch', methods=['POST'])
+def validate_access_batch():
+    """
+    Validate one IPFS access hash against many CIDs in a single call.
+    Used by the gateway for page loads and directory listings.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No JSON data provided"}), 400
+    
+    ipfs_access_hash = data.get('ipfs_access_hash')
+    cids = data.get('cids')
+    
+    if not ipfs_access_hash or not isinstance(cids, list) or not cids:
+        return jsonify({"error": "ipfs_access_hash and a non-empty cids list are required"}), 400
+    if len(cids) > MAX_BATCH_VALIDATE_CIDS:
+        return jsonify({"error": f"At most {MAX_BATCH_VALIDATE_CIDS} cids per request"}), 400
+    if not all(isinstance(cid, str) and cid for cid in cids):
+        return jsonify({"error": "cids must be non-empty strings"}), 400
+    
+    verdicts = validate_ipfs_access_batch(ipfs_access_hash, cids)
+    
+    return jsonify({
+        "results": {cid: _validation_response(verdict) for cid, verdict in verdicts.items()}
+    }), 200
+
+
+@main.route('/api/ipfs/token', methods=['POST'])
+def issue_capability_token():
+    """
+    Mint a short-lived signed token for one CID.
+    The gateway accepts it instead of the access hash and verifies it without the database.
+    """
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "No JSON data provided"}), 400
+    
+    ipfs_access_hash = data.get('ipfs_access_hash')
+    cid = data.get('cid')
+    ttl = data.get('ttl_seconds')
+    
     if not ipfs_access_hash or not cid:
         return jsonify({"error": "ipfs_access_hash and cid are required"}), 400
+    if not isinstance(ipfs_access_hash, str) or not isinstance(cid, str):
+        return jsonify({"error": "ipfs_access_hash and cid must be strings"}), 400
+    if ttl is not None and (not isinstance(ttl, int) or ttl <= 0):
+        return jsonify({"error": "ttl_seconds must be a positive integer"}), 400
     
-    # Validate access
     validation = validate_ipfs_access(ipfs_access_hash, cid)
+    if not validation["valid"]:
+        return jsonify(_validation_response(validation)), 403
+    
+    try:
+        token, expires_at = mint_capability_token(ipfs_access_hash, cid, validation, ttl)
+    except CapabilityTokensDisabled as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({
+        "token": token,
+        "cid": cid,
+        "is_private": validation["is_private"],
+        "expires_at": datetime.utcfromtimestamp(expires_at).isoformat() + "Z"
+    }), 200
+
+
+@main.route('/api/ipfs/auth', methods=['GET', 'HEAD'])
+def gateway_auth():
+    """
+    nginx auth_request target for the private gateway.
+    Answers a bare 204 (allow) or 403 (deny) and exposes metering data as headers.
     
+    Token: X-IPFS-Token header or ?token= on the original URI (checked without the database)
+    Access hash: X-IPFS-Access-Hash header or ?access_hash= on the original URI
+    CID: the /ipfs/<cid>/... path of X-Original-URI (never a client-supplied header)
+    """
+    cid, params = _parse_gateway_uri(request.headers.get('X-Original-URI', ''))
+    token = request.headers.get('X-IPFS-Token') or params.get('token')
+    ipfs_access_hash = request.headers.get('X-IPFS-Access-Hash') or params.get('access_hash')
+    
+    if not (token or ipfs_access_hash) or not cid:
+        return Response(status=403)
+    
+    if token:
+        validation = verify_capability_token(token, cid)
+    else:
+        validation = validate_ipfs_access(ipfs_access_hash, cid)
+    if not validation["valid"]:
+        return Response(status=403)
+    
+    headers = {
+        "X-IPFS-User-Id": str(validation["user_id"]),
+        "X-IPFS-Is-Private": "true" if validation["is_private"] else "false"
+    }
+    if token:
+        # nginx must not serve a cached allow past the token's expiry
+        headers["X-Accel-Expires"] = str(max(0, min(30, validation["expires_at"] - int(time.time()))))
+    return Response(status=204, headers=headers)
+
+
+def _parse_gateway_uri(uri):
+    """Split a gateway request URI into (cid, {query parameter: first value})."""
+    path, _, query = uri.partition('?')
+    cid = None
+    parts = path.split('/')
+    if len(parts) > 2 and parts[1] == 'ipfs' and parts[2]:
+        cid = parts[2]
+    params = {name: values[0] for name, values in parse_qs(query).items()}
+    return cid, params
+
+
+def _validation_response(validation):
+    """Public fields of a validate_ipfs_access verdict."""
     if validation["valid"]:
-        return jsonify({
+        return {
             "valid": True,
             "user_id": validation["user_id"],
             "is_private": validation["is_private"],
             "file_size_bytes": validation["file_size_bytes"]
-        }), 200
-    else:
-        return jsonify({
-            "valid": False,
-            "reason": validation["reason"]
-        }), 403
+        }
+    return {
+        "valid": False,
+        "reason": validation["reason"]
+    }
 
 
 # ========================================================================
@@ -628,22 +826,29 @@ def create_cluster_backup(user):
     """
     from .models import ClusterBackup, ReplicaHistory
     
-    if 'file' not in request.files:
-        return jsonify({"error": "No file provided"}), 400
+    # Checked again below with the real cost; refuse before the upload reaches Kubo
+    if user.credit_balance_eur <= 0:
+        return jsonify({
+            "error": "Insufficient credits. Please add funds to create cluster backup.",
+            "recommendation": "Add at least €10 to start using cluster backups"
+        }), 402
     
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+    try:
+        upload = stream_upload_to_kubo(request)
+    except UploadFormatError as e:
+        return jsonify({"error": str(e)}), 400
+    except IPFSClientError as e:
+        return jsonify({"error": "Failed to create backup", "details": str(e)}), 500
     
     # Get replica count (default: 1)
-    replica_count = int(request.form.get('replica_count', 1))
+    replica_count = int(upload.fields.get('replica_count', 1))
     if replica_count not in [1, 2, 3]:
         return jsonify({"error": "replica_count must be 1, 2, or 3"}), 400
     
     # MONTHLY DEDUCTION MODEL: No retention_days needed
     # Customer adds balance, system deducts monthly until balance runs out
     # Optional: max_retention_days as safety limit
-    max_retention_days = request.form.get('max_retention_days', None)
+    max_retention_days = upload.fields.get('max_retention_days', None)
     if max_retention_days:
         try:
             max_retention_days = int(max_retention_days)
@@ -652,12 +857,8 @@ def create_cluster_backup(user):
         except (TypeError, ValueError):
             return jsonify({"error": "Invalid max_retention_days"}), 400
     
-    # Save temp file
-    temp_path = os.path.join('/tmp', secrets.token_hex(16))
-    file.save(temp_path)
-    
     try:
-        file_size_bytes = os.path.getsize(temp_path)
+        file_size_bytes = upload.size_bytes
         file_size_gb = Decimal(file_size_bytes) / Decimal(1024 * 1024 * 1024)
         
         # MONTHLY DEDUCTION: Calculate costs but don't charge upfront
@@ -666,7 +867,6 @@ def create_cluster_backup(user):
         
         # Check if user has any balance to start
         if user.credit_balance_eur <= 0:
-            os.remove(temp_path)
             return jsonify({
                 "error": "Insufficient credits. Please add funds to create cluster backup.",
                 "monthly_cost": str(monthly_cost),
@@ -677,15 +877,11 @@ def create_cluster_backup(user):
         months_balance_lasts = float(user.credit_balance_eur / monthly_cost) if monthly_cost > 0 else 999
         days_balance_lasts = int(user.credit_balance_eur / daily_cost) if daily_cost > 0 else 99999
         
-        # Add to IPFS cluster
-        ipfs_add_cmd = ["ipfs", "add", "-q", temp_path]
-        result = subprocess.run(ipfs_add_cmd, capture_output=True, text=True, check=True)
-        cid = result.stdout.strip()
+        # Content was already streamed into Kubo while the request was read
+        cid = upload.cid
         
         # Pin to cluster with replication factor
-        ipfs_pin_cmd = ["ipfs-cluster-ctl", "pin", "add", "--replication-min", str(replica_count), 
-                        "--replication-max", str(replica_count), cid]
-        subprocess.run(ipfs_pin_cmd, check=True)
+        get_cluster_client().pin_add(cid, replication_min=replica_count, replication_max=replica_count)
         
         # MONTHLY DEDUCTION: No upfront charge, will be deducted monthly
         # Balance is checked, but not deducted now
@@ -699,7 +895,7 @@ def create_cluster_backup(user):
         new_backup = ClusterBackup(
             user_id=user.id,
             cid=cid,
-            file_name=file.filename,
+            file_name=upload.filename,
             size_bytes=file_size_bytes,
             replica_count=replica_count,
             status='active',
@@ -708,10 +904,9 @@ def create_cluster_backup(user):
             already_charged=False  # Will be charged monthly
         )
         db.session.add(new_backup)
+        register_deadline("backup", expire_at)
         db.session.commit()
         
-        os.remove(temp_path)
-        
         # Calculate end of current month
         from calendar import monthrange
         now = datetime.utcnow()
@@ -721,7 +916,7 @@ def create_cluster_backup(user):
         return jsonify({
             "message": "Cluster backup created! Monthly charges will be deducted from your balance.",
             "cid": cid,
-            "file_name": file.filename,
+            "file_name": upload.filename,
             "size_gb": float(file_size_gb),
             "replica_count": replica_count,
             "billing_info": {
@@ -737,14 +932,10 @@ def create_cluster_backup(user):
             "expire_at": expire_at.isoformat() if expire_at else "Runs until balance depleted or manually deleted"
         }), 201
         
-    except subprocess.CalledProcessError as e:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    except IPFSClientError as e:
         return jsonify({"error": "Failed to create backup", "details": str(e)}), 500
     except Exception as e:
         db.session.rollback()
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
         return jsonify({"error": "Failed to create backup", "details": str(e)}), 500
 
 
@@ -776,9 +967,8 @@ def update_backup_replicas(user, backup_id):
     
     # Update replica count in IPFS cluster
     try:
-        ipfs_pin_cmd = ["ipfs-cluster-ctl", "pin", "add", "--replication-min", str(new_replica_count),
-                        "--replication-max", str(new_replica_count), backup.cid]
-        subprocess.run(ipfs_pin_cmd, check=True)
+        get_cluster_client().pin_add(backup.cid, replication_min=new_replica_count,
+                                     replication_max=new_replica_count)
         
         # Update database and record change
         if update_replica_count(backup_id, new_replica_count):
@@ -791,7 +981,7 @@ def update_backup_replicas(user, backup_id):
         else:
             return jsonify({"error": "Failed to update replica count"}), 500
             
-    except subprocess.CalledProcessError as e:
+    except IPFSClientError as e:
         return jsonify({"error": "Failed to update replicas in cluster", "details": str(e)}), 500
 
 
@@ -848,8 +1038,7 @@ def delete_cluster_backup(user, backup_id):
     
     try:
         # Unpin from cluster
-        ipfs_unpin_cmd = ["ipfs-cluster-ctl", "pin", "rm", backup.cid]
-        subprocess.run(ipfs_unpin_cmd, check=True)
+        get_cluster_client().pin_rm(backup.cid)
         
         # Delete from database
         db.session.delete(backup)
@@ -860,7 +1049,7 @@ def delete_cluster_backup(user, backup_id):
             "info": "You will be charged for actual days stored at next billing cycle."
         }), 200
         
-    except subprocess.CalledProcessError as e:
+    except IPFSClientError as e:
         return jsonify({"error": "Failed to delete backup", "details": str(e)}), 500
 
 
@@ -897,9 +1086,10 @@ def satsale_webhook():
     amount_btc = data.get('btc_value') or data.get('amount')
     fiat_value_eur = data.get('fiat_value') or data.get('value')
     user_api_key = data.get('user_id') or data.get('api_key')  # Pass api_key in SatSale config
+    invoice_reference = data.get('invoice')  # Pooled invoices (payment_addresses) carry our reference instead
     
     # Validation
-    if not all([tx_id, amount_btc, fiat_value_eur, user_api_key]):
+    if not all([tx_id, amount_btc, fiat_value_eur]) or not (user_api_key or invoice_reference):
         logger.error("Missing required payment data")
         return jsonify({
             "status": "error",
@@ -907,10 +1097,14 @@ def satsale_webhook():
         }), 400
     
     try:
-        # Find user by API key
-        user = User.query.filter_by(api_key=user_api_key).first()
+        # Find user by invoice reference or API key
+        if invoice_reference:
+            payment_address = mark_invoice_paid(invoice_reference)
+            user = User.query.get(payment_address.user_id) if payment_address else None
+        else:
+            user = User.query.filter_by(api_key=user_api_key).first()
         if not user:
-            logger.error(f"User not found with api_key: {user_api_key}")
+            logger.error(f"User not found for invoice {invoice_reference} / api_key {user_api_key}")
             return jsonify({"status": "error", "message": "User not found"}), 404
         
         # Check if payment already processed (prevent double-charging)
@@ -923,7 +1117,7 @@ def satsale_webhook():
         # Add credits to user balance (EUR)
         # FIXED: Add to kubo_balance_eur (for IPFS Kubo storage) instead of credit_balance_eur
         credit_amount = Decimal(str(fiat_value_eur))
-        user.kubo_balance_eur += credit_amount
+        credit_balance(user.id, "kubo", credit_amount, "payment", reference=tx_id)
         
         # Record payment in database
         new_payment = Payment(
@@ -933,6 +1127,7 @@ def satsale_webhook():
             status='completed'
         )
         db.session.add(new_payment)
+        db.session.flush()  # The invoice row references payments.tx_id
         
         # Create invoice record
         from .models import Invoice
@@ -974,38 +1169,30 @@ def ipfs_health():
         "errors": []
     }
     
+    kubo = get_kubo_client()
+    cluster = get_cluster_client()
+
     # Check IPFS node
     try:
-        result = subprocess.run(["ipfs", "id"], capture_output=True, text=True, timeout=5)
-        if result.returncode == 0:
-            health_status["ipfs_node"] = "healthy"
-        else:
-            health_status["ipfs_node"] = "unhealthy"
-            health_status["errors"].append("IPFS node not responding")
-    except Exception as e:
-        health_status["ipfs_node"] = "error"
-        health_status["errors"].append(f"IPFS node error: {str(e)}")
+        kubo.id(read_timeout=5)
+        health_status["ipfs_node"] = "healthy"
+    except IPFSClientError as e:
+        health_status["ipfs_node"] = "unhealthy"
+        health_status["errors"].append(f"IPFS node not responding: {e}")
     
     # Check swarm peers
     try:
-        result = subprocess.run(["ipfs", "swarm", "peers"], capture_output=True, text=True, timeout=5)
-        if result.returncode == 0:
-            health_status["swarm_peers"] = len(result.stdout.strip().split('\n'))
-    except Exception as e:
+        health_status["swarm_peers"] = len(kubo.swarm_peers(read_timeout=5))
+    except IPFSClientError as e:
         health_status["errors"].append(f"Swarm check error: {str(e)}")
     
     # Check IPFS cluster
     try:
-        result = subprocess.run(["ipfs-cluster-ctl", "peers", "ls"], capture_output=True, text=True, timeout=5)
-        if result.returncode == 0:
-            health_status["ipfs_cluster"] = "healthy"
-            health_status["cluster_peers"] = len(result.stdout.strip().split('\n'))
-        else:
-            health_status["ipfs_cluster"] = "unhealthy"
-            health_status["errors"].append("IPFS cluster not responding")
-    except Exception as e:
-        health_status["ipfs_cluster"] = "error"
-        health_status["errors"].append(f"IPFS cluster error: {str(e)}")
+        health_status["cluster_peers"] = len(cluster.peers(read_timeout=5))
+        health_status["ipfs_cluster"] = "healthy"
+    except IPFSClientError as e:
+        health_status["ipfs_cluster"] = "unhealthy"
+        health_status["errors"].append(f"IPFS cluster not responding: {e}")
     
     # Determine overall status
     if health_status["ipfs_node"] == "healthy" and health_status["ipfs_cluster"] == "healthy":
@@ -0,0 +1,146 @@
+"""
+Scheduler Module
+Long-running daemon that runs every cleanup and billing task on its own interval
+A Postgres advisory lock per task lets any number of nodes run it: each task runs on one node at a time
+Last run, duration and rows touched of each task are kept in task_runs
+"""
+
+import os
+import time
+import socket
+from datetime import datetime, timedelta
+from .models import db, TaskRun
+from .cleanup import (manage_pin_expiration, manage_cluster_backup_expiration, manage_pin_grace_periods,
+                      reset_monthly_bandwidth, charge_monthly_backup_storage, prune_cluster_pin_outcomes)
+from .balances import compact_ledger
+from .capability_tokens import prune_token_revocations
+from .usage_snapshots import snapshot_daily_usage
+from .cluster_billing import charge_monthly_cluster_backups
+from .reconcile import reconcile_cluster_pins
+from .ipfs_upload import release_upload_pins
+
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "5"))   # How often due tasks are looked for
+_LOCK_NAMESPACE = 0x5C4ED                   # First key of pg_try_advisory_lock(int, int); the second is the task name hash
+
+# Task name -> (function, default interval in seconds); override with SCHEDULE_<NAME>_SECONDS
+TASKS = {
+    # Safety net only: the expiration daemon (src.expiration) runs these two at each deadline
+    "pin_expiration": (manage_pin_expiration, 3600),                    # Unpin IPFS Kubo files after retention period
+    "cluster_backup_expiration": (manage_cluster_backup_expiration, 3600),  # Delete IPFS Cluster backups after retention (PREPAID)
+    "pin_grace_periods": (manage_pin_grace_periods, 60),                # Grace period when balance=0 (7 days, then delete user)
+    "reset_monthly_bandwidth": (reset_monthly_bandwidth, 3600),         # Reset bandwidth counters monthly
+    "charge_monthly_backup_storage": (charge_monthly_backup_storage, 86400),  # Monthly billing for backup service (legacy)
+    "compact_ledger": (compact_ledger, 60),                             # Apply ledger-only charges to the balance columns
+    "prune_token_revocations": (prune_token_revocations, 3600),         # Drop revocations older than the longest token lifetime
+    "snapshot_daily_usage": (snapshot_daily_usage, 3600),               # Yesterday's usage rows: storage from the first run after midnight
+    "prune_cluster_pin_outcomes": (prune_cluster_pin_outcomes, 86400),  # Drop unpin/re-pin outcomes older than 30 days
+    "cluster_billing": (charge_monthly_cluster_backups, 86400),         # Bills backups whose 30-day period has ended
+    "release_upload_pins": (release_upload_pins, 300),                  # Local upload pins the cluster now holds elsewhere
+    "reconcile_cluster": (reconcile_cluster_pins, 86400),               # Cluster pinset vs database (repairs if RECONCILE_REPAIR)
+}
+CLEANUP_TASKS = [name for name in TASKS if name not in ("cluster_billing", "reconcile_cluster")]  # What run_cleanup() runs, in order
+
+
+def task_interval(name):
+    """Seconds between two runs of a task, fleet-wide."""
+    return float(os.getenv(f"SCHEDULE_{name.upper()}_SECONDS", TASKS[name][1]))
+
+
+def _is_due(name):
+    last = db.session.query(TaskRun.started_at).filter(TaskRun.name == name).scalar()
+    db.session.commit()
+    return last is None or last + timedelta(seconds=task_interval(name)) <= datetime.utcnow()
+
+
+def _rows_touched(result):
+    # Tasks return a count, or a stats dict (cluster billing, reconciliation)
+    if isinstance(result, dict):
+        return result.get("rows", result.get("backups"))
+    return result if isinstance(result, int) else None
+
+
+def run_task(name, force=False):
+    """
+    Run one task if it is due and no other node is running it.
+
+    The advisory lock is held on its own connection for the whole run, so it
+    survives the task's commits and is released if this process dies.
+
+    Args:
+        name: Key of TASKS
+        force: Run even if the interval has not elapsed (still skipped while another node runs it)
+
+    Returns:
+        bool: True if the task ran (successfully or not)
+    """
+    if not force and not _is_due(name):
+        return False
+
+    with db.engine.connect() as lock_connection:
+        locked = lock_connection.execute(db.text("SELECT pg_try_advisory_lock(:namespace, hashtext(:name))"),
+                                         {"namespace": _LOCK_NAMESPACE, "name": name}).scalar()
+        lock_connection.commit()  # Session-level lock: do not sit idle in a transaction while the task runs
+        if not locked:
+            return False
+        try:
+            # Another node may have finished it between the check and the lock
+            if not force and not _is_due(name):
+                return False
+            return _run_locked(name)
+        finally:
+            lock_connection.execute(db.text("SELECT pg_advisory_unlock(:namespace, hashtext(:name))"),
+                                    {"namespace": _LOCK_NAMESPACE, "name": name})
+            lock_connection.commit()
+
+
+def _run_locked(name):
+    run = db.session.get(TaskRun, name) or TaskRun(name=name)
+    run.status = 'running'
+    run.host = f"{socket.gethostname()}:{os.getpid()}"
+    run.started_at = datetime.utcnow()
+    run.finished_at = run.duration_seconds = run.rows_touched = run.error = None
+    db.session.add(run)
+    db.session.commit()
+
+    started = time.monotonic()
+    try:
+        rows = _rows_touched(TASKS[name][0]())
+        status, error = 'ok', None
+    except Exception as e:
+        db.session.rollback()
+        rows, status, error = None, 'failed', f"{type(e).__name__}: {e}"
+        print(f"Task {name} failed: {error}")
+
+    run = db.session.get(TaskRun, name)
+    run.status = status
+    run.finished_at = datetime.utcnow()
+    run.duration_seconds = time.monotonic() - started
+    run.rows_touched = rows
+    run.error = error
+    db.session.commit()
+    print(f"Task {name} {status} in {run.duration_seconds:.1f}s ({rows} rows)")
+    return True
+
+
+def run_scheduler():
+    """Main loop: run whatever is due, one task at a time, forever. The app is built once."""
+    from .app import create_app
+
+    app = create_app()
+    with app.app_context():
+        print(f"Scheduler started on {socket.gethostname()}: "
+              + ", ".join(f"{name} every {task_interval(name):g}s" for name in TASKS))
+        while True:
+            for name in TASKS:
+                try:
+                    run_task(name)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Scheduler error in {name}: {e}")
+                finally:
+                    db.session.remove()
+            time.sleep(SCHEDULER_TICK_SECONDS)
+
+
+if __name__ == "__main__":
+    run_scheduler()
@@ -0,0 +1,73 @@
+"""
+TTL Cache Module
+Thread-safe, size-bounded LRU cache whose entries expire after a fixed TTL
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    LRU cache with per-entry expiry.
+
+    Entries older than `ttl` seconds are treated as missing; once `maxsize`
+    entries are held, the least recently used one is evicted.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, newer_than=None):
+        """
+        Args:
+            key: Cache key
+            default: Returned on a miss
+            newer_than: Monotonic timestamp; entries stored at or before it count as a miss
+
+        Returns:
+            Cached value or `default`
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            stored_at, value = entry
+            if now - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            if newer_than is not None and stored_at <= newer_than:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, stored_at=None):
+        """
+        Args:
+            key: Cache key
+            value: Value to cache
+            stored_at: Monotonic time the value was read at (default: now); pass
+                the time a lookup started so invalidations during it still apply
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() if stored_at is None else stored_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -56,14 +56,25 @@ CREATE TABLE IF NOT EXISTS cluster_pins (
     FOREIGN KEY (customer_address) REFERENCES customers(address) ON DELETE CASCADE
 );
 
--- Create bandwidth_usage table
+-- Create bandwidth_usage table (gateway traffic per user, CID and window, from src.bandwidth_ingest)
 CREATE TABLE IF NOT EXISTS bandwidth_usage (
     id SERIAL PRIMARY KEY,
-    customer_address VARCHAR(255) NOT NULL,
-    cid VARCHAR(255),
-    bytes_transferred BIGINT NOT NULL,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (customer_address) REFERENCES customers(address) ON DELETE CASCADE
+    user_id INTEGER NOT NULL,
+    cid VARCHAR(255) NOT NULL,
+    is_private BOOLEAN NOT NULL,
+    window_start TIMESTAMP NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    bytes_transferred BIGINT NOT NULL DEFAULT 0,
+    CONSTRAINT uq_bandwidth_usage_window UNIQUE (user_id, window_start, cid, is_private)
+);
+CREATE INDEX IF NOT EXISTS ix_bandwidth_usage_window_start ON bandwidth_usage(window_start);
+
+-- Create log_ingest_checkpoints table (how far each access log has been metered)
+CREATE TABLE IF NOT EXISTS log_ingest_checkpoints (
+    source VARCHAR(255) PRIMARY KEY,
+    inode BIGINT,
+    byte_offset BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Create indexes for performance
@@ -73,7 +84,6 @@ CREATE INDEX IF NOT EXISTS idx_pins_customer ON pins(customer_address);
 CREATE INDEX IF NOT EXISTS idx_pins_status ON pins(status);
 CREATE INDEX IF NOT EXISTS idx_cluster_pins_customer ON cluster_pins(customer_address);
 CREATE INDEX IF NOT EXISTS idx_cluster_pins_status ON cluster_pins(status);
-CREATE INDEX IF NOT EXISTS idx_bandwidth_customer ON bandwidth_usage(customer_address);
 
 -- Grant permissions
 GRANT ALL PRIVILEGES ON DATABASE ipfs_billing TO billing_user;